@@ -0,0 +1,144 @@
+# answer_cache.py
+"""
+Answer cache in front of run_rag_chain.
+
+Lookups match the normalized question text first, then fall back to cosine
+similarity of query embeddings above ANSWER_CACHE_THRESHOLD. Each entry keeps
+the answer, the IDs of its source chunks and the source documents themselves.
+The whole cache is dropped whenever the index version changes (bumped by every
+write to the collection), and entries also expire after ANSWER_CACHE_TTL_S.
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from langchain_core.documents import Document
+from data_loader import chunk_id
+from vector_store_handler import index_version
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE", "true").lower() in ("1", "true", "yes")
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL_S = float(os.getenv("ANSWER_CACHE_TTL_S", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+_PUNCT_RE = re.compile(r"[^\w\s%./-]")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def _unit(v) -> np.ndarray:
+    v = np.asarray(v, dtype=np.float32)
+    return v / (np.linalg.norm(v) or 1.0)
+
+
+def normalize_query(q: str) -> str:
+    q = _PUNCT_RE.sub(" ", q.lower())
+    return _SPACE_RE.sub(" ", q).strip(" .")
+
+
+class AnswerCache:
+    def __init__(self, max_entries: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL_S,
+                 threshold: float = ANSWER_CACHE_THRESHOLD, version_fn: Callable[[], str] = index_version):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.version_fn = version_fn
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._version: Optional[str] = None
+        self.metrics = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "expired": 0, "invalidations": 0}
+
+    def _check_version(self):
+        version = self.version_fn()
+        if version != self._version:
+            if self._entries:
+                LOG.info("Index version changed (%s -> %s); dropping %d cached answers", self._version, version, len(self._entries))
+                self.metrics["invalidations"] += 1
+            self._entries.clear()
+            self._version = version
+
+    def _alive(self, key: str, entry: Dict[str, Any]) -> bool:
+        if time.time() - entry["created"] <= self.ttl:
+            return True
+        del self._entries[key]
+        self.metrics["expired"] += 1
+        return False
+
+    def lookup(self, question: str, embed_fn: Optional[Callable[[str], List[float]]] = None) -> Tuple[Optional[Dict[str, Any]], Optional[np.ndarray]]:
+        """
+        Returns (hit, query_vector). hit is {"answer", "source_documents", "source_ids", "match"} or None.
+        embed_fn is only called when there is no exact match; pass the returned vector on to put().
+        """
+        key = normalize_query(question)
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is not None and self._alive(key, entry):
+                self._entries.move_to_end(key)
+                self.metrics["exact_hits"] += 1
+                return {**entry, "match": "exact"}, entry.get("vector")
+            candidates = [(k, e) for k, e in self._entries.items() if e.get("vector") is not None]
+
+        vector = None
+        if embed_fn is not None:
+            try:
+                vector = _unit(embed_fn(question))
+            except Exception as e:
+                LOG.warning("Query embedding for answer cache failed: %s", e)
+
+        with self._lock:
+            if vector is not None and candidates:
+                sims = np.stack([e["vector"] for _, e in candidates]) @ vector
+                best = int(np.argmax(sims))
+                k, e = candidates[best]
+                if sims[best] >= self.threshold and k in self._entries and self._alive(k, e):
+                    self._entries.move_to_end(k)
+                    self.metrics["semantic_hits"] += 1
+                    LOG.info("Semantic answer-cache hit (%.3f): %r ~ %r", sims[best], key, k)
+                    return {**e, "match": "semantic"}, vector
+            self.metrics["misses"] += 1
+        return None, vector
+
+    def put(self, question: str, answer: str, source_documents: List[Document], vector: Optional[np.ndarray] = None):
+        key = normalize_query(question)
+        with self._lock:
+            self._check_version()
+            self._entries[key] = {
+                "answer": answer,
+                "source_ids": [chunk_id(d) for d in source_documents],
+                "source_documents": list(source_documents),
+                "vector": _unit(vector) if vector is not None else None,
+                "created": time.time(),
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            m = dict(self.metrics)
+            m["size"] = len(self._entries)
+        lookups = m["exact_hits"] + m["semantic_hits"] + m["misses"]
+        m["hit_rate"] = (m["exact_hits"] + m["semantic_hits"]) / lookups if lookups else 0.0
+        return m
+
+
+_CACHE: Optional[AnswerCache] = None
+
+
+def get_answer_cache() -> Optional[AnswerCache]:
+    """Process-wide cache shared by every session, or None when ANSWER_CACHE is disabled."""
+    global _CACHE
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    if _CACHE is None:
+        _CACHE = AnswerCache()
+    return _CACHE
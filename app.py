@@ -1,12 +1,13 @@
 import streamlit as st
 import os
+import uuid
 from dotenv import load_dotenv
 
 # Load Logic
-from file_handler import handle_uploaded_file_bytes
-from data_loader import chunk_documents
-from vector_store_handler import create_vector_store_from_documents, get_existing_retriever
-from chain_handler import run_rag_chain
+from job_queue import get_job_queue, ACTIVE, DONE, DUPLICATE, FAILED
+from chain_handler import stream_rag_chain, GROQ_REPHRASE, GROQ_ANSWER
+from resources import get_retriever, warm_up
+from metadata_index import Scope, get_metadata_index
 
 load_dotenv()
 
@@ -113,13 +114,44 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# --- 3. Session State ---
-if "retriever" not in st.session_state:
-    st.session_state.retriever = get_existing_retriever()
+# --- 3. Shared Resources & Session State ---
+@st.cache_resource(show_spinner="🔥 Loading models...")
+def warm_resources():
+    # Once per server process: reranker, LLM clients and retriever are shared by every session
+    return warm_up(llm_models=(GROQ_REPHRASE, GROQ_ANSWER))
+
+warm_resources()
+
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "processed_files" not in st.session_state:
-    st.session_state.processed_files = set()
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+if "job_ids" not in st.session_state:
+    st.session_state.job_ids = []
+    st.session_state.announced_jobs = set()
+
+JOB_ICONS = {"queued": "⏳", "parsing": "📄", "chunking": "🧩", "embedding": "🧠", DONE: "✅", DUPLICATE: "⏭️", FAILED: "❌"}
+
+
+def render_jobs():
+    """Per-file progress of this session's ingestion jobs (polled while any is running)."""
+    jobs = get_job_queue().jobs(ids=st.session_state.job_ids)
+    for job in jobs:
+        line = f"{JOB_ICONS.get(job['status'], '•')} **{job['name']}** — {job['status']}"
+        if job["detail"]:
+            line += f" ({job['detail']})"
+        st.markdown(line)
+        if job["status"] == DONE and job["id"] not in st.session_state.announced_jobs:
+            st.session_state.announced_jobs.add(job["id"])
+            st.toast(f"Indexed {job['name']} ({job['chunks']} chunks)", icon="🎉")
+    if jobs and not any(j["status"] in ACTIVE for j in jobs):
+        if st.session_state.get("polling_jobs"):
+            # the last job just finished: rerun the page so the fragment is rebuilt without run_every
+            st.session_state.polling_jobs = False
+            st.rerun()
+        if st.button("Clear finished", use_container_width=True):
+            st.session_state.job_ids = []
+            st.rerun()
 
 # --- 4. Sidebar (Add Files) ---
 with st.sidebar:
@@ -136,29 +168,26 @@ with st.sidebar:
             if not uploaded_files:
                 st.toast("⚠️ Please select a file first.", icon="📂")
             else:
-                with st.status("⚙️ Processing...", expanded=True) as status:
-                    all_docs = []
-                    new_files = []
-                    for f in uploaded_files:
-                        if f.name not in st.session_state.processed_files:
-                            file_bytes = f.read()
-                            try:
-                                docs = handle_uploaded_file_bytes(file_bytes, f.name)
-                                all_docs.extend(docs)
-                                new_files.append(f.name)
-                                st.session_state.processed_files.add(f.name)
-                            except Exception as e:
-                                st.error(f"Error: {e}")
-                    
-                    if all_docs:
-                        st.write("🧩 Chunking & Embedding...")
-                        chunks = chunk_documents(all_docs)
-                        create_vector_store_from_documents(chunks)
-                        st.session_state.retriever = get_existing_retriever()
-                        status.update(label="✅ Indexing Complete!", state="complete", expanded=False)
-                        st.toast(f"Added {len(new_files)} documents!", icon="🎉")
-                    else:
-                        status.update(label="⚠️ No new data", state="error")
+                # Indexing runs on background workers; the chat stays usable meanwhile
+                queue = get_job_queue()
+                for f in uploaded_files:
+                    st.session_state.job_ids.append(queue.enqueue(f.name, f.getvalue(), session=st.session_state.session_id))
+                st.toast(f"Queued {len(uploaded_files)} file(s) for indexing", icon="📥")
+
+        if st.session_state.job_ids:
+            active = any(j["status"] in ACTIVE for j in get_job_queue().jobs(ids=st.session_state.job_ids))
+            st.session_state.polling_jobs = active
+            # only this block reruns while polling, not the whole page
+            st.fragment(run_every=1.0 if active else None)(render_jobs)()
+
+    with st.expander("🔍 Search Scope"):
+        # listed from the in-memory metadata index, not by scanning the collection
+        catalog = get_metadata_index().describe()
+        picked = st.multiselect("Documents", options=list(catalog), placeholder="All documents",
+                                format_func=lambda s: f"{s} ({catalog[s]['chunks']} chunks)")
+        st.session_state.scope = Scope(sources=picked) if picked else None
+        if picked:
+            st.caption(f"Searching {sum(catalog[s]['chunks'] for s in picked)} of {sum(c['chunks'] for c in catalog.values())} chunks")
 
     st.divider()
     if st.button("🗑️ Clear Chat", use_container_width=True):
@@ -227,41 +256,46 @@ if st.session_state.messages and st.session_state.messages[-1]["role"] == "user"
     user_query = st.session_state.messages[-1]["content"]
     
     with st.chat_message("assistant"):
-        if not st.session_state.retriever:
+        retriever = get_retriever()
+        if not retriever:
             st.warning("⚠️ Please upload and index documents in the sidebar first.")
         else:
-            with st.spinner("🧠 Thinking..."):
-                try:
-                    # Run RAG
-                    result = run_rag_chain(user_query, [], st.session_state.retriever)
-                    answer = result["answer"]
-                    docs = result["source_documents"]
-                    
-                    st.markdown(answer)
-                    
-                    # Prepare Source Metadata
-                    source_meta = []
-                    with st.expander("📚 Reference Sources"):
-                        seen_sources = set()
-                        for d in docs:
-                            source_id = f"{d.metadata.get('source')} - Pg {d.metadata.get('page')}"
-                            if source_id not in seen_sources:
-                                st.markdown(f"**📄 {d.metadata.get('source', 'Unknown')}** (Page {d.metadata.get('page', '?')})")
-                                preview = d.page_content[:150].replace("\n", " ")
-                                st.caption(f"_{preview}..._")
-                                source_meta.append({
-                                    "source": d.metadata.get('source'),
-                                    "page": d.metadata.get('page'),
-                                    "preview": preview
-                                })
-                                seen_sources.add(source_id)
+            try:
+                # Retrieve & rerank first so sources can be shown before generation starts
+                with st.spinner("🔎 Searching..."):
+                    result = stream_rag_chain(user_query, [], retriever, scope=st.session_state.get("scope"))
+                docs = result["source_documents"]
+
+                # answer goes above the sources, but is filled in after they are rendered
+                answer_box = st.container()
+
+                # Prepare Source Metadata
+                source_meta = []
+                with st.expander("📚 Reference Sources"):
+                    seen_sources = set()
+                    for d in docs:
+                        source_id = f"{d.metadata.get('source')} - Pg {d.metadata.get('page')}"
+                        if source_id not in seen_sources:
+                            st.markdown(f"**📄 {d.metadata.get('source', 'Unknown')}** (Page {d.metadata.get('page', '?')})")
+                            preview = d.page_content[:150].replace("\n", " ")
+                            st.caption(f"_{preview}..._")
+                            source_meta.append({
+                                "source": d.metadata.get('source'),
+                                "page": d.metadata.get('page'),
+                                "preview": preview
+                            })
+                            seen_sources.add(source_id)
+
+                # Stream the answer token by token
+                with answer_box:
+                    answer = st.write_stream(result["answer_stream"])
 
-                    # Save to history
-                    st.session_state.messages.append({
-                        "role": "assistant", 
-                        "content": answer,
-                        "sources": source_meta
-                    })
-                    
-                except Exception as e:
-                    st.error(f"Error: {e}")
\ No newline at end of file
+                # Save to history
+                st.session_state.messages.append({
+                    "role": "assistant", 
+                    "content": answer,
+                    "sources": source_meta
+                })
+                
+            except Exception as e:
+                st.error(f"Error: {e}")
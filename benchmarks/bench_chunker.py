@@ -0,0 +1,100 @@
+# benchmarks/bench_chunker.py
+"""
+Throughput of data_loader.chunk_documents (single-pass, token-based) against
+chunk_documents_legacy (MarkdownHeaderTextSplitter + RecursiveCharacterTextSplitter).
+
+Corpora:
+    qatar      text of data/uploads/qatar_test_doc.pdf, one Document per page
+               (pypdf text extraction; falls back to synthetic pages of the same size)
+    synthetic  generated markdown, --mb megabytes split into 4 KB pages
+
+    python benchmarks/bench_chunker.py --mb 100
+    python benchmarks/bench_chunker.py --mb 10 --skip-legacy-above 20
+"""
+
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from langchain_core.documents import Document
+from data_loader import chunk_documents, chunk_documents_legacy
+
+QATAR_PDF = ROOT / "data" / "uploads" / "qatar_test_doc.pdf"
+WORDS = ("growth inflation liquidity LNG output fiscal surplus QCB policy rate deposits credit "
+         "banking sector non-hydrocarbon GDP projected percent medium-term outlook reforms").split()
+
+
+def qatar_pages():
+    try:
+        from pypdf import PdfReader
+        pages = [p.extract_text() or "" for p in PdfReader(str(QATAR_PDF)).pages]
+    except Exception as e:
+        print(f"(pypdf extraction unavailable: {e}; using synthetic pages of similar size)")
+        return synthetic_pages(0.2)
+    return [Document(page_content=t, metadata={"source": QATAR_PDF.name, "page": i + 1}) for i, t in enumerate(pages)]
+
+
+def _paragraph(rng: random.Random) -> str:
+    sentences = []
+    for _ in range(rng.randint(2, 8)):
+        words = rng.choices(WORDS, k=rng.randint(6, 30))
+        sentences.append(" ".join(words).capitalize() + f" {rng.randint(1, 99)}.{rng.randint(0, 9)}%.")
+    return " ".join(sentences)
+
+
+def synthetic_pages(mb: float, page_bytes: int = 4096, seed: int = 7):
+    rng = random.Random(seed)
+    # pages are random draws from a pool of blocks, so chunks differ without generating 100 MB of prose
+    blocks = [_paragraph(rng) for _ in range(2000)]
+    blocks += [f"### {rng.choice(WORDS).title()} details" for _ in range(50)]
+    blocks += ["| Year | Value |\n| --- | --- |\n" + "\n".join(f"| {2015 + j} | {rng.randint(0, 999)} |" for j in range(6)) for _ in range(200)]
+    pages, total, n = [], 0, 0
+    target = int(mb * 2**20)
+    while total < target:
+        parts, size = [f"# Report {n // 20}\n## Section {n}"], 0
+        while size < page_bytes:
+            parts.append(rng.choice(blocks))
+            size += len(parts[-1])
+        text = "\n\n".join(parts)
+        pages.append(Document(page_content=text, metadata={"source": f"synthetic_{n // 50}.md", "page": n % 50 + 1}))
+        total += len(text)
+        n += 1
+    return pages
+
+
+def timed(fn, docs):
+    t0 = time.perf_counter()
+    chunks = fn(docs)
+    return time.perf_counter() - t0, len(chunks)
+
+
+def report(name, docs, skip_legacy):
+    mb = sum(len(d.page_content) for d in docs) / 2**20
+    print(f"\n{name}: {len(docs)} pages, {mb:.1f} MB")
+    new_s, new_n = timed(chunk_documents, docs)
+    print(f"  token chunker : {new_s:8.2f}s  {mb / new_s:7.1f} MB/s  {new_n / new_s:9.0f} chunks/s  ({new_n} chunks)")
+    if skip_legacy:
+        print("  legacy        : skipped")
+        return
+    old_s, old_n = timed(chunk_documents_legacy, docs)
+    print(f"  legacy        : {old_s:8.2f}s  {mb / old_s:7.1f} MB/s  {old_n / old_s:9.0f} chunks/s  ({old_n} chunks)")
+    print(f"  speedup       : {old_s / new_s:.1f}x")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mb", type=float, default=100, help="size of the synthetic markdown corpus")
+    ap.add_argument("--skip-legacy-above", type=float, default=float("inf"), help="MB above which the legacy chunker is not run")
+    args = ap.parse_args()
+
+    report("qatar_test_doc.pdf", qatar_pages(), skip_legacy=False)
+    report("synthetic markdown", synthetic_pages(args.mb), skip_legacy=args.mb > args.skip_legacy_above)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# benchmarks/bench_ingest.py
+"""
+Offline speedup check for ingestion.ingest_files.
+
+A stub parser sleeps to mimic a LlamaParse round trip and returns canned
+markdown pages, so no API key or network is needed:
+
+    python benchmarks/bench_ingest.py --files 40 --latency 0.5 --workers 8
+"""
+
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from ingestion import ingest_files
+from benchmarks.fakes import make_stub_parser
+
+
+def run(files, parse_fn, workers, chunk_workers):
+    t0 = time.perf_counter()
+    chunks = sum(len(r.chunks) for r in ingest_files(files, parse_fn=parse_fn, workers=workers, chunk_workers=chunk_workers))
+    return time.perf_counter() - t0, chunks
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--files", type=int, default=20)
+    ap.add_argument("--pages", type=int, default=10)
+    ap.add_argument("--latency", type=float, default=0.5, help="stub parse seconds per file")
+    ap.add_argument("--workers", type=int, default=8)
+    ap.add_argument("--chunk-workers", type=int, default=2)
+    args = ap.parse_args()
+
+    parse_fn = make_stub_parser(args.latency, args.pages)
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i in range(args.files):
+            p = Path(tmp) / f"doc_{i:04d}.pdf"
+            p.write_bytes(b"%PDF-stub " + str(i).encode())
+            files.append(p)
+
+        seq_s, seq_chunks = run(files, parse_fn, workers=1, chunk_workers=0)
+        par_s, par_chunks = run(files, parse_fn, workers=args.workers, chunk_workers=args.chunk_workers)
+
+    print(f"sequential: {seq_s:.2f}s ({seq_chunks} chunks)")
+    print(f"concurrent: {par_s:.2f}s ({par_chunks} chunks, workers={args.workers}, chunk_workers={args.chunk_workers})")
+    print(f"speedup:    {seq_s / par_s:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# benchmarks/bench_local_index.py
+"""
+Recall, latency, size and cold start of the local vector index (local_index.py)
+against exact float32 search, optionally also against Chroma.
+
+Vectors are synthetic (clustered Gaussian, unit length, like text embeddings);
+ground truth is an exact float32 scan with the same squared-L2 distance.
+
+    python benchmarks/bench_local_index.py --n 200000 --dim 768
+    python benchmarks/bench_local_index.py --n 50000 --chroma      # adds Chroma build + cold-open timings
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from local_index import LocalIndex
+
+
+def synthetic(n: int, dim: int, clusters: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    x = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def exact_topk(data: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    sq = np.einsum("ij,ij->i", data, data)
+    out = []
+    for q in queries:
+        dist = sq - 2.0 * (data @ q)
+        top = np.argpartition(dist, k)[:k]
+        out.append(top[np.argsort(dist[top])])
+    return np.stack(out)
+
+
+def percentiles(samples):
+    a = np.asarray(samples) * 1000
+    return {"p50_ms": round(float(np.percentile(a, 50)), 3), "p95_ms": round(float(np.percentile(a, 95)), 3),
+            "p99_ms": round(float(np.percentile(a, 99)), 3)}
+
+
+def run_queries(index: LocalIndex, queries: np.ndarray, truth: np.ndarray, k: int, nprobe: int):
+    times, hits = [], 0
+    for q, t in zip(queries, truth):
+        t0 = time.perf_counter()
+        got = [row for row, _ in index.search(q, k=k, nprobe=nprobe)]
+        times.append(time.perf_counter() - t0)
+        hits += len(set(got) & set(t.tolist()))
+    return {"recall": round(hits / truth.size, 4), **percentiles(times)}
+
+
+def cold_open(code: str) -> float:
+    """Seconds from interpreter start to the first query result, in a fresh process."""
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=ROOT, env={**os.environ, "ANONYMIZED_TELEMETRY": "False"})
+    return time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=200_000)
+    ap.add_argument("--dim", type=int, default=768)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--lists", type=int, default=0, help="IVF lists (default: sqrt(n))")
+    ap.add_argument("--chroma", action="store_true", help="also build a Chroma collection and compare cold start")
+    ap.add_argument("--out", help="write the JSON results here")
+    args = ap.parse_args()
+
+    data = synthetic(args.n, args.dim, clusters=max(16, args.n // 2000))
+    queries = synthetic(args.queries, args.dim, clusters=max(16, args.n // 2000), seed=0)  # same centers as data
+    queries += 0.05 * np.random.default_rng(1).standard_normal(queries.shape).astype(np.float32)
+    truth = exact_topk(data, queries, args.k)
+    ids = [f"v{i}" for i in range(args.n)]
+    lists = args.lists or int(np.sqrt(args.n))
+    work = tempfile.mkdtemp(prefix="bench_local_index_")
+    results = {"n": args.n, "dim": args.dim, "k": args.k, "float32_bytes": int(data.nbytes), "backends": {}}
+
+    sq = np.einsum("ij,ij->i", data, data)
+    t0 = time.perf_counter()
+    for q in queries:
+        np.argpartition(sq - 2.0 * (data @ q), args.k)
+    results["float32_numpy_scan_ms"] = round((time.perf_counter() - t0) / len(queries) * 1000, 3)
+
+    try:
+        for dtype in ("float16", "int8"):
+            path = os.path.join(work, dtype)
+            index = LocalIndex(path, dtype=dtype)
+            t0 = time.perf_counter()
+            for i in range(0, args.n, 5000):
+                index.upsert(ids[i:i + 5000], data[i:i + 5000])
+            build_s = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            index = LocalIndex(path, dtype=dtype)
+            open_s = time.perf_counter() - t0
+            stats = index.stats()
+            entry = {"build_s": round(build_s, 2), "open_ms": round(open_s * 1000, 2), "vector_bytes": stats["vector_bytes"],
+                     "compression": round(data.nbytes / stats["vector_bytes"], 2),
+                     "exact": run_queries(index, queries, truth, args.k, nprobe=0)}
+            t0 = time.perf_counter()
+            index.build_ivf(lists)
+            entry["ivf_build_s"] = round(time.perf_counter() - t0, 2)
+            entry["ivf_lists"] = lists
+            for nprobe in (4, 8, 16, 32):
+                entry[f"ivf_nprobe_{nprobe}"] = run_queries(index, queries, truth, args.k, nprobe=nprobe)
+            entry["cold_open_and_query_s"] = round(cold_open(
+                "import numpy as np; from local_index import LocalIndex; "
+                f"LocalIndex({path!r}).search(np.ones({args.dim}, dtype=np.float32), k=5, nprobe=0)"), 2)
+            results["backends"][dtype] = entry
+            print(dtype, json.dumps(entry), flush=True)
+
+        if args.chroma:
+            import chromadb
+            path = os.path.join(work, "chroma")
+            col = chromadb.PersistentClient(path=path).get_or_create_collection("bench")
+            t0 = time.perf_counter()
+            for i in range(0, args.n, 5000):
+                col.add(ids=ids[i:i + 5000], embeddings=data[i:i + 5000])
+            entry = {"build_s": round(time.perf_counter() - t0, 2)}
+            times, hits = [], 0
+            for q, t in zip(queries, truth):
+                t0 = time.perf_counter()
+                got = col.query(query_embeddings=[q], n_results=args.k)["ids"][0]
+                times.append(time.perf_counter() - t0)
+                hits += len({int(g[1:]) for g in got} & set(t.tolist()))
+            entry["query"] = {"recall": round(hits / truth.size, 4), **percentiles(times)}
+            entry["cold_open_and_query_s"] = round(cold_open(
+                "import chromadb; "
+                f"chromadb.PersistentClient(path={path!r}).get_collection('bench').query(query_embeddings=[[1.0]*{args.dim}], n_results=5)"), 2)
+            results["backends"]["chroma"] = entry
+            print("chroma", json.dumps(entry), flush=True)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        Path(args.out).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# benchmarks/bench_parse_shards.py
+"""
+Offline check of page-range sharding in llama_parser_handler.iter_parsed_pages.
+
+The LlamaParse call is replaced by fakes.PdfTextParser (pypdf text per page plus
+injected latency and failures), so it runs without a key or network on the
+bundled report:
+
+    python benchmarks/bench_parse_shards.py
+    python benchmarks/bench_parse_shards.py --shard-pages 5 --workers 16 --page-latency 0.5 --fail 2
+
+Checks and reports:
+    whole        one request for the whole file (the previous behaviour)
+    sharded      concurrent shards with --fail shards failing once: total time, time to
+                 first pages, retried shards, and that every page comes back once with
+                 the same absolute page number and text as the whole-file parse
+    resume       a shard that keeps failing raises after the retries; a re-run only
+                 sends that shard (the others come from the parse cache)
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def collect(batches):
+    t0 = time.perf_counter()
+    first, pages = None, []
+    for batch in batches:
+        if first is None:
+            first = time.perf_counter() - t0
+        pages.extend(batch)
+    return pages, first, time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--file", default=str(ROOT / "data" / "uploads" / "qatar_test_doc.pdf"))
+    ap.add_argument("--shard-pages", type=int, default=10)
+    ap.add_argument("--workers", type=int, default=8)
+    ap.add_argument("--request-latency", type=float, default=2.0, help="stub seconds per request")
+    ap.add_argument("--page-latency", type=float, default=0.2, help="stub seconds per page (vision parsing is page-bound)")
+    ap.add_argument("--fail", type=int, default=1, help="shards that fail once")
+    args = ap.parse_args()
+
+    # the parse cache is read at import time: point it at a scratch directory
+    os.environ["PARSE_CACHE_DIR"] = tempfile.mkdtemp(prefix="parse_cache_")
+    os.environ["PARSE_CACHE"] = "true"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    from pypdf import PdfReader
+    from benchmarks.fakes import PdfTextParser
+    from llama_parser_handler import iter_parsed_pages, split_pdf
+    from parse_cache import get_parse_cache
+
+    data = Path(args.file).read_bytes()
+    name = Path(args.file).name
+    reader = PdfReader(args.file)
+    n_pages = len(reader.pages)
+    shards = split_pdf(data, args.shard_pages)
+    opts = dict(shard_pages=args.shard_pages, workers=args.workers, retry_delay=0.1)
+    report = {"file": name, "pages": n_pages, "shards": len(shards)}
+
+    base = PdfTextParser(data)
+    texts = base.texts
+    parser = PdfTextParser(data, args.request_latency, args.page_latency, texts=texts)
+    reference, _, whole_s = collect(iter_parsed_pages(data, name, parse_fn=parser, shard_pages=0))
+    report["whole"] = {"seconds": round(whole_s, 2), "pages": len(reference)}
+    get_parse_cache().clear()
+
+    # the first --fail shards fail once
+    first_pages = [texts[base._fingerprint(reader.pages[s[0] - 1])] for s in shards]
+    parser = PdfTextParser(data, args.request_latency, args.page_latency, fail_first=first_pages[: args.fail], texts=texts)
+    pages, first_s, sharded_s = collect(iter_parsed_pages(data, name, parse_fn=parser, **opts))
+    by_page = sorted(pages, key=lambda p: p["page"])
+    report["sharded"] = {
+        "seconds": round(sharded_s, 2), "first_pages_s": round(first_s, 2), "speedup": round(whole_s / sharded_s, 1),
+        "requests": parser.calls, "retried": parser.calls - len(shards), "pages_sent": parser.pages_parsed,
+        "same_pages": by_page == reference, "duplicates": len(pages) - len({p["page"] for p in pages}),
+    }
+    get_parse_cache().clear()
+
+    # one shard fails on every attempt: the call raises, completed shards stay cached
+    stuck = first_pages[-1]
+    parser = PdfTextParser(data, texts=texts)
+    parser.fail_first = _Always([stuck])
+    try:
+        collect(iter_parsed_pages(data, name, parse_fn=parser, retries=1, **opts))
+        raised = None
+    except RuntimeError as e:
+        raised = str(e)
+    parser = PdfTextParser(data, texts=texts)
+    pages, _, _ = collect(iter_parsed_pages(data, name, parse_fn=parser, **opts))
+    report["resume"] = {"error": raised, "rerun_requests": parser.calls,
+                        "same_pages": sorted(pages, key=lambda p: p["page"]) == reference}
+
+    print(json.dumps(report, indent=2))
+
+
+class _Always(set):
+    """fail_first stand-in whose entry is never used up."""
+
+    def discard(self, item):
+        pass
+
+
+if __name__ == "__main__":
+    main()
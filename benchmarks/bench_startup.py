@@ -0,0 +1,124 @@
+# benchmarks/bench_startup.py
+"""
+Cold-start cost of the app's entry points, from `python -X importtime`.
+
+Each entry point is imported in a fresh interpreter (best of --repeat runs):
+
+    total_ms      sum of all module import times reported by -X importtime
+    wall_ms       interpreter start to import finished, minus a bare `python -c pass`
+    top           packages with the largest share of total_ms
+    heavy         heavy dependencies that were loaded (ingestion / provider / eval stacks)
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --entries chain_handler,app --repeat 5 --out startup.json
+
+"app" imports what app.py imports at module level (running app.py itself needs a
+Streamlit server). LLAMA_CLOUD_API_KEY is removed from the environment, so an
+entry point that still needs the parser stack at import time fails visibly.
+"""
+
+import os
+import ast
+import sys
+import json
+import time
+import argparse
+import subprocess
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List
+
+ROOT = Path(__file__).resolve().parent.parent
+
+ENTRIES = ("chain_handler", "resources", "vector_store_handler", "app", "job_queue", "setup_db", "evaluate")
+# loaded on first use only; a query-serving worker should import none of these
+HEAVY = ("llama_parse", "llama_index", "flashrank", "onnxruntime", "ragas", "datasets", "pandas", "chromadb",
+         "langchain_chroma", "langchain_google_genai", "google.genai", "langchain_groq", "groq",
+         "langchain_community", "langchain_classic", "langchain_text_splitters",
+         "llama_parser_handler", "file_handler")
+
+_PROBE = "import sys, json; print(json.dumps([m for m in {heavy!r} if m in sys.modules]))"
+
+
+def app_imports() -> List[str]:
+    """Modules app.py imports at top level."""
+    tree = ast.parse((ROOT / "app.py").read_text(encoding="utf-8"))
+    mods = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            mods += [a.name for a in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            mods.append(node.module)
+    return mods
+
+
+def parse_importtime(stderr: str) -> Dict[str, float]:
+    """Self time in microseconds per module from -X importtime output."""
+    out = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        out[name.strip()] = out.get(name.strip(), 0.0) + float(self_us)
+    return out
+
+
+def run_once(modules: List[str]) -> Dict[str, Any]:
+    env = {k: v for k, v in os.environ.items() if k != "LLAMA_CLOUD_API_KEY"}
+    env.setdefault("ANONYMIZED_TELEMETRY", "False")
+    code = "".join(f"import {m}; " for m in modules) + _PROBE.format(heavy=HEAVY)
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+    if proc.returncode != 0:
+        errors = [l for l in proc.stderr.splitlines() if l.strip() and not l.startswith("import time:")]
+        return {"error": errors[-1] if errors else f"exit {proc.returncode}"}
+    times = parse_importtime(proc.stderr)
+    return {"wall_s": wall, "times": times, "heavy": json.loads(proc.stdout.strip().splitlines()[-1])}
+
+
+def bench_entry(name: str, repeat: int, baseline_s: float) -> Dict[str, Any]:
+    modules = app_imports() if name == "app" else [name]
+    runs = [run_once(modules) for _ in range(repeat)]
+    failed = [r for r in runs if "error" in r]
+    if failed:
+        return {"modules": modules, "error": failed[0]["error"]}
+    best = min(runs, key=lambda r: sum(r["times"].values()))
+    by_package = Counter()
+    for mod, us in best["times"].items():
+        by_package[mod.split(".")[0]] += us
+    return {
+        "modules": modules,
+        "total_ms": round(sum(best["times"].values()) / 1000, 1),
+        "wall_ms": round(1000 * (min(r["wall_s"] for r in runs) - baseline_s), 1),
+        "imported": len(best["times"]),
+        "top": {pkg: round(us / 1000, 1) for pkg, us in by_package.most_common(8)},
+        "heavy": best["heavy"],
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--entries", default=",".join(ENTRIES), help="comma-separated modules ('app' = app.py's imports)")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--out", help="write the JSON report here (always printed)")
+    args = ap.parse_args()
+
+    baseline = min(run_once([])["wall_s"] for _ in range(args.repeat))
+    results = {}
+    for name in (e.strip() for e in args.entries.split(",") if e.strip()):
+        results[name] = r = bench_entry(name, args.repeat, baseline)
+        if "error" in r:
+            print(f"{name:22s} FAILED: {r['error']}", flush=True)
+        else:
+            print(f"{name:22s} {r['total_ms']:8.1f} ms imports {r['wall_ms']:8.1f} ms wall  heavy: {', '.join(r['heavy']) or '-'}", flush=True)
+
+    report = {"python": sys.version.split()[0], "baseline_ms": round(1000 * baseline, 1), "results": results}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        Path(args.out).write_text(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+# benchmarks/bench_suite.py
+"""
+Offline regression suite: ingestion, chunking, retrieval, rerank and end-to-end
+run_rag_chain latency with the local stand-ins from benchmarks/fakes.py
+(hashing embedder, echo LLM, overlap ranker, stub parser), so no API keys or
+network are needed and runs are comparable over time.
+
+    python benchmarks/bench_suite.py --sizes 1000,10000 --out results.json
+    python benchmarks/bench_suite.py --sizes 1000000 --queries 200 --skip ingestion,chunking
+    python benchmarks/bench_suite.py --compare baseline.json results.json
+
+Measured:
+    chunking     chunk_documents on synthetic markdown: MB/s, chunks/s
+    ingestion    stub-parsed files through ingestion.stream_index into a real collection: pages/s, chunks/s
+    corpora      per size: index build (chunks/s), retriever open time, retrieval and rerank
+                 latency, end-to-end run_rag_chain latency (p50/p95/p99 ms) and the same
+                 queries as one run_rag_chain_many batch (total seconds, questions/s)
+
+Provider latencies are injectable (--llm-latency, --embed-latency, ...); they
+default to 0 so the numbers show the pipeline's own overhead. Answer and
+rerank caches are off unless --warm-caches is given.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+WORDS = ("growth inflation liquidity LNG output fiscal surplus QCB policy rate deposits credit banking sector "
+         "non-hydrocarbon GDP projected percent medium-term outlook reforms tourism exports imports reserves "
+         "capital market equity bonds housing prices construction employment wages energy renewable solar").split()
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    a = np.asarray(samples) * 1000
+    return {"n": len(samples), "p50_ms": round(float(np.percentile(a, 50)), 3), "p95_ms": round(float(np.percentile(a, 95)), 3),
+            "p99_ms": round(float(np.percentile(a, 99)), 3), "mean_ms": round(float(a.mean()), 3)}
+
+
+def synthetic_chunks(n: int, seed: int = 0):
+    """n chunk Documents over n/200 sources; every chunk carries a unique marker term so queries have a known target."""
+    from langchain_core.documents import Document
+    from data_loader import _hash_text
+    rng = random.Random(seed)
+    for i in range(n):
+        body = " ".join(rng.choices(WORDS, k=rng.randint(40, 120)))
+        text = f"Item ref{i} {body} {rng.randint(1, 99)}.{rng.randint(0, 9)}%."
+        source = f"report_{i // 200:05d}.pdf"
+        yield Document(page_content=text, metadata={"source": source, "page": (i % 200) // 10 + 1, "chunk_index": i % 10,
+                                                    "chunk_hash": _hash_text(text), "Header 1": f"Section {i % 7}"})
+
+
+def make_queries(n_chunks: int, count: int, seed: int = 1) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    return [{"text": f"ref{t} {' '.join(rng.sample(WORDS, 3))}", "target": f"ref{t}"}
+            for t in (rng.randrange(n_chunks) for _ in range(count))]
+
+
+def bench_chunking(mb: float) -> Dict[str, Any]:
+    from benchmarks.bench_chunker import synthetic_pages
+    from data_loader import chunk_documents
+    pages = synthetic_pages(mb)
+    size = sum(len(p.page_content) for p in pages) / 2**20
+    t0 = time.perf_counter()
+    chunks = chunk_documents(pages)
+    s = time.perf_counter() - t0
+    return {"mb": round(size, 2), "pages": len(pages), "chunks": len(chunks), "seconds": round(s, 3),
+            "mb_per_s": round(size / s, 2), "chunks_per_s": round(len(chunks) / s, 1)}
+
+
+def bench_ingestion(work: str, files: int, pages: int, parse_latency: float) -> Dict[str, Any]:
+    from benchmarks.fakes import make_stub_parser
+    from ingestion import BytesSource, stream_index
+    from vector_store_handler import EmbeddingWriter
+    persist = os.path.join(work, "ingest_db")
+    writer = EmbeddingWriter(persist_directory=persist)
+    sources = [BytesSource(f"doc_{i:04d}.pdf", f"%PDF-stub {i}".encode()) for i in range(files)]
+    t0 = time.perf_counter()
+    n_chunks = n_pages = 0
+    for event, res in stream_index(sources, write_fn=writer.write, parse_fn=make_stub_parser(parse_latency, pages)):
+        if event == "committed":
+            n_chunks += len(res.chunk_ids)
+            n_pages += pages
+    s = time.perf_counter() - t0
+    return {"files": files, "pages": n_pages, "chunks": n_chunks, "seconds": round(s, 3),
+            "pages_per_s": round(n_pages / s, 1), "chunks_per_s": round(n_chunks / s, 1)}
+
+
+def bench_corpus(work: str, size: int, n_queries: int) -> Dict[str, Any]:
+    import resources
+    from chain_handler import run_rag_chain, run_rag_chain_many
+    from vector_store_handler import EmbeddingWriter, get_existing_retriever, VECTOR_BACKEND
+    persist = os.path.join(work, f"corpus_{size}")
+    out: Dict[str, Any] = {"chunks": size, "backend": VECTOR_BACKEND}
+
+    writer = EmbeddingWriter(persist_directory=persist)
+    batch, t0 = [], time.perf_counter()
+    for d in synthetic_chunks(size):
+        batch.append(d)
+        if len(batch) == 5000:
+            writer.write(batch)
+            batch = []
+    if batch:
+        writer.write(batch)
+    s = time.perf_counter() - t0
+    out["build"] = {"seconds": round(s, 2), "chunks_per_s": round(size / s, 1)}
+
+    t0 = time.perf_counter()
+    retriever = get_existing_retriever(persist)
+    out["open_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+    resources.REGISTRY.swap("retriever", retriever)
+
+    queries = make_queries(size, n_queries)
+    stage = resources.get_rerank_stage()
+    retrieval, rerank, hits = [], [], 0
+    for q in queries:
+        t0 = time.perf_counter()
+        docs = retriever.invoke(q["text"])
+        retrieval.append(time.perf_counter() - t0)
+        hits += any(q["target"] in d.page_content.split() for d in docs)
+        t0 = time.perf_counter()
+        stage.rerank(q["text"], docs)
+        rerank.append(time.perf_counter() - t0)
+    out["retrieval"] = {**percentiles(retrieval), "hit_rate": round(hits / len(queries), 3)}
+    out["rerank"] = percentiles(rerank)
+
+    e2e = []
+    for q in queries:
+        t0 = time.perf_counter()
+        run_rag_chain(q["text"], [], retriever)
+        e2e.append(time.perf_counter() - t0)
+    out["end_to_end"] = percentiles(e2e)
+
+    t0 = time.perf_counter()
+    answered = sum(1 for _ in run_rag_chain_many([q["text"] for q in queries], retriever))
+    s = time.perf_counter() - t0
+    out["batch"] = {"questions": answered, "seconds": round(s, 3), "questions_per_s": round(answered / s, 1)}
+    shutil.rmtree(persist, ignore_errors=True)
+    return out
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit or None, "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def _flatten(d: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    out = {}
+    for k, v in d.items():
+        key = f"{prefix}.{k}" if prefix else k
+        if isinstance(v, dict):
+            out.update(_flatten(v, key))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[key] = float(v)
+    return out
+
+
+def compare(base_path: str, new_path: str):
+    """Prints every shared metric with its relative change (latencies: lower is better, rates: higher is better)."""
+    base = _flatten(json.loads(Path(base_path).read_text())["results"])
+    new = _flatten(json.loads(Path(new_path).read_text())["results"])
+    print(f"{'metric':60s} {'base':>12s} {'new':>12s} {'change':>9s}")
+    for key in sorted(base.keys() & new.keys()):
+        b, n = base[key], new[key]
+        change = f"{(n - b) / b * 100:+8.1f}%" if b else "      n/a"
+        print(f"{key:60s} {b:12.3f} {n:12.3f} {change}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--sizes", default="1000,10000", help="comma-separated corpus sizes in chunks (1k .. 1M)")
+    ap.add_argument("--queries", type=int, default=100)
+    ap.add_argument("--skip", default="", help="comma-separated: chunking,ingestion,corpora")
+    ap.add_argument("--chunk-mb", type=float, default=20)
+    ap.add_argument("--ingest-files", type=int, default=20)
+    ap.add_argument("--ingest-pages", type=int, default=10)
+    ap.add_argument("--parse-latency", type=float, default=0.0, help="stub parser seconds per file")
+    ap.add_argument("--llm-latency", type=float, default=0.0, help="echo LLM seconds before the first token")
+    ap.add_argument("--token-latency", type=float, default=0.0, help="echo LLM seconds per generated token")
+    ap.add_argument("--embed-latency", type=float, default=0.0, help="embedder seconds per call")
+    ap.add_argument("--rerank-latency", type=float, default=0.0, help="ranker seconds per passage")
+    ap.add_argument("--warm-caches", action="store_true", help="keep the answer and rerank caches on")
+    ap.add_argument("--work-dir", help="where temporary collections are built (default: a temp dir)")
+    ap.add_argument("--out", help="write the JSON report here (always printed)")
+    ap.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two reports and exit")
+    args = ap.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # module-level settings are read at import time, so set them before importing the app
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+    os.environ.setdefault("LLAMA_CLOUD_API_KEY", "offline-benchmark")  # never used: parsing goes through the stub
+    if not args.warm_caches:
+        os.environ["ANSWER_CACHE"] = "false"
+        os.environ["RERANK_CACHE_SIZE"] = "0"
+    import logging
+    logging.basicConfig(level=os.environ["LOG_LEVEL"])
+    logging.getLogger().setLevel(os.environ["LOG_LEVEL"])
+
+    from benchmarks import fakes
+    fakes.install(llm_latency=args.llm_latency, token_latency=args.token_latency, embed_latency=args.embed_latency,
+                  rerank_latency=args.rerank_latency)
+
+    skip = {s.strip() for s in args.skip.split(",") if s.strip()}
+    work = args.work_dir or tempfile.mkdtemp(prefix="rag_bench_")
+    os.makedirs(work, exist_ok=True)
+    results: Dict[str, Any] = {}
+    try:
+        if "chunking" not in skip:
+            results["chunking"] = bench_chunking(args.chunk_mb)
+            print("chunking", json.dumps(results["chunking"]), flush=True)
+        if "ingestion" not in skip:
+            results["ingestion"] = bench_ingestion(work, args.ingest_files, args.ingest_pages, args.parse_latency)
+            print("ingestion", json.dumps(results["ingestion"]), flush=True)
+        if "corpora" not in skip:
+            results["corpora"] = {}
+            for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+                results["corpora"][str(size)] = bench_corpus(work, size, args.queries)
+                print(f"corpus {size}", json.dumps(results["corpora"][str(size)]), flush=True)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work, ignore_errors=True)
+
+    report = {"environment": environment(), "config": vars(args), "results": results}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        Path(args.out).write_text(text)
+
+
+if __name__ == "__main__":
+    main()
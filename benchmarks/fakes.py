@@ -0,0 +1,192 @@
+# benchmarks/fakes.py
+"""
+Local stand-ins for the hosted providers, so benchmarks run offline and are
+repeatable:
+
+    HashingEmbeddings   deterministic feature-hashing embedder (lexical overlap -> cosine similarity)
+    EchoChatModel       chat model that echoes the question, with configurable latency per call and per token
+    FakeRanker          flashrank.Ranker look-alike scoring by token overlap, with per-passage latency
+    make_stub_parser    parse_fn returning canned markdown pages after a fixed delay (no LlamaParse)
+    PdfTextParser       stands in for the LlamaParse call on real PDF bytes: pypdf text per page, with
+                        per-request and per-page latency and injectable failures
+
+install() plugs them into the places the app looks providers up: the resource
+registry (LLM clients, rerank stage) and vector_store_handler's embedding class.
+"""
+
+import io
+import re
+import time
+import hashlib
+import zlib
+import asyncio
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+_WORD_RE = re.compile(r"\w+")
+
+PAGE = """# Section {n}
+## Outlook
+Real GDP growth is projected at {n}.{n} percent, supported by LNG expansion.
+| Year | Growth |
+| --- | --- |
+| 2024 | 2.0 |
+| 2025 | 2.4 |
+""" + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40
+
+
+class HashingEmbeddings(Embeddings):
+    """Bag-of-words feature hashing into `dim` signed buckets, L2-normalized."""
+
+    def __init__(self, dim: int = 256, latency: float = 0.0, model: Optional[str] = None, **kwargs: Any):
+        self.dim = dim
+        self.latency = latency
+        self._buckets: Dict[str, tuple] = {}
+
+    def _vector(self, text: str) -> List[float]:
+        v = np.zeros(self.dim, dtype=np.float32)
+        for tok in _WORD_RE.findall(text.lower()):
+            b = self._buckets.get(tok)
+            if b is None:
+                h = zlib.crc32(tok.encode("utf-8"))
+                b = self._buckets[tok] = (h % self.dim, 1.0 if (h >> 16) & 1 else -1.0)
+            v[b[0]] += b[1]
+        n = float(np.linalg.norm(v))
+        return (v / n if n else v).tolist()
+
+    def embed_documents(self, texts: List[str], task_type: Optional[str] = None) -> List[List[float]]:
+        # task_type mirrors GoogleGenerativeAIEmbeddings, so batched query embedding takes the same path
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._vector(text)
+
+
+class EchoChatModel(BaseChatModel):
+    """
+    Answers with `prefix` + the last human message, repeated up to `tokens` words (0: as is).
+    `latency` is spent before the first token, `token_latency` per token.
+    """
+
+    latency: float = 0.0
+    token_latency: float = 0.0
+    tokens: int = 0
+    prefix: str = ""
+
+    @property
+    def _llm_type(self) -> str:
+        return "echo"
+
+    def _words(self, messages: List[BaseMessage]) -> List[str]:
+        words = (self.prefix + str(messages[-1].content)).split() or ["ok"]
+        if self.tokens:
+            words = (words * (self.tokens // len(words) + 1))[: self.tokens]
+        return [w + " " for w in words]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        words = self._words(messages)
+        time.sleep(self.latency + self.token_latency * len(words))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(words).strip()))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        words = self._words(messages)
+        await asyncio.sleep(self.latency + self.token_latency * len(words))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(words).strip()))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for w in self._words(messages):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=w))
+
+
+class FakeRanker:
+    """Stands in for flashrank.Ranker: rerank(RerankRequest) -> passages with a 'score', best first."""
+
+    def __init__(self, per_passage_latency: float = 0.0):
+        self.per_passage_latency = per_passage_latency
+
+    def rerank(self, request) -> List[Dict[str, Any]]:
+        if self.per_passage_latency:
+            time.sleep(self.per_passage_latency * len(request.passages))
+        q = set(_WORD_RE.findall(request.query.lower()))
+        out = []
+        for p in request.passages:
+            words = set(_WORD_RE.findall(p["text"].lower()))
+            out.append({**p, "score": len(q & words) / (len(q | words) or 1)})
+        return sorted(out, key=lambda r: r["score"], reverse=True)
+
+
+def make_stub_parser(latency: float, pages: int):
+    def parse(file_bytes: bytes, filename: str):
+        time.sleep(latency)
+        return [Document(page_content=PAGE.format(n=i), metadata={"source": filename, "page": i + 1}) for i in range(pages)]
+    return parse
+
+
+class PdfTextParser:
+    """
+    (pdf bytes, filename) -> [{"page", "content"}] like llama_parser_handler._parse_pages, numbered
+    from 1 within the bytes it is given. Page text is extracted from `source` once up front and
+    looked up by content stream, so the timed calls cost only the injected latency.
+    Calls whose first page has a text in fail_first fail once (retry tests).
+    """
+
+    def __init__(self, source: bytes, request_latency: float = 0.0, page_latency: float = 0.0, fail_first: Optional[List[str]] = None,
+                 texts: Optional[Dict[str, str]] = None):
+        from pypdf import PdfReader
+        # texts: the .texts of an earlier parser for the same source, to skip extracting them again
+        self.texts = texts if texts is not None else {self._fingerprint(p): p.extract_text() or "" for p in PdfReader(io.BytesIO(source)).pages}
+        self.request_latency = request_latency
+        self.page_latency = page_latency
+        self.fail_first = set(fail_first or ())
+        self.calls = 0
+        self.pages_parsed = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fingerprint(page) -> str:
+        contents = page.get_contents()
+        return hashlib.sha1(contents.get_data() if contents is not None else b"").hexdigest()
+
+    def __call__(self, file_bytes: bytes, filename: str) -> List[Dict[str, Any]]:
+        from pypdf import PdfReader
+        texts = [self.texts.get(self._fingerprint(p)) or p.extract_text() or "" for p in PdfReader(io.BytesIO(file_bytes)).pages]
+        time.sleep(self.request_latency + self.page_latency * len(texts))
+        with self._lock:
+            self.calls += 1
+            first = texts[0] if texts else ""
+            if first in self.fail_first:
+                self.fail_first.discard(first)
+                raise RuntimeError("injected parse failure")
+            self.pages_parsed += len(texts)
+        return [{"page": i + 1, "content": t} for i, t in enumerate(texts) if t.strip()]
+
+
+def install(llm_latency: float = 0.0, token_latency: float = 0.0, answer_tokens: int = 64, embed_latency: float = 0.0,
+            rerank_latency: float = 0.0, embed_dim: int = 256):
+    """Routes every provider lookup of the app to the stand-ins above (call before building retrievers)."""
+    import resources
+    import chain_handler
+    import vector_store_handler
+    from rerank_stage import RerankStage
+
+    vector_store_handler.embedding_model = lambda: HashingEmbeddings(embed_dim, embed_latency)
+    # the rewritten query differs from the question, so the second retrieval runs as it does in production
+    resources.REGISTRY.register(f"llm:{chain_handler.GROQ_REPHRASE}", lambda: EchoChatModel(latency=llm_latency, prefix="details on "))
+    resources.REGISTRY.register(f"llm:{chain_handler.GROQ_ANSWER}",
+                                lambda: EchoChatModel(latency=llm_latency, token_latency=token_latency, tokens=answer_tokens))
+    resources.REGISTRY.register("rerank_stage", lambda: RerankStage(ranker=FakeRanker(rerank_latency)))
+    for name in (f"llm:{chain_handler.GROQ_REPHRASE}", f"llm:{chain_handler.GROQ_ANSWER}", "rerank_stage", "retriever"):
+        resources.REGISTRY.swap(name)
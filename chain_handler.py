@@ -1,24 +1,34 @@
 import os
+import time
+import asyncio
 import logging
-from typing import List, Dict, Any
+import threading
+import contextvars
+from typing import List, Dict, Any, AsyncIterator, Callable, Iterator, Optional, Tuple
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_groq import ChatGroq
-# Ensure langchain_community is installed
-from langchain_classic.retrievers import ContextualCompressionRetriever
-from langchain_community.document_compressors import FlashrankRerank
+from resources import get_llm, get_rerank_stage
+from answer_cache import get_answer_cache
+from context_packer import pack_context
+from metadata_index import Scope
+from tracing import span, start_span, use_span
 
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
 GROQ_REPHRASE = os.getenv("GROQ_REPHRASE_MODEL", "llama-3.1-8b-instant")
 GROQ_ANSWER = os.getenv("GROQ_ANSWER_MODEL", "llama-3.3-70b-versatile")
+# Past this many seconds the rephrase call is abandoned and raw-question results are used
+REPHRASE_BUDGET_S = float(os.getenv("REPHRASE_BUDGET_S", "1.5"))
+# run_rag_chain_many: rephrase / answer calls in flight at once
+RAG_BATCH_CONCURRENCY = int(os.getenv("RAG_BATCH_CONCURRENCY", "16"))
 
 def build_rephrase_chain():
     template = ChatPromptTemplate.from_messages([
         ("system", "Rewrite the search query to be precise and standalone."),
         ("human", "{input}")
     ])
-    llm = ChatGroq(model=GROQ_REPHRASE)
+    llm = get_llm(GROQ_REPHRASE)  # shared client, built once per process
     return template | llm
 
 def build_answer_chain():
@@ -35,40 +45,25 @@ def build_answer_chain():
          {context}"""),
         ("human", "{input}")
     ])
-    llm = ChatGroq(model=GROQ_ANSWER)
+    llm = get_llm(GROQ_ANSWER)
     return prompt | llm
 
-def get_reranker_retriever(base_retriever):
-    """
-    Wraps the vector store retriever with a Reranker (FlashRank).
-    """
-    compressor = FlashrankRerank(model="ms-marco-MiniLM-L-12-v2") 
-    compression_retriever = ContextualCompressionRetriever(
-        base_compressor=compressor, 
-        base_retriever=base_retriever
-    )
-    return compression_retriever
-
-def run_rag_chain(question: str, history, base_retriever) -> Dict[str, Any]:
-    """
-    Returns a dictionary with 'answer' and 'source_documents'.
-    """
-    reranker = get_reranker_retriever(base_retriever)
+def fuse_candidates(*candidate_lists: List[Document]) -> List[Document]:
+    """Round-robin merge of several ranked lists, dropping duplicate chunks."""
+    fused, seen = [], set()
+    for rank in range(max((len(c) for c in candidate_lists), default=0)):
+        for candidates in candidate_lists:
+            if rank < len(candidates):
+                d = candidates[rank]
+                key = d.metadata.get("chunk_hash") or d.page_content
+                if key not in seen:
+                    seen.add(key)
+                    fused.append(d)
+    return fused
 
-    # 1. Rephrase
-    try:
-        rephraser = build_rephrase_chain()
-        rewritten_query = rephraser.invoke({"input": question}).content
-    except Exception:
-        rewritten_query = question
-    
-    # 2. Retrieve & Rerank
-    docs = reranker.invoke(rewritten_query)
-    
-    if not docs:
-        return {"answer": "I couldn't find relevant information.", "source_documents": []}
 
-    # 3. Format Context
+def format_context_parts(docs: List[Document]) -> List[str]:
+    """One prompt block per document: a source/page/section header line, then the text."""
     context_parts = []
     for d in docs:
         source = d.metadata.get('source', 'Unknown File')
@@ -80,15 +75,428 @@ def run_rag_chain(question: str, history, base_retriever) -> Dict[str, Any]:
         context_header = f"{h1} > {h2}".strip(" > ")
         
         context_parts.append(f"--- SOURCE: {source} | Page: {page} | Section: {context_header} ---\n{d.page_content}")
-    
-    context_text = "\n\n".join(context_parts)
+    return context_parts
+
+
+def format_context(docs: List[Document]) -> str:
+    return "\n\n".join(format_context_parts(docs))
+
+
+async def _arephrase(question: str) -> Optional[str]:
+    """Rewritten query, or None if the rephrase call fails or exceeds REPHRASE_BUDGET_S."""
+    with span("rephrase") as s:
+        try:
+            response = await asyncio.wait_for(build_rephrase_chain().ainvoke({"input": question}), timeout=REPHRASE_BUDGET_S)
+            s.set(**_token_usage(response))
+            return response.content.strip() or None
+        except asyncio.TimeoutError:
+            s.set(timed_out=True)
+            LOG.info("Rephrase exceeded %.1fs budget; using raw-query results", REPHRASE_BUDGET_S)
+        except Exception as e:
+            s.set(failed=True)
+            LOG.warning("Rephrase failed: %s", e)
+        return None
+
+
+async def _aretrieve(retriever, query: str, kind: str) -> List[Document]:
+    with span("retrieve", query=kind) as s:
+        docs = await retriever.ainvoke(query)
+        s.set(candidates=len(docs))
+        return docs
+
+
+def _token_usage(message) -> Dict[str, int]:
+    """Input/output token counts reported by the provider, if any."""
+    usage = getattr(message, "usage_metadata", None) or {}
+    return {k: usage[k] for k in ("input_tokens", "output_tokens") if k in usage}
+
+
+async def aretrieve_and_rerank(question: str, base_retriever) -> Tuple[List[Document], str]:
+    """
+    Retrieval on the raw question starts while the rephrase call is in flight;
+    the rewritten query is retrieved too and both candidate lists are fused before reranking.
+    Returns (reranked docs, query used for reranking).
+    """
+    rephrase_task = asyncio.create_task(_arephrase(question))
+    raw_task = asyncio.create_task(_aretrieve(base_retriever, question, "raw"))
+
+    rewritten_query = await rephrase_task
+    candidate_lists = [await raw_task]
+    if rewritten_query and rewritten_query != question.strip():
+        candidate_lists.append(await _aretrieve(base_retriever, rewritten_query, "rewritten"))
+
+    candidates = fuse_candidates(*candidate_lists)
+    query = rewritten_query or question
+    if not candidates:
+        return [], query
+    with span("rerank", candidates=len(candidates)) as s:
+        # FlashRank is CPU-bound: keep it off the event loop
+        docs = await asyncio.to_thread(get_rerank_stage().rerank, query, candidates)
+        s.set(kept=len(docs))
+    return docs, query
 
-    # 4. Generate Answer
-    answer_chain = build_answer_chain() 
-    response = answer_chain.invoke({"input": question, "context": context_text})
+
+def _query_embed_fn(base_retriever) -> Optional[Callable[[str], List[float]]]:
+    embeddings = getattr(getattr(base_retriever, "vectorstore", None), "embeddings", None)
+    return embeddings.embed_query if embeddings is not None else None
+
+
+def _answer_cache(history, scope: Optional[Scope], use_cache: bool = True):
+    # cached answers are keyed by the question only, so scoped questions bypass the cache
+    if not use_cache or history or (scope is not None and not scope.is_empty()):
+        return None
+    return get_answer_cache()
+
+
+async def _aretrieve_or_cached(question: str, history, base_retriever, scope: Optional[Scope] = None,
+                               use_cache: bool = True):
+    """
+    Answer-cache lookup runs alongside rephrase/retrieval; on a hit the retrieval is cancelled.
+    Returns (cache hit or None, reranked docs, query vector for a later cache put).
+    """
+    cache = _answer_cache(history, scope, use_cache)
+    if scope is not None and not scope.is_empty():
+        from vector_store_handler import scoped_retriever
+        base_retriever = scoped_retriever(base_retriever, scope)
+    retrieve_task = asyncio.create_task(aretrieve_and_rerank(question, base_retriever))
+    if cache is None:
+        docs, _ = await retrieve_task
+        return None, docs, None
+
+    with span("answer_cache") as s:
+        try:
+            hit, query_vector = await asyncio.to_thread(cache.lookup, question, _query_embed_fn(base_retriever))
+        except Exception as e:
+            # the cache is an optimization: fall back to the retrieval already in flight
+            s.set(failed=True)
+            LOG.warning("Answer cache lookup failed: %s", e)
+            hit, query_vector = None, None
+        s.set(hit=hit is not None)
+    if hit is not None:
+        retrieve_task.cancel()
+        LOG.info("Answer cache %s hit (hit rate %.0f%%)", hit["match"], 100 * cache.stats()["hit_rate"])
+        return hit, hit["source_documents"], query_vector
+    docs, _ = await retrieve_task
+    return None, docs, query_vector
+
+
+async def arun_rag_chain(question: str, history, base_retriever, scope: Optional[Scope] = None,
+                         use_cache: bool = True) -> Dict[str, Any]:
+    """
+    Async RAG pipeline. Returns a dictionary with 'answer', 'source_documents' (reranked hits)
+    and 'contexts' (the context blocks the answer was generated from, as sent in the prompt).
+    Repeated (or near-identical) questions are served from the answer cache; use_cache=False
+    skips it both ways (evaluation, where near-duplicate questions must be answered separately).
+    scope (documents, page range, section prefix) limits retrieval to matching chunks.
+    """
+    with span("rag_chain", scoped=scope is not None and not scope.is_empty(), history=len(history or [])) as root:
+        # 1+2. Rephrase || Retrieve, then Rerank
+        hit, docs, query_vector = await _aretrieve_or_cached(question, history, base_retriever, scope, use_cache)
+        root.set(cache_hit=hit is not None, docs=len(docs))
+        if hit is not None:
+            # packing is deterministic, so these are the blocks the cached answer was generated from
+            return {"answer": hit["answer"], "source_documents": docs, "contexts": _packed_context(docs)}
+
+        if not docs:
+            return {"answer": "I couldn't find relevant information.", "source_documents": [], "contexts": []}
+
+        # 3. Format Context (adjacent chunks merged, repeats dropped, capped at the token budget)
+        contexts = _packed_context(docs)
+        context_text = "\n\n".join(contexts)
+
+        # 4. Generate Answer
+        response = await _agenerate(question, context_text)
+
+    cache = _answer_cache(history, scope, use_cache)
+    if cache is not None:
+        cache.put(question, response.content, docs, vector=query_vector)
     
     # Return BOTH answer and docs for the UI
     return {
         "answer": response.content,
-        "source_documents": docs
-    }
\ No newline at end of file
+        "source_documents": docs,
+        "contexts": contexts,
+    }
+
+
+async def _agenerate(question: str, context_text: str):
+    with span("answer") as s:
+        response = await build_answer_chain().ainvoke({"input": question, "context": context_text})
+        s.set(**_token_usage(response))
+        return response
+
+
+def _packed_context(docs: List[Document]) -> List[str]:
+    """Prompt context blocks for the reranked docs."""
+    with span("pack_context", chunks=len(docs)) as s:
+        packed = pack_context(docs)
+        s.set(blocks=len(packed))
+        return format_context_parts(packed)
+
+
+def stream_answer(question: str, docs: List[Document], started: Optional[float] = None,
+                  on_complete: Optional[Callable[[str], None]] = None, trace=None) -> Iterator[str]:
+    """
+    Yields answer tokens from the answer chain as they arrive.
+    Logs time-to-first-token and total latency (both measured from 'started', e.g. when the question came in).
+    on_complete receives the full answer once the stream is exhausted.
+    trace is the caller's (already started) span; it is ended when the stream is.
+    """
+    t0 = started if started is not None else time.perf_counter()
+    if not docs:
+        yield "I couldn't find relevant information."
+        if trace is not None:
+            trace.end()
+        return
+    first_token = None
+    parts = []
+    usage: Dict[str, int] = {}
+    # the consumer may resume this generator from another thread, so the span is passed, not taken from context
+    s = start_span("answer", parent=trace)
+    try:
+        answer_chain = build_answer_chain()
+        with use_span(s):
+            context_text = "\n\n".join(_packed_context(docs))
+        for chunk in answer_chain.stream({"input": question, "context": context_text}):
+            for k, v in _token_usage(chunk).items():  # streamed usage arrives as per-chunk deltas
+                usage[k] = usage.get(k, 0) + v
+            if not chunk.content:
+                continue
+            if first_token is None:
+                first_token = time.perf_counter() - t0
+                LOG.info("Time to first token: %.2fs", first_token)
+            parts.append(chunk.content)
+            yield chunk.content
+    except BaseException as e:
+        s.end(e)
+        if trace is not None:
+            trace.end(e)
+        raise
+    s.set(chunks=len(parts), first_token_ms=round(1000 * (first_token or 0.0), 1), **usage).end()
+    if trace is not None:
+        trace.end()
+    if on_complete is not None:
+        on_complete("".join(parts))
+    LOG.info("Answer complete: %.2fs total (first token %.2fs)", time.perf_counter() - t0, first_token or 0.0)
+
+
+def stream_rag_chain(question: str, history, base_retriever, scope: Optional[Scope] = None) -> Dict[str, Any]:
+    """
+    Streaming variant of run_rag_chain: retrieval and reranking finish before this returns,
+    so 'source_documents' can be shown right away; 'answer_stream' yields tokens lazily.
+    """
+    started = time.perf_counter()
+    root = start_span("rag_chain", streamed=True, scoped=scope is not None and not scope.is_empty(), history=len(history or []))
+    try:
+        with use_span(root):
+            hit, docs, query_vector = _run_sync(_aretrieve_or_cached(question, history, base_retriever, scope))
+    except BaseException as e:
+        root.end(e)
+        raise
+    root.set(cache_hit=hit is not None, docs=len(docs))
+    if hit is not None:
+        root.end()
+        return {"source_documents": docs, "answer_stream": iter([hit["answer"]])}
+    LOG.info("Retrieval ready in %.2fs (%d docs)", time.perf_counter() - started, len(docs))
+
+    on_complete = None
+    cache = _answer_cache(history, scope)
+    if cache is not None and docs:
+        on_complete = lambda answer: cache.put(question, answer, docs, vector=query_vector)
+    return {
+        "source_documents": docs,
+        "answer_stream": stream_answer(question, docs, started=started, on_complete=on_complete, trace=root),
+    }
+
+
+# One event loop per process runs every synchronous entry point: the shared ChatGroq
+# clients (resources.get_llm) keep an async HTTP pool that is bound to the loop it was
+# first used on, so a fresh asyncio.run per question would break it after the first call.
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_LOOP_PID: Optional[int] = None
+_LOOP_LOCK = threading.Lock()
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP, _LOOP_PID
+    with _LOOP_LOCK:
+        if _LOOP is None or _LOOP_PID != os.getpid():  # a forked child does not inherit the loop thread
+            _LOOP, _LOOP_PID = asyncio.new_event_loop(), os.getpid()
+            threading.Thread(target=_LOOP.run_forever, name="rag-loop", daemon=True).start()
+        return _LOOP
+
+
+async def _in_context(coro, ctx: contextvars.Context):
+    # the task copies the caller's context, so spans opened on the loop join the caller's trace
+    return await ctx.run(asyncio.get_running_loop().create_task, coro)
+
+
+def _run_sync(coro):
+    """Runs coro on the process-wide background loop and waits for the result (any thread, any running loop)."""
+    loop = _background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coro.close()
+        raise RuntimeError("called from the background loop itself; await the coroutine instead")
+    future = asyncio.run_coroutine_threadsafe(_in_context(coro, contextvars.copy_context()), loop)
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def run_rag_chain(question: str, history, base_retriever, scope: Optional[Scope] = None) -> Dict[str, Any]:
+    """
+    Returns a dictionary with 'answer', 'source_documents' and 'contexts'.
+    Thin synchronous wrapper around arun_rag_chain; see there for scope.
+    """
+    return _run_sync(arun_rag_chain(question, history, base_retriever, scope))
+
+
+async def _aembed_queries(retriever, queries: List[str]) -> Optional[List[List[float]]]:
+    embeddings = getattr(getattr(retriever, "vectorstore", None), "embeddings", None)
+    if embeddings is None:
+        return None
+    from vector_store_handler import embed_queries
+    with span("embed_queries", queries=len(queries)):
+        return await asyncio.to_thread(embed_queries, embeddings, queries)
+
+
+async def _asearch_many(retriever, queries: List[str], vectors: Optional[List[List[float]]]) -> List[List[Document]]:
+    """One multi-query vector search where the retriever supports it, else retriever.abatch."""
+    from vector_store_handler import search_many
+    with span("retrieve", queries=len(queries)) as s:
+        found = await asyncio.to_thread(search_many, retriever, queries, vectors) if vectors is not None else None
+        if found is None:
+            s.set(batched=False)
+            found = await retriever.abatch(queries)
+        s.set(candidates=sum(len(f) for f in found))
+        return found
+
+
+async def arun_rag_chain_many(questions: List[str], base_retriever, scope: Optional[Scope] = None,
+                              concurrency: int = RAG_BATCH_CONCURRENCY) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+    """
+    arun_rag_chain for a batch of independent questions (no chat history), e.g. a questionnaire.
+    Yields (index into questions, result) as each answer completes; results are the dicts
+    arun_rag_chain returns, plus 'error' if that question's answer call failed.
+
+    Each stage runs once for the whole batch: all rephrases concurrently, one batched query
+    embedding, one multi-query vector search, reranking on RERANK_WORKERS threads; then at most
+    `concurrency` answer calls are in flight, so the batch takes about as long as its slowest question.
+    """
+    questions = list(questions)
+    if not questions:
+        return
+    limit = asyncio.Semaphore(max(1, concurrency))
+    cache = _answer_cache(None, scope)
+    if scope is not None and not scope.is_empty():
+        from vector_store_handler import scoped_retriever
+        base_retriever = scoped_retriever(base_retriever, scope)
+
+    async def rephrase(question: str) -> Optional[str]:
+        async with limit:
+            return await _arephrase(question)
+
+    async def answer(i: int, docs: List[Document]) -> Tuple[int, Dict[str, Any]]:
+        if not docs:
+            return i, {"answer": "I couldn't find relevant information.", "source_documents": [], "contexts": []}
+        async with limit:
+            contexts = _packed_context(docs)
+            try:
+                response = await _agenerate(questions[i], "\n\n".join(contexts))
+            except Exception as e:
+                LOG.warning("Answer failed for question %d: %s", i, e)
+                return i, {"answer": None, "source_documents": docs, "contexts": contexts, "error": f"{type(e).__name__}: {e}"}
+        if cache is not None:
+            cache.put(questions[i], response.content, docs, vector=query_vectors[i])
+        return i, {"answer": response.content, "source_documents": docs, "contexts": contexts}
+
+    root = start_span("rag_chain_many", questions=len(questions), concurrency=concurrency,
+                      scoped=scope is not None and not scope.is_empty())
+    tasks: List[asyncio.Task] = []
+    try:
+        with use_span(root):
+            rewritten = await asyncio.gather(*(rephrase(q) for q in questions))
+
+            # distinct search queries: every question, plus its rewrite when that differs
+            queries: List[str] = []
+            slots: Dict[str, int] = {}
+            def slot(text: str) -> int:
+                if text not in slots:
+                    slots[text] = len(queries)
+                    queries.append(text)
+                return slots[text]
+            raw = [slot(q) for q in questions]
+            alt = [slot(r) if r and r != q.strip() else None for q, r in zip(questions, rewritten)]
+            vectors = await _aembed_queries(base_retriever, queries)
+
+            hits: Dict[int, Dict[str, Any]] = {}
+            query_vectors: List[Any] = [None] * len(questions)
+            if cache is not None:
+                with span("answer_cache", questions=len(questions)) as s:
+                    for i, q in enumerate(questions):
+                        vector = vectors[raw[i]] if vectors is not None else None
+                        hit, query_vectors[i] = cache.lookup(q, (lambda _q, v=vector: v) if vector is not None else None)
+                        if hit is not None:
+                            hits[i] = hit
+                    s.set(hits=len(hits))
+            misses = [i for i in range(len(questions)) if i not in hits]
+
+            reranked: List[List[Document]] = []
+            if misses:
+                needed = sorted({j for i in misses for j in (raw[i], alt[i]) if j is not None})
+                found = await _asearch_many(base_retriever, [queries[j] for j in needed],
+                                            [vectors[j] for j in needed] if vectors is not None else None)
+                by_query = dict(zip(needed, found))
+                requests = [(rewritten[i] or questions[i],
+                             fuse_candidates(*(by_query[j] for j in (raw[i], alt[i]) if j is not None))) for i in misses]
+                reranked = await asyncio.to_thread(get_rerank_stage().rerank_many, requests)
+            # tasks inherit the root span as their parent
+            tasks = [asyncio.create_task(answer(i, docs)) for i, docs in zip(misses, reranked)]
+        root.set(cache_hits=len(hits))
+
+        for i, hit in hits.items():
+            yield i, {"answer": hit["answer"], "source_documents": hit["source_documents"],
+                      "contexts": _packed_context(hit["source_documents"])}
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    except BaseException as e:
+        root.end(e)
+        raise
+    finally:
+        for t in tasks:
+            t.cancel()
+    root.end()
+
+
+def run_rag_chain_many(questions: List[str], base_retriever, scope: Optional[Scope] = None,
+                       concurrency: int = RAG_BATCH_CONCURRENCY) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Synchronous arun_rag_chain_many: yields (index, result) as answers complete.
+    The batch runs on the background loop (answers keep arriving while the caller
+    handles earlier results); closing the iterator early cancels it.
+
+        results = [None] * len(questions)
+        for i, result in run_rag_chain_many(questions, retriever):
+            results[i] = result
+    """
+    batch = arun_rag_chain_many(questions, base_retriever, scope, concurrency)
+    try:
+        while True:
+            try:
+                item = _run_sync(_anext(batch))
+            except StopAsyncIteration:
+                break
+            yield item
+    finally:
+        # cancels the answer calls still in flight
+        _run_sync(batch.aclose())
+
+
+async def _anext(agen):
+    return await agen.__anext__()
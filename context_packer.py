@@ -0,0 +1,124 @@
+# context_packer.py
+"""
+Builds the prompt context from reranked chunks with as few tokens as possible.
+
+1. Group hits by (source, page, headers).
+2. Within a group, merge chunks that are adjacent by chunk_index, cutting the
+   text the splitter repeated between them (CHUNK_OVERLAP).
+3. Drop paragraphs that already appear in an earlier block.
+4. Pack blocks into CONTEXT_TOKEN_BUDGET in rank order (a group ranks as its
+   best hit). Blocks keep source/page metadata, so format_context still emits
+   the page needed for [Page X] citations.
+"""
+
+import os
+import re
+import logging
+from typing import Dict, List, Optional, Tuple
+from langchain_core.documents import Document
+from data_loader import estimate_tokens
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+# shorter suffix/prefix matches are treated as coincidence, not splitter overlap
+MIN_OVERLAP_CHARS = int(os.getenv("CONTEXT_MIN_OVERLAP_CHARS", "20"))
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+_PARA_RE = re.compile(r"\n\s*\n")
+_SPACE_RE = re.compile(r"\s+")
+_GROUP_KEYS = ("source", "page", "Header 1", "Header 2", "Header 3")
+
+
+def _overlap(a: str, b: str, max_chars: int) -> int:
+    """Length of the longest suffix of a that is also a prefix of b."""
+    for n in range(min(len(a), len(b), max_chars), MIN_OVERLAP_CHARS - 1, -1):
+        if a.endswith(b[:n]):
+            return n
+    return 0
+
+
+def merge_texts(a: str, b: str, max_overlap: Optional[int] = None) -> str:
+    if b in a:
+        return a
+    if a in b:
+        return b
+    n = _overlap(a, b, max_overlap or len(b))
+    if n:
+        return a + b[n:]
+    return a.rstrip() + "\n" + b.lstrip()
+
+
+def _dedupe_paragraphs(text: str, seen: set) -> str:
+    kept = []
+    for para in _PARA_RE.split(text):
+        key = _SPACE_RE.sub(" ", para).strip().lower()
+        if not key:
+            continue
+        if key in seen:
+            continue
+        seen.add(key)
+        kept.append(para.strip())
+    return "\n\n".join(kept)
+
+
+def _group_blocks(docs: List[Document]) -> List[Tuple[int, Document]]:
+    """(best rank, merged Document) per run of adjacent chunks, in no particular order."""
+    groups: Dict[tuple, List[Tuple[int, Document]]] = {}
+    seen_chunks = set()
+    for rank, d in enumerate(docs):
+        chunk_key = d.metadata.get("chunk_hash") or d.page_content
+        if chunk_key in seen_chunks:
+            continue
+        seen_chunks.add(chunk_key)
+        key = tuple(d.metadata.get(k) for k in _GROUP_KEYS)
+        groups.setdefault(key, []).append((rank, d))
+
+    blocks = []
+    for members in groups.values():
+        members.sort(key=lambda rd: (rd[1].metadata.get("chunk_index", rd[0]), rd[0]))
+        run: List[Tuple[int, Document]] = []
+        for rank, d in members + [(None, None)]:
+            idx = d.metadata.get("chunk_index") if d is not None else None
+            prev = run[-1][1].metadata.get("chunk_index") if run else None
+            if run and idx is not None and prev is not None and idx - prev <= 1:
+                run.append((rank, d))
+                continue
+            if run:
+                text = run[0][1].page_content
+                for _, nxt in run[1:]:
+                    text = merge_texts(text, nxt.page_content)
+                meta = dict(run[0][1].metadata)
+                if len(run) > 1:
+                    meta["merged_chunks"] = [m.metadata.get("chunk_index") for _, m in run]
+                blocks.append((min(r for r, _ in run), Document(page_content=text, metadata=meta)))
+            run = [(rank, d)] if d is not None else []
+    return blocks
+
+
+def pack_context(docs: List[Document], token_budget: int = CONTEXT_TOKEN_BUDGET) -> List[Document]:
+    """Merged, de-duplicated blocks that fit token_budget, best-ranked first."""
+    if not docs:
+        return []
+    blocks = sorted(_group_blocks(docs), key=lambda rb: rb[0])
+    before = sum(estimate_tokens(d.page_content) for d in docs)
+
+    packed, seen, used = [], set(), 0
+    for _, block in blocks:
+        text = _dedupe_paragraphs(block.page_content, seen)
+        if not text:
+            continue
+        tokens = estimate_tokens(text)
+        if used + tokens > token_budget:
+            remaining = token_budget - used
+            if remaining < 64:
+                continue
+            # keep the head of the block, cut at a word boundary
+            text = text[: remaining * 4].rsplit(" ", 1)[0] + " ..."  # ~4 chars per token, as in estimate_tokens
+            tokens = estimate_tokens(text)
+        packed.append(Document(page_content=text, metadata=block.metadata))
+        used += tokens
+
+    LOG.info("Context packed: %d chunks -> %d blocks, ~%d -> ~%d tokens (budget %d)",
+             len(docs), len(packed), before, used, token_budget)
+    return packed
@@ -1,12 +1,17 @@
-from typing import List, Iterable
+from typing import Dict, List, Iterable, Iterator, Tuple
+import io
+import re
 import hashlib
 from langchain_core.documents import Document
-from langchain_text_splitters import MarkdownHeaderTextSplitter,RecursiveCharacterTextSplitter
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# chunk sizes for the token-based chunker
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "256"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "50"))
+# character sizes, only used by chunk_documents_legacy
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
 DEDUP = os.getenv("DEDUP", "true").lower() in ("1", "true", "yes")#it helps user if he add twice it ignore and repetitive text it help to dedup catches it so it help to cost less 
@@ -16,13 +21,141 @@ def _hash_text(t: str) -> str:
     return hashlib.sha1(t.encode("utf-8")).hexdigest()[:12]
 
 
-def chunk_documents(docs: Iterable[Document], chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP, dedupe: bool = DEDUP) -> List[Document]:
+def chunk_id(doc: Document) -> str:
+    """Deterministic vector-store ID: re-indexing the same chunk overwrites it instead of adding a duplicate."""
+    chunk_hash = doc.metadata.get("chunk_hash") or _hash_text(doc.page_content)
+    return f"{doc.metadata.get('source', 'file')}-{chunk_hash}"
+
+
+# approximate tokens: words, numbers and single punctuation marks (~1.2x BPE tokens on English prose)
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_HEADER_RE = re.compile(r"(#{1,3})(?:\s+(.*))?$")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+# (text, tokens, separator placed before it when joined)
+_Unit = Tuple[str, int, str]
+
+
+def count_tokens(text: str) -> int:
+    return _TOKEN_RE.subn("", text)[1]  # counts matches without building the list
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheaper estimate for budgets (embedding batches, prompt context): ~4 characters per token."""
+    return max(1, len(text) // 4)
+
+
+def _split_long(text: str, max_tokens: int) -> Iterator[_Unit]:
+    """Sentences, or fixed token windows for sentences that are still too long."""
+    for i, sentence in enumerate(_SENTENCE_RE.split(text)):
+        sep = " " if i else "\n"
+        n = count_tokens(sentence)
+        if n <= max_tokens:
+            yield sentence, n, sep
+            continue
+        starts = [m.start() for m in _TOKEN_RE.finditer(sentence)]
+        for j in range(0, len(starts), max_tokens):
+            end = starts[j + max_tokens] if j + max_tokens < len(starts) else len(sentence)
+            yield sentence[starts[j]:end].strip(), min(max_tokens, len(starts) - j), sep if j == 0 else " "
+
+
+def _pack(units: List[_Unit], chunk_tokens: int, overlap_tokens: int) -> Iterator[str]:
+    """Greedy packing of units into chunks of <= chunk_tokens, carrying <= overlap_tokens of trailing units."""
+    cur: List[_Unit] = []
+    cur_tokens = 0
+    for unit in units:
+        if cur and cur_tokens + unit[1] > chunk_tokens:
+            yield "".join(u[2] + u[0] for u in cur)[len(cur[0][2]):]
+            # keep the tail of the chunk as overlap for the next one
+            tail, tail_tokens = [], 0
+            for u in reversed(cur):
+                if tail_tokens + u[1] > overlap_tokens or tail_tokens + u[1] + unit[1] > chunk_tokens:
+                    break
+                tail.append(u)
+                tail_tokens += u[1]
+            cur, cur_tokens = tail[::-1], tail_tokens
+        cur.append(unit)
+        cur_tokens += unit[1]
+    if cur:
+        yield "".join(u[2] + u[0] for u in cur)[len(cur[0][2]):]
+
+
+def iter_markdown_chunks(text: str, chunk_tokens: int = CHUNK_TOKENS, chunk_overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[Tuple[str, Dict[str, str]]]:
+    """
+    Single pass over markdown: tracks '#'..'###' headers (header lines are not
+    part of the chunk text, headers inside code fences are ignored) and yields
+    (chunk text, {"Header 1": ..}) per chunk of at most chunk_tokens tokens.
+    """
+    headers: Dict[str, str] = {}
+    units: List[_Unit] = []
+    in_fence = False
+    paragraph_break = False
+
+    for raw in io.StringIO(text):
+        line = raw.strip()
+        if not in_fence and line[:1] == "#":
+            m = _HEADER_RE.match(line)
+            if m:
+                if units:
+                    yield from ((c, headers) for c in _pack(units, chunk_tokens, chunk_overlap_tokens))
+                    units = []
+                level = len(m.group(1))
+                headers = {k: v for k, v in headers.items() if int(k[-1]) < level}
+                headers[f"Header {level}"] = (m.group(2) or "").strip()
+                continue
+        if (line.startswith("```") and line.count("```") == 1) or line.startswith("~~~"):
+            in_fence = not in_fence
+        if not line:
+            paragraph_break = True
+            continue
+        sep = "\n\n" if paragraph_break else "\n"
+        paragraph_break = False
+        n = count_tokens(line)
+        if n <= chunk_tokens:
+            units.append((line, n, sep))
+        else:
+            for i, unit in enumerate(_split_long(line, chunk_tokens)):
+                units.append(unit if i else (unit[0], unit[1], sep))
+    if units:
+        yield from ((c, headers) for c in _pack(units, chunk_tokens, chunk_overlap_tokens))
+
+
+def iter_chunk_documents(docs: Iterable[Document], chunk_tokens: int = CHUNK_TOKENS, chunk_overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                         dedupe: bool = DEDUP) -> Iterator[Document]:
+    """Lazy version of chunk_documents."""
+    seen_hashes = set()
+    for doc in docs:
+        for i, (text, headers) in enumerate(iter_markdown_chunks(doc.page_content, chunk_tokens, chunk_overlap_tokens)):
+            chunk_hash = _hash_text(text)
+            if dedupe:
+                if chunk_hash in seen_hashes:
+                    continue
+                seen_hashes.add(chunk_hash)
+            yield Document(page_content=text, metadata={**doc.metadata, **headers, "chunk_index": i, "chunk_hash": chunk_hash})
+
+
+def chunk_documents(docs: Iterable[Document], chunk_tokens: int = CHUNK_TOKENS, chunk_overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                    dedupe: bool = DEDUP) -> List[Document]:
     """
     Smart Chunking:
+    1. Splits by Markdown Headers (Header 1..3 metadata, logical sections stay together).
+    2. Packs each section into chunks of at most chunk_tokens tokens, on line/sentence
+       boundaries, with chunk_overlap_tokens of overlap.
+    """
+    return list(iter_chunk_documents(docs, chunk_tokens, chunk_overlap_tokens, dedupe))
+
+
+def chunk_documents_legacy(docs: Iterable[Document], chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP, dedupe: bool = DEDUP) -> List[Document]:
+    """
+    Previous LangChain-based chunker (character sizes), kept as the reference
+    for benchmarks/bench_chunker.py.
+    Smart Chunking:
     1. Splits by Markdown Headers first (to keep logical sections together).
     2. Then splits by characters if the section is still too big.
     """
 
+    from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
+
     # 1. Define Headers to split on
     headers_to_split_on = [
         ("#", "Header 1"),
@@ -32,8 +165,8 @@ def chunk_documents(docs: Iterable[Document], chunk_size: int = CHUNK_SIZE, chun
     markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on)
    # 2. Define Recursive Splitter for large sections
     text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE, 
-        chunk_overlap=CHUNK_OVERLAP
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
     )
     
     all_chunks = []
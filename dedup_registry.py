@@ -0,0 +1,244 @@
+# dedup_registry.py
+"""
+Persistent, corpus-wide dedup registry stored next to the vector store
+(<persist>_dedup.sqlite, SQLite in WAL mode so Streamlit sessions and
+setup_db can use it at the same time).
+
+Two levels:
+- files:  whole-file SHA-256 -> the source that indexed it. A file whose
+          content is already indexed (under any name) is not parsed again.
+- chunks: chunk_hash -> the vector ID holding that text, plus per-source
+          references. A chunk whose text is already in the collection is not
+          embedded or written again; vectors are only deleted once no source
+          references them (see prune()). Re-indexing a source under new content
+          returns the IDs of its old chunks nobody else references
+          (commit_file()/alias()), so callers can delete them.
+
+A file is "claimed" (status 'pending') before it is parsed, so two sessions
+uploading the same PDF do not both parse it; stale claims from crashed runs
+expire after DEDUP_CLAIM_TTL_S.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+DEDUP_ENABLED = os.getenv("DEDUP", "true").lower() in ("1", "true", "yes")
+DEDUP_CLAIM_TTL_S = float(os.getenv("DEDUP_CLAIM_TTL_S", "1800"))
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    source TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files(sha256);
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk_hash TEXT PRIMARY KEY,
+    chunk_id TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_id ON chunks(chunk_id);
+CREATE TABLE IF NOT EXISTS refs (
+    chunk_hash TEXT NOT NULL,
+    source TEXT NOT NULL,
+    PRIMARY KEY (chunk_hash, source)
+);
+CREATE INDEX IF NOT EXISTS refs_source ON refs(source);
+"""
+
+_MAX_VARS = 900  # stay below SQLite's bound-parameter limit
+
+
+def _batches(items: List[str], size: int = _MAX_VARS):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class DedupRegistry:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # one connection per thread; autocommit, with explicit BEGIN IMMEDIATE for writes
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self):
+        return _Transaction(self._conn())
+
+    # --- files ---
+    def claim_file(self, source: str, sha256: str) -> Tuple[str, Optional[str]]:
+        """
+        ("indexed", owner) if this content is already indexed (owner may equal source),
+        ("pending", owner) if another run is indexing it right now,
+        ("claimed", None)  if the caller should parse and index it.
+        """
+        now = time.time()
+        with self._write() as cur:
+            rows = cur.execute("SELECT source, status, updated_at FROM files WHERE sha256 = ?", (sha256,)).fetchall()
+            done = [r[0] for r in rows if r[1] == "done"]
+            if done:
+                return "indexed", source if source in done else done[0]
+            busy = [r[0] for r in rows if r[1] == "pending" and r[0] != source and now - r[2] < DEDUP_CLAIM_TTL_S]
+            if busy:
+                return "pending", busy[0]
+            cur.execute("INSERT OR REPLACE INTO files (source, sha256, status, updated_at) VALUES (?, ?, 'pending', ?)",
+                        (source, sha256, now))
+        return "claimed", None
+
+    def abandon(self, source: str, sha256: str):
+        """Drops a claim after a failed parse so the file is retried."""
+        with self._write() as cur:
+            cur.execute("DELETE FROM files WHERE source = ? AND sha256 = ? AND status = 'pending'", (source, sha256))
+
+    def commit_file(self, source: str, sha256: str, chunk_refs: Iterable[Tuple[str, str]]) -> List[str]:
+        """
+        Marks the file indexed; chunk_refs are (chunk_hash, chunk_id) pairs the file now relies on.
+        Returns the vector IDs of its previous content that nothing references any more (delete them).
+        """
+        refs = list(chunk_refs)
+        with self._write() as cur:
+            cur.executemany("INSERT OR IGNORE INTO chunks (chunk_hash, chunk_id) VALUES (?, ?)", refs)
+            old = self._release_refs(cur, source)
+            cur.executemany("INSERT OR IGNORE INTO refs (chunk_hash, source) VALUES (?, ?)", [(h, source) for h, _ in refs])
+            cur.execute("INSERT OR REPLACE INTO files (source, sha256, status, updated_at) VALUES (?, ?, 'done', ?)",
+                        (source, sha256, time.time()))
+            return self._orphans(cur, old)
+
+    def alias(self, source: str, sha256: str, owner: str) -> List[str]:
+        """Registers source as a copy of owner's content; returns orphaned vector IDs as commit_file does."""
+        if source == owner:
+            return []
+        with self._write() as cur:
+            old = self._release_refs(cur, source)
+            cur.execute("INSERT OR IGNORE INTO refs (chunk_hash, source) SELECT chunk_hash, ? FROM refs WHERE source = ?", (source, owner))
+            cur.execute("INSERT OR REPLACE INTO files (source, sha256, status, updated_at) VALUES (?, ?, 'done', ?)",
+                        (source, sha256, time.time()))
+            return self._orphans(cur, old)
+
+    @staticmethod
+    def _release_refs(cur: sqlite3.Cursor, source: str) -> Dict[str, str]:
+        """Drops the source's references; returns chunk_hash -> chunk_id of what it referenced."""
+        old = dict(cur.execute(
+            "SELECT c.chunk_hash, c.chunk_id FROM refs r JOIN chunks c ON c.chunk_hash = r.chunk_hash WHERE r.source = ?",
+            (source,)).fetchall())
+        cur.execute("DELETE FROM refs WHERE source = ?", (source,))
+        return old
+
+    @staticmethod
+    def _orphans(cur: sqlite3.Cursor, old: Dict[str, str]) -> List[str]:
+        """Of the released chunks, forgets and returns those no source references any more."""
+        orphaned = []
+        for h, cid in old.items():
+            if cur.execute("SELECT 1 FROM refs WHERE chunk_hash = ? LIMIT 1", (h,)).fetchone() is None:
+                cur.execute("DELETE FROM chunks WHERE chunk_hash = ?", (h,))
+                orphaned.append(cid)
+        return orphaned
+
+    def release(self, source: str):
+        """Forgets a source (file removed). Follow with prune() on its chunk IDs."""
+        with self._write() as cur:
+            cur.execute("DELETE FROM refs WHERE source = ?", (source,))
+            cur.execute("DELETE FROM files WHERE source = ?", (source,))
+
+    def chunk_ids_for(self, source: str) -> List[str]:
+        rows = self._conn().execute(
+            "SELECT c.chunk_id FROM refs r JOIN chunks c ON c.chunk_hash = r.chunk_hash WHERE r.source = ?", (source,)).fetchall()
+        return [r[0] for r in rows]
+
+    # --- chunks ---
+    def known_chunks(self, chunk_hashes: Iterable[str]) -> Dict[str, str]:
+        """chunk_hash -> chunk_id for hashes whose text is already in the collection."""
+        hashes = list(dict.fromkeys(chunk_hashes))
+        found = {}
+        conn = self._conn()
+        for batch in _batches(hashes):
+            marks = ",".join("?" * len(batch))
+            found.update(conn.execute(f"SELECT chunk_hash, chunk_id FROM chunks WHERE chunk_hash IN ({marks})", batch).fetchall())
+        return found
+
+    def prune(self, chunk_ids: Iterable[str]) -> List[str]:
+        """
+        Of the given vector IDs, returns those no source references any more (safe to delete
+        from the collection) and forgets them. IDs the registry never saw are returned as is.
+        """
+        ids = list(dict.fromkeys(chunk_ids))
+        if not ids:
+            return []
+        deletable = []
+        with self._write() as cur:
+            for batch in _batches(ids):
+                marks = ",".join("?" * len(batch))
+                rows = dict(cur.execute(f"SELECT chunk_id, chunk_hash FROM chunks WHERE chunk_id IN ({marks})", batch).fetchall())
+                for cid in batch:
+                    h = rows.get(cid)
+                    if h is None:
+                        deletable.append(cid)
+                    elif cur.execute("SELECT 1 FROM refs WHERE chunk_hash = ? LIMIT 1", (h,)).fetchone() is None:
+                        cur.execute("DELETE FROM chunks WHERE chunk_hash = ?", (h,))
+                        deletable.append(cid)
+        kept = len(ids) - len(deletable)
+        if kept:
+            LOG.info("Keeping %d shared chunks still referenced by other files", kept)
+        return deletable
+
+    def clear(self):
+        with self._write() as cur:
+            cur.execute("DELETE FROM refs")
+            cur.execute("DELETE FROM chunks")
+            cur.execute("DELETE FROM files")
+
+    def stats(self) -> Dict[str, int]:
+        conn = self._conn()
+        return {
+            "files": conn.execute("SELECT COUNT(*) FROM files WHERE status = 'done'").fetchone()[0],
+            "pending": conn.execute("SELECT COUNT(*) FROM files WHERE status = 'pending'").fetchone()[0],
+            "chunks": conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0],
+            "refs": conn.execute("SELECT COUNT(*) FROM refs").fetchone()[0],
+        }
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK, yielding a cursor."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Cursor:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn.cursor()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+_REGISTRIES: Dict[str, DedupRegistry] = {}
+_REGISTRIES_LOCK = threading.Lock()
+
+
+def get_dedup_registry(persist_directory: Optional[str] = None) -> Optional[DedupRegistry]:
+    """Registry for the given vector store (one per process), or None when DEDUP is off."""
+    if not DEDUP_ENABLED:
+        return None
+    from vector_store_handler import sidecar_path
+    path = sidecar_path("dedup.sqlite", persist_directory)
+    with _REGISTRIES_LOCK:
+        if path not in _REGISTRIES:
+            _REGISTRIES[path] = DedupRegistry(path)
+        return _REGISTRIES[path]
@@ -0,0 +1,161 @@
+# embedding_cache.py
+"""
+Persistent embedding cache keyed by (embedding model, chunk_hash).
+
+Vectors live in a flat float32 file that is read through a NumPy memmap; an
+append-only index file maps chunk_hash -> row. Only cache misses are sent to
+the embedding provider, so re-indexing after a small edit embeds only the
+chunks that actually changed.
+"""
+
+import os
+import re
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from data_loader import _hash_text
+from file_lock import file_lock
+from tracing import annotate
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+
+def _model_slug(model_name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name).strip("_") or "model"
+
+
+class EmbeddingCache:
+    """
+    One directory per embedding model:
+        meta.json    -> {"model": ..., "dim": ...}
+        vectors.f32  -> row-major float32 matrix, appended to on every put
+        index.tsv    -> "<chunk_hash>\\t<row>" lines, appended to on every put
+
+    Writes hold a lock file (.lock), so setup_db and the Streamlit server can
+    both append; each process reads the other's rows on its next load.
+    """
+
+    def __init__(self, cache_dir: str, model_name: str):
+        self.model_name = model_name
+        self.dir = Path(cache_dir) / _model_slug(model_name)
+        self._meta_path = self.dir / "meta.json"
+        self._vec_path = self.dir / "vectors.f32"
+        self._idx_path = self.dir / "index.tsv"
+        self._lock = threading.Lock()
+        self.dim: Optional[int] = None
+        self._rows: Dict[str, int] = {}
+        self._mm: Optional[np.memmap] = None
+        self._load()
+
+    def _load(self):
+        if not self._meta_path.exists():
+            return
+        try:
+            self.dim = int(json.loads(self._meta_path.read_text())["dim"])
+        except (OSError, ValueError, KeyError) as e:
+            LOG.warning("Ignoring unreadable embedding cache at %s: %s", self.dir, e)
+            return
+        n_rows = self._vec_path.stat().st_size // (self.dim * 4) if self._vec_path.exists() else 0
+        if self._idx_path.exists():
+            with open(self._idx_path, "r", encoding="utf-8") as fh:
+                for line in fh:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) != 2 or not parts[1].isdigit():
+                        continue  # torn write from an interrupted run
+                    row = int(parts[1])
+                    if row < n_rows:
+                        self._rows[parts[0]] = row
+        self._remap(n_rows)
+        LOG.info("Embedding cache %s: %d vectors (dim=%d)", self.dir, len(self._rows), self.dim)
+
+    def _remap(self, n_rows: int):
+        self._mm = np.memmap(self._vec_path, dtype=np.float32, mode="r", shape=(n_rows, self.dim)) if n_rows else None
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, List[float]]:
+        out = {}
+        with self._lock:
+            for k in keys:
+                row = self._rows.get(k)
+                if row is not None and self._mm is not None:
+                    out[k] = self._mm[row].tolist()
+        return out
+
+    def put_many(self, keys: Sequence[str], vectors: Sequence[Sequence[float]]):
+        if not keys:
+            return
+        mat = np.asarray(vectors, dtype=np.float32)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with self._lock, file_lock(str(self.dir / ".lock")):
+            if self.dim is None and self._meta_path.exists():
+                self._load()  # another process created the cache since we opened it
+            if self.dim is None:
+                self.dim = int(mat.shape[1])
+                self._meta_path.write_text(json.dumps({"model": self.model_name, "dim": self.dim}))
+            if mat.shape[1] != self.dim:
+                LOG.warning("Embedding dim %d != cached dim %d; not caching", mat.shape[1], self.dim)
+                return
+            row_bytes = self.dim * 4
+            size = self._vec_path.stat().st_size if self._vec_path.exists() else 0
+            start = size // row_bytes
+            with open(self._vec_path, "ab") as fh:
+                if size != start * row_bytes:
+                    fh.truncate(start * row_bytes)  # torn row from an interrupted write
+                fh.write(mat.tobytes())
+            # the index is written after the vectors, so a crash never leaves a row pointing at missing data
+            lines = "".join(f"{k}\t{start + i}\n" for i, k in enumerate(keys))
+            with open(self._idx_path, "a+b") as fh:
+                if fh.tell():
+                    fh.seek(-1, os.SEEK_END)
+                    if fh.read(1) != b"\n":
+                        lines = "\n" + lines  # end the torn line so it stays the only one skipped
+                fh.write(lines.encode("utf-8"))
+            for i, k in enumerate(keys):
+                self._rows[k] = start + i
+            self._remap(start + len(keys))
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps any LangChain embeddings object. Documents are looked up by the same
+    hash data_loader stores as 'chunk_hash'; only misses hit the provider.
+    Queries are never cached.
+    """
+
+    def __init__(self, base: Embeddings, cache: EmbeddingCache):
+        self.base = base
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [_hash_text(t) for t in texts]
+        found = self.cache.get_many(keys)
+
+        # unique misses only: identical chunks are embedded once
+        miss_keys, miss_texts, pending = [], [], set()
+        for k, t in zip(keys, texts):
+            if k not in found and k not in pending:
+                pending.add(k)
+                miss_keys.append(k)
+                miss_texts.append(t)
+
+        self.hits += len(texts) - len(miss_keys)
+        self.misses += len(miss_keys)
+        annotate(cache_hits=len(texts) - len(miss_keys), cache_misses=len(miss_keys))
+        if miss_texts:
+            LOG.info("Embedding %d new chunks (%d cached)", len(miss_texts), len(texts) - len(miss_texts))
+            vectors = self.base.embed_documents(miss_texts)
+            self.cache.put_many(miss_keys, vectors)
+            found.update(zip(miss_keys, (list(v) for v in vectors)))
+        return [found[k] for k in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.base.embed_query(text)
@@ -1,124 +1,270 @@
+"""
+Evaluation harness: answers a test set through the RAG pipeline, then grades it with Ragas.
+
+- Questions come from EVAL_TESTSET (JSON lines: {"question", "ground_truth"}, optional "id").
+- Up to EVAL_CONCURRENCY questions are in flight, started at most EVAL_RPM per minute
+  (each question makes two Groq calls: rephrase + answer); throttled questions back off and retry.
+- The graded contexts are the blocks run_rag_chain actually put into the prompt, so there is
+  no second retrieval and no mismatch with what the answer was based on.
+- The answer cache is bypassed, so every question is answered on its own retrieval.
+- Every answered question is appended to EVAL_ANSWERS and every graded one to EVAL_SCORES as it
+  completes; re-running resumes with the questions that are missing (or failed last time).
+
+    python evaluate.py                        # answer + grade (faithfulness, answer_relevancy)
+    python evaluate.py --no-grade             # answers only (grade later with finish_grading.py)
+    python evaluate.py --fresh --rpm 60       # discard checkpoints, allow 60 questions/minute
+"""
+
 import os
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
 import pandas as pd
-from datasets import Dataset
-from ragas import evaluate
-from ragas.metrics import faithfulness, answer_relevancy
-from langchain_groq import ChatGroq
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from vector_store_handler import get_existing_retriever
-from chain_handler import run_rag_chain
-from ragas.run_config import RunConfig
+from dotenv import load_dotenv
+from vector_store_handler import get_existing_retriever, is_rate_limit
+from chain_handler import arun_rag_chain
+
+load_dotenv()
 
 # --- CONFIGURATION ---
-# 1. Setup Models (Using the verified working model)
-eval_llm = ChatGroq(model="llama-3.3-70b-versatile", temperature=0)
-eval_embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-
-# 2. Define Test Set
-questions = [
-    "What is the projected Real GDP growth for 2025?",
-    "What measures did QCB introduce regarding foreign liabilities?",
-    "What is the target for renewable energy capacity by 2030?",
-]
-
-ground_truths = [
-    "Real GDP growth is projected to improve gradually to 2 percent in 2024-25.",
-    "What was the objective of the recent QCB measures regarding foreign liabilities?",
-    "The target is to expand renewable energy capacity to 4 GW by 2030.",
-]
-
-def safe_extract_text(response):
+EVAL_TESTSET = os.getenv("EVAL_TESTSET", "data/eval/testset.jsonl")
+EVAL_ANSWERS = os.getenv("EVAL_ANSWERS", "eval_answers.jsonl")
+EVAL_SCORES = os.getenv("EVAL_SCORES", "eval_scores.jsonl")
+EVAL_CONCURRENCY = int(os.getenv("EVAL_CONCURRENCY", "8"))
+EVAL_RPM = float(os.getenv("EVAL_RPM", "30"))  # questions started per minute (0 = unlimited)
+EVAL_MAX_RETRIES = int(os.getenv("EVAL_MAX_RETRIES", "5"))
+EVAL_GRADE_WORKERS = int(os.getenv("EVAL_GRADE_WORKERS", "8"))
+EVAL_GRADE_BATCH = int(os.getenv("EVAL_GRADE_BATCH", "20"))  # rows per Ragas call, checkpointed after each
+EVAL_LLM = os.getenv("EVAL_LLM", "llama-3.3-70b-versatile")
+EVAL_EMBEDDINGS = os.getenv("EVAL_EMBEDDINGS", "models/text-embedding-004")
+
+
+def read_jsonl(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    rows = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                pass  # torn last line of an interrupted run
+    return rows
+
+
+def append_jsonl(path: str, record: Dict[str, Any]):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def load_testset(path: str = EVAL_TESTSET) -> List[Dict[str, Any]]:
+    """Test-set rows with a 'key' (their id, else the question) used to match checkpoints."""
+    rows = read_jsonl(path)
+    for r in rows:
+        r["key"] = str(r.get("id") or r["question"])
+    return rows
+
+
+def load_answers(path: str = EVAL_ANSWERS) -> Dict[str, Dict[str, Any]]:
+    """key -> latest checkpointed answer record."""
+    return {r["key"]: r for r in read_jsonl(path)}
+
+
+class RateLimiter:
+    """Spaces call starts at least 60/rpm seconds apart (rpm <= 0: unlimited)."""
+
+    def __init__(self, rpm: float):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def _answer_one(row: Dict[str, Any], retriever, limiter: RateLimiter, sem: asyncio.Semaphore,
+                      max_retries: int = EVAL_MAX_RETRIES) -> Dict[str, Any]:
+    record = {"key": row["key"], "question": row["question"], "ground_truth": row.get("ground_truth", "")}
+    async with sem:
+        t0 = time.perf_counter()
+        for attempt in range(max_retries + 1):
+            await limiter.wait()
+            try:
+                # no answer cache: a near-duplicate question (2024 vs 2025) must not be graded on another's answer
+                result = await arun_rag_chain(row["question"], [], retriever, use_cache=False)
+                record.update(answer=str(result["answer"]), contexts=[str(c) for c in result["contexts"]], error=None)
+                break
+            except Exception as e:
+                if not is_rate_limit(e) or attempt == max_retries:
+                    record.update(answer=None, contexts=[], error=f"{type(e).__name__}: {e}")
+                    break
+                await asyncio.sleep(2 ** attempt * (0.5 + random.random()))
+        record["seconds"] = round(time.perf_counter() - t0, 2)
+    return record
+
+
+async def answer_testset(rows: Sequence[Dict[str, Any]], retriever, answers_path: str = EVAL_ANSWERS,
+                         concurrency: int = EVAL_CONCURRENCY, rpm: float = EVAL_RPM) -> Dict[str, Dict[str, Any]]:
+    """Answers every row not already answered in answers_path; returns key -> record for all rows."""
+    done = {k: r for k, r in load_answers(answers_path).items() if not r.get("error")}
+    todo = [r for r in rows if r["key"] not in done]
+    print(f"🚀 {len(rows)} questions: {len(rows) - len(todo)} already answered, {len(todo)} to go "
+          f"(concurrency {concurrency}, {rpm:g}/min)")
+    limiter, sem = RateLimiter(rpm), asyncio.Semaphore(max(1, concurrency))
+    t0 = time.perf_counter()
+    tasks = [asyncio.ensure_future(_answer_one(r, retriever, limiter, sem)) for r in todo]
+    for i, fut in enumerate(asyncio.as_completed(tasks), 1):
+        record = await fut
+        append_jsonl(answers_path, record)
+        done[record["key"]] = record
+        status = "❌ " + record["error"] if record["error"] else f"{len(record['contexts'])} contexts"
+        print(f"[{i}/{len(todo)}] {record['question'][:70]} ({record['seconds']:.1f}s, {status})")
+    if todo:
+        print(f"Answered {len(todo)} questions in {time.perf_counter() - t0:.1f}s")
+    return {r["key"]: done[r["key"]] for r in rows if r["key"] in done}
+
+
+def _score(value) -> Optional[float]:
+    try:
+        v = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(v) else v
+
+
+def load_scores(path: str = EVAL_SCORES) -> Dict[str, Dict[str, float]]:
+    """key -> {metric: score}, merged over every checkpointed grading pass."""
+    scores: Dict[str, Dict[str, float]] = {}
+    for r in read_jsonl(path):
+        scores.setdefault(r["key"], {}).update({m: v for m, v in r["scores"].items() if v is not None})
+    return scores
+
+
+def grade(records: Sequence[Dict[str, Any]], metrics: Optional[list] = None, scores_path: str = EVAL_SCORES,
+          batch_size: int = EVAL_GRADE_BATCH, workers: int = EVAL_GRADE_WORKERS) -> Dict[str, Dict[str, float]]:
     """
-    Safety function to ensure we NEVER get a Dictionary or Document object.
-    Always returns a clean string.
+    Grades answered records with Ragas in batches, checkpointing each batch to scores_path.
+    Rows that already have every requested metric are skipped; failed (NaN) scores are retried next run.
     """
-    if isinstance(response, str):
-        return response
-    elif isinstance(response, dict):
-        # Common LangChain output keys
-        return response.get('answer') or response.get('result') or response.get('output') or str(response)
-    elif hasattr(response, 'content'):
-        # LangChain AIMessage object
-        return response.content
-    else:
-        return str(response)
-
-def run_evaluation():
-    print("🚀 Starting Evaluation Suite...")
-    
-    # 3. Initialize Retrieval
-    retriever = get_existing_retriever()
-    answers = []
-    contexts = []
-    
-    # 4. Loop through questions
-    for i, q in enumerate(questions):
-        print(f"[{i+1}/{len(questions)}] Asking: {q}")
-        
+    # only the grading phase needs Ragas and the judge models
+    from datasets import Dataset
+    from ragas import evaluate
+    from ragas.metrics import faithfulness, answer_relevancy
+    from ragas.run_config import RunConfig
+    from langchain_groq import ChatGroq
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+    metrics = metrics or [faithfulness, answer_relevancy]
+    names = [m.name for m in metrics]
+    scores = load_scores(scores_path)
+    todo = [r for r in records if r.get("answer") is not None and not all(n in scores.get(r["key"], {}) for n in names)]
+    print(f"\n⚖️  Grading {len(todo)} answers ({', '.join(names)}); {len(records) - len(todo)} already graded or unanswered")
+    if not todo:
+        return scores
+
+    eval_llm = ChatGroq(model=EVAL_LLM, temperature=0)
+    eval_embeddings = GoogleGenerativeAIEmbeddings(model=EVAL_EMBEDDINGS)
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        dataset = Dataset.from_dict({
+            "question": [r["question"] for r in batch],
+            "answer": [r["answer"] for r in batch],
+            "contexts": [r["contexts"] or ["No context retrieved"] for r in batch],
+            "ground_truth": [r["ground_truth"] for r in batch],
+        })
         try:
-            # A. Get Answer
-            raw_response = run_rag_chain(q, [], retriever)
-            clean_answer = safe_extract_text(raw_response)
-            answers.append(clean_answer)
-            
-            # B. Get Context (Re-retrieve to be sure)
-            docs = retriever.invoke(q)
-            # FORCE CONVERSION TO STRING LIST - no Document objects allowed
-            clean_context = [str(doc.page_content) for doc in docs] 
-            contexts.append(clean_context)
-            
+            results = evaluate(
+                dataset=dataset,
+                metrics=metrics,
+                llm=eval_llm,
+                embeddings=eval_embeddings,
+                run_config=RunConfig(max_workers=workers, timeout=60),
+                raise_exceptions=False,
+            )
         except Exception as e:
-            print(f"❌ Error processing question '{q}': {e}")
-            answers.append("Error generating answer")
-            contexts.append(["No context retrieved"])
-
-    # 5. SAFETY SAVE (Save before Eval)
-    # If the code crashes after this, you don't lose your API usage.
-    data = {
-        "question": questions,
-        "answer": answers,
-        "contexts": contexts,
-        "ground_truth": ground_truths
-    }
-    
-    print("\n💾 Saving intermediate results to 'pre_eval_backup.csv'...")
-    df_backup = pd.DataFrame(data)
-    df_backup.to_csv("pre_eval_backup.csv", index=False)
-    
-    # 6. Type Check Verification
-    print("\n🔍 Verifying Data Types...")
-    print(f" - Answer type: {type(answers[0])} (Must be <class 'str'>)")
-    print(f" - Context type: {type(contexts[0])} (Must be <class 'list'>)")
-    print(f" - Context content: {type(contexts[0][0])} (Must be <class 'str'>)")
-    
-    if not isinstance(answers[0], str) or not isinstance(contexts[0][0], str):
-        print("⛔ CRITICAL STOP: Data contains non-string objects. Check 'pre_eval_backup.csv'.")
+            print(f"⚠️ Ragas Grading Error: {e}")
+            print(f"Answers are safe in '{EVAL_ANSWERS}'; re-run to grade the rest.")
+            break
+        frame = results.to_pandas()
+        for r, (_, row) in zip(batch, frame.iterrows()):
+            graded = {n: _score(row.get(n)) for n in names}
+            append_jsonl(scores_path, {"key": r["key"], "scores": graded})
+            scores.setdefault(r["key"], {}).update({n: v for n, v in graded.items() if v is not None})
+        print(f"[{min(start + batch_size, len(todo))}/{len(todo)}] graded")
+    return scores
+
+
+def write_report(records: Sequence[Dict[str, Any]], scores: Dict[str, Dict[str, float]], path: str = "evaluation_report.csv"):
+    rows = []
+    for r in records:
+        row = {"user_input": r["question"], "retrieved_contexts": r.get("contexts") or [],
+               "response": r.get("answer"), "reference": r.get("ground_truth")}
+        row.update(scores.get(r["key"], {}))
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    df.to_csv(path, index=False)
+    print("\n📊 Evaluation Results:")
+    print(df.mean(numeric_only=True).to_string())
+    print(f"✅ Success! Saved to '{path}'")
+
+
+def run_evaluation(testset: str = EVAL_TESTSET, grade_answers: bool = True, concurrency: int = EVAL_CONCURRENCY,
+                   rpm: float = EVAL_RPM, answers_path: str = EVAL_ANSWERS, scores_path: str = EVAL_SCORES):
+    print("🚀 Starting Evaluation Suite...")
+    rows = load_testset(testset)
+    if not rows:
+        print(f"❌ No questions in '{testset}'.")
         return
 
-    # 7. Create Dataset & Evaluate
-    print("\n⚖️  Running Ragas Judge...")
-    dataset = Dataset.from_dict(data)
+    retriever = get_existing_retriever()
+    answered = asyncio.run(answer_testset(rows, retriever, answers_path, concurrency, rpm))
+    records = [answered[r["key"]] for r in rows if r["key"] in answered]
+
+    failed = [r for r in records if r.get("error")]
+    if failed:
+        print(f"⚠️ {len(failed)} questions failed; re-run to retry them.")
 
+    # kept for finish_grading.py users on the old CSV flow
+    pd.DataFrame({
+        "question": [r["question"] for r in records],
+        "answer": [r.get("answer") or "Error generating answer" for r in records],
+        "contexts": [r.get("contexts") or ["No context retrieved"] for r in records],
+        "ground_truth": [r["ground_truth"] for r in records],
+    }).to_csv("pre_eval_backup.csv", index=False)
+
+    if grade_answers:
+        scores = grade([r for r in records if not r.get("error")], scores_path=scores_path)
+        write_report(records, scores)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer and grade the evaluation test set.")
+    parser.add_argument("--testset", default=EVAL_TESTSET, help="JSON lines with question / ground_truth")
+    parser.add_argument("--concurrency", type=int, default=EVAL_CONCURRENCY, help="questions in flight")
+    parser.add_argument("--rpm", type=float, default=EVAL_RPM, help="questions started per minute (0 = unlimited)")
+    parser.add_argument("--no-grade", action="store_true", help="only answer (and checkpoint) the questions")
+    parser.add_argument("--fresh", action="store_true", help="discard the answer and score checkpoints first")
+    args = parser.parse_args(argv)
+    if args.fresh:
+        for path in (EVAL_ANSWERS, EVAL_SCORES):
+            Path(path).unlink(missing_ok=True)
+    run_evaluation(args.testset, grade_answers=not args.no_grade, concurrency=args.concurrency, rpm=args.rpm)
 
-    try:
-        results = evaluate(
-            dataset=dataset,
-            metrics=[faithfulness, answer_relevancy],
-            llm=eval_llm,
-            embeddings=eval_embeddings,
-            run_config=RunConfig(max_workers=1, timeout=60), 
-            raise_exceptions=False
-        )
-        print("\n📊 Evaluation Results:")
-        print(results)
-        
-        final_df = results.to_pandas()
-        final_df.to_csv("evaluation_report.csv", index=False)
-        print("✅ Success! Saved to 'evaluation_report.csv'")
-        
-    except Exception as e:
-        print(f"⚠️ Ragas Grading Error: {e}")
-        print("Your generated answers are safe in 'pre_eval_backup.csv'.")
 
 if __name__ == "__main__":
-    run_evaluation()
\ No newline at end of file
+    main()
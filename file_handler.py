@@ -1,8 +1,8 @@
 # file_handler.py
 import os
-from typing import List
+from typing import Iterator, List
 from langchain_core.documents import Document
-from llama_parser_handler import parse_bytes_to_documents
+from llama_parser_handler import parse_bytes_to_documents, iter_parse_bytes
 
 # Supported Types
 ALLOWED_EXTENSIONS = {".pdf", ".png", ".jpg", ".jpeg", ".txt"}
@@ -23,4 +23,21 @@ def handle_uploaded_file_bytes(file_bytes: bytes, filename: str) -> List[Documen
         return [Document(page_content=text, metadata={"source": filename, "page": 1})]
 
     # For PDFs and Images, use LlamaParse
-    return parse_bytes_to_documents(file_bytes, filename)
\ No newline at end of file
+    return parse_bytes_to_documents(file_bytes, filename)
+
+
+def iter_uploaded_file_bytes(file_bytes: bytes, filename: str) -> Iterator[List[Document]]:
+    """
+    Streaming handle_uploaded_file_bytes: yields page Documents in batches as they are parsed
+    (one batch per page-range shard of a large PDF). Raises if some pages could not be parsed.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+
+    if ext not in ALLOWED_EXTENSIONS:
+        raise ValueError(f"Unsupported file type: {ext}")
+
+    if ext == ".txt":
+        yield handle_uploaded_file_bytes(file_bytes, filename)
+        return
+
+    yield from iter_parse_bytes(file_bytes, filename)
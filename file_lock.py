@@ -0,0 +1,57 @@
+# file_lock.py
+"""
+Cross-process exclusive lock on a lock file, for the on-disk stores that both
+setup_db and the Streamlit server write (embedding cache, BM25 journal, local index).
+
+    with file_lock(os.path.join(directory, ".lock")):
+        ...  # re-read what other processes wrote, then append
+
+Uses fcntl.flock; where that is not available (Windows) it only serializes
+threads of this process, i.e. one writer process is assumed there.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+_THREAD_LOCKS: Dict[str, threading.RLock] = {}
+_DEPTH: Dict[str, int] = {}
+_GUARD = threading.Lock()
+
+
+def _thread_lock(path: str) -> threading.RLock:
+    with _GUARD:
+        lock = _THREAD_LOCKS.get(path)
+        if lock is None:
+            lock = _THREAD_LOCKS[path] = threading.RLock()
+        return lock
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """Holds an exclusive lock on `path` (created if missing) for the duration of the block; re-entrant per thread."""
+    path = os.path.abspath(path)
+    with _thread_lock(path):
+        depth = _DEPTH.get(path, 0)
+        if fcntl is None or depth:
+            _DEPTH[path] = depth + 1
+            try:
+                yield
+            finally:
+                _DEPTH[path] = depth
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a+b") as fh:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            _DEPTH[path] = 1
+            try:
+                yield
+            finally:
+                _DEPTH[path] = 0
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
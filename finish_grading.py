@@ -1,54 +1,44 @@
-import pandas as pd
 import ast
-from datasets import Dataset
-from ragas import evaluate
-from ragas.metrics import faithfulness  # Removed answer_relevancy
-from ragas.run_config import RunConfig
-from langchain_groq import ChatGroq
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+import pandas as pd
 from dotenv import load_dotenv
+from evaluate import EVAL_ANSWERS, EVAL_TESTSET, grade, load_answers, load_testset, write_report
 
 load_dotenv()
 
-eval_llm = ChatGroq(model="llama-3.3-70b-versatile", temperature=0)
-eval_embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
 
-def finish_evaluation():
-    print("📂 Loading saved data from 'pre_eval_backup.csv'...")
-    try:
-        df = pd.read_csv("pre_eval_backup.csv")
-    except FileNotFoundError:
-        print("❌ Error: 'pre_eval_backup.csv' not found.")
-        return
-
-    # Repair Data
+def _records_from_backup(path: str = "pre_eval_backup.csv"):
+    """Answers saved by older runs of evaluate.py (contexts stored as a Python list literal)."""
+    df = pd.read_csv(path)
     df['contexts'] = df['contexts'].apply(ast.literal_eval)
-    
-    # Hardcode Ground Truths (Safety)
-    df['ground_truth'] = [
-        "Real GDP growth is projected to improve gradually to 2 percent in 2024-25.",
-        "QCB introduced measures to reduce banks' net short-term foreign liabilities and non-resident deposits.",
-        "The target is to expand renewable energy capacity to 4 GW by 2030."
-    ]
-
-    dataset = Dataset.from_pandas(df)
-
-    print("⚖️  Running Ragas Judge (Faithfulness Only)...")
-    
+    return [{"key": row.question, "question": row.question, "answer": row.answer, "contexts": row.contexts}
+            for row in df.itertuples()]
+
+
+def finish_evaluation():
+    print(f"📂 Loading saved answers from '{EVAL_ANSWERS}'...")
+    records = [r for r in load_answers().values() if not r.get("error")]
+    if not records:
+        print("   none found, trying 'pre_eval_backup.csv'...")
+        try:
+            records = _records_from_backup()
+        except FileNotFoundError:
+            print("❌ Error: no saved answers. Run `python evaluate.py --no-grade` first.")
+            return
+
+    # Ground truths come from the test set, matched by id / question
+    truths = {}
+    for r in load_testset():
+        truths[r["key"]] = truths[r["question"]] = r.get("ground_truth", "")
+    missing = [r["question"] for r in records if r["key"] not in truths]
+    if missing:
+        print(f"⚠️ {len(missing)} answered questions are not in '{EVAL_TESTSET}' and are skipped.")
+    records = [dict(r, ground_truth=truths[r["key"]]) for r in records if r["key"] in truths]
+
     # Single metric = Fast & Stable
-    results = evaluate(
-        dataset=dataset,
-        metrics=[faithfulness], 
-        llm=eval_llm,
-        embeddings=eval_embeddings,
-        raise_exceptions=False
-    )
-    
-    print("\n📊 Evaluation Results:")
-    print(results)
-    
-    results.to_pandas().to_csv("evaluation_report.csv", index=False)
-    print("✅ Final Report Saved: 'evaluation_report.csv'")
+    from ragas.metrics import faithfulness
+    scores = grade(records, metrics=[faithfulness])
+    write_report(records, scores)
+
 
 if __name__ == "__main__":
-    finish_evaluation()
\ No newline at end of file
+    finish_evaluation()
@@ -0,0 +1,137 @@
+# index_manifest.py
+"""
+Manifest of the files currently indexed in the vector store.
+
+For every file it records path, size, mtime, content hash and the IDs of the
+chunks written for it. setup_db diffs the uploads folder against it so only
+new or changed files are parsed, and stale vectors can be deleted by ID.
+"""
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+MANIFEST_VERSION = 1
+
+
+def file_sha256(path: Path, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class IndexManifest:
+    def __init__(self, path: str, files: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.path = Path(path)
+        self.files: Dict[str, Dict[str, Any]] = files or {}
+
+    @classmethod
+    def load(cls, path: str) -> "IndexManifest":
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+        except FileNotFoundError:
+            return cls(path)
+        if data.get("version") != MANIFEST_VERSION:
+            # unknown layout -> behave as if nothing was indexed
+            return cls(path)
+        return cls(path, data.get("files", {}))
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        payload = {"version": MANIFEST_VERSION, "updated_at": time.time(), "files": self.files}
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                json.dump(payload, fh, indent=1)
+            os.replace(tmp, self.path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def record(self, key: str, path: Path, sha256: str, chunk_ids: List[str]):
+        st = path.stat()
+        self.files[key] = {
+            "path": str(path),
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "sha256": sha256,
+            "chunk_ids": list(chunk_ids),
+            "indexed_at": time.time(),
+        }
+
+    def forget(self, key: str) -> List[str]:
+        """Drops a file and returns the chunk IDs that were indexed for it."""
+        entry = self.files.pop(key, None)
+        return entry.get("chunk_ids", []) if entry else []
+
+    def diff(self, files: Iterable[Path]) -> Tuple[List[Tuple[Path, str]], List[str], List[str]]:
+        """
+        Compares files on disk against the manifest.
+        Returns (to_index as (path, sha256), unchanged keys, removed keys).
+        Size+mtime is checked first so unchanged files are not even hashed.
+        """
+        to_index, unchanged, seen = [], [], set()
+        for p in files:
+            key = p.name
+            seen.add(key)
+            entry = self.files.get(key)
+            st = p.stat()
+            if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+                unchanged.append(key)
+                continue
+            digest = file_sha256(p)
+            if entry and entry["sha256"] == digest:
+                # touched but identical content: just refresh size/mtime
+                self.record(key, p, digest, entry["chunk_ids"])
+                unchanged.append(key)
+                continue
+            to_index.append((p, digest))
+        removed = [k for k in self.files if k not in seen]
+        return to_index, unchanged, removed
+
+
+class IngestCheckpoint:
+    """
+    Append-only journal of chunk IDs committed by the current run.
+    Chunk IDs are content-derived, so after a crash the next run can skip every
+    chunk listed here without re-embedding it. Cleared when a run completes.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def load(self) -> Set[str]:
+        ids = set()
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        ids.update(json.loads(line))
+                    except ValueError:
+                        continue  # torn last line
+        except FileNotFoundError:
+            pass
+        return ids
+
+    def append(self, ids: List[str]):
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as fh:
+                fh.write(json.dumps(ids) + "\n")
+                fh.flush()
+                os.fsync(fh.fileno())
+
+    def clear(self):
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,393 @@
+# ingestion.py
+"""
+Concurrent parse -> chunk -> write for many files.
+
+Parsing (LlamaParse, network-bound) runs in a thread pool; chunking (CPU-bound)
+runs in a process pool so splitting does not hold the GIL. Failures and timeouts
+are isolated per file, and results are yielded in input order.
+
+stream_index() connects that to the vector-store write through a bounded queue:
+chunks are flushed in fixed-size batches as soon as they are ready, so memory
+stays flat however large the corpus is, and every committed batch survives a
+crash later in the run. With a DedupRegistry it also skips files whose content
+is already indexed (before parsing) and chunks whose text is already in the
+collection (before embedding).
+
+The parser is pluggable (parse_fn(file_bytes, filename) -> List[Document]), so a
+local stub that just sleeps can stand in for LlamaParse when measuring speedups
+offline (see benchmarks/bench_ingest.py). A parse_fn may also yield its pages in
+batches (the default does, one batch per page-range shard of a large PDF); each
+batch is chunked as soon as it arrives, while later shards are still parsing.
+"""
+
+import os
+import time
+import queue
+import hashlib
+import logging
+import threading
+import multiprocessing
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
+from langchain_core.documents import Document
+from data_loader import chunk_documents, chunk_id, _hash_text, DEDUP
+from index_manifest import file_sha256
+from tracing import span, bind
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_CHUNK_WORKERS = int(os.getenv("INGEST_CHUNK_WORKERS", str(min(4, os.cpu_count() or 1))))
+INGEST_TIMEOUT = float(os.getenv("INGEST_TIMEOUT", "600"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "4"))
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+ParseFn = Callable[[bytes, str], Union[List[Document], Iterable[List[Document]]]]
+WriteFn = Callable[[List[Document]], None]
+
+
+class BytesSource:
+    """In-memory file (e.g. a Streamlit upload) that quacks like a Path for ingest_files."""
+
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self._data = data
+
+    def read_bytes(self) -> bytes:
+        return self._data
+
+
+def source_sha256(source) -> str:
+    if isinstance(source, BytesSource):
+        return hashlib.sha256(source.read_bytes()).hexdigest()
+    return file_sha256(source)
+
+
+@dataclass
+class FileResult:
+    index: int
+    path: Path
+    chunks: List[Document] = field(default_factory=list)
+    pages: int = 0
+    error: Optional[str] = None
+    seconds: float = 0.0
+    # filled in by stream_index, which releases 'chunks' once they are queued for writing
+    chunk_ids: List[str] = field(default_factory=list)
+    chunk_hashes: List[str] = field(default_factory=list)
+    new_chunks: int = 0
+    # set when a DedupRegistry is used
+    sha256: Optional[str] = None
+    duplicate_of: Optional[str] = None
+    # vectors of the source's previous content that nothing references any more; the caller deletes them
+    replaced_ids: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _default_parse(file_bytes: bytes, filename: str) -> Iterator[List[Document]]:
+    # imported lazily: chunking worker processes never need the parser stack
+    from file_handler import iter_uploaded_file_bytes
+    return iter_uploaded_file_bytes(file_bytes, filename)
+
+
+def page_batches(parsed) -> Iterator[List[Document]]:
+    """A parse_fn result as batches of pages: a plain list is one batch."""
+    if parsed is None:
+        return
+    if isinstance(parsed, list):
+        yield parsed
+    else:
+        yield from parsed
+
+
+def _process_file(index: int, path: Path, parse_fn: ParseFn, chunk_pool: Optional[ProcessPoolExecutor], started: dict) -> FileResult:
+    started[index] = time.monotonic()
+    res = FileResult(index=index, path=path)
+    try:
+        # each batch of pages is chunked while the parser works on the next one
+        chunked = []
+        with span("parse", file=path.name) as s:
+            data = path.read_bytes()
+            for docs in page_batches(parse_fn(data, path.name)):
+                if not docs:
+                    continue
+                res.pages += len(docs)
+                chunked.append(chunk_pool.submit(chunk_documents, docs) if chunk_pool is not None else chunk_documents(docs))
+            s.set(bytes=len(data), pages=res.pages, batches=len(chunked))
+        if not res.pages:
+            res.error = "no documents parsed"
+            return res
+        with span("chunk", file=path.name, pages=res.pages) as s:
+            seen = set()
+            for part in chunked:
+                for c in (part.result() if chunk_pool is not None else part):
+                    # chunk_documents dedupes within a call; repeats across batches are dropped here
+                    if DEDUP and len(chunked) > 1:
+                        if c.metadata["chunk_hash"] in seen:
+                            continue
+                        seen.add(c.metadata["chunk_hash"])
+                    res.chunks.append(c)
+            s.set(chunks=len(res.chunks))
+    except Exception as e:
+        LOG.exception("Failed processing %s: %s", path.name, e)
+        res.error = f"{type(e).__name__}: {e}"
+    finally:
+        res.seconds = time.monotonic() - started[index]
+    return res
+
+
+def ingest_files(files: Sequence[Path], parse_fn: Optional[ParseFn] = None, workers: int = INGEST_WORKERS,
+                 chunk_workers: int = INGEST_CHUNK_WORKERS, timeout: Optional[float] = INGEST_TIMEOUT) -> Iterator[FileResult]:
+    """
+    Parses and chunks files concurrently, yielding one FileResult per file in input order.
+    - workers: parallel parse jobs (threads)
+    - chunk_workers: chunking processes (0 = chunk in the parse thread)
+    - timeout: per-file seconds, counted from when the file starts parsing.
+      A timed-out parse cannot be interrupted; its result is discarded and the file reported as failed.
+    At most 2 * workers files are in flight, so memory stays bounded however many files are passed.
+    """
+    parse_fn = parse_fn or _default_parse
+    files = list(files)
+    total = len(files)
+    if not total:
+        return
+
+    t0 = time.monotonic()
+    started = {}
+    done_count = 0
+    failed = 0
+    # 'spawn' avoids forking a process that already runs parser threads
+    chunk_pool = ProcessPoolExecutor(max_workers=chunk_workers, mp_context=multiprocessing.get_context("spawn")) if chunk_workers > 0 else None
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ingest")
+    process_file = bind(_process_file)  # per-file spans join the caller's trace
+    try:
+        pending = {}
+        next_submit = 0
+        window = 2 * max(1, workers)
+
+        for i in range(total):
+            while next_submit < total and next_submit < i + window:
+                pending[next_submit] = pool.submit(process_file, next_submit, files[next_submit], parse_fn, chunk_pool, started)
+                next_submit += 1
+
+            fut = pending.pop(i)
+            res = None
+            while res is None:
+                done, _ = wait([fut], timeout=0.5, return_when=FIRST_COMPLETED)
+                if done:
+                    res = fut.result()
+                elif timeout and i in started and time.monotonic() - started[i] > timeout:
+                    fut.cancel()
+                    res = FileResult(index=i, path=files[i], error=f"timed out after {timeout:.0f}s", seconds=timeout)
+
+            done_count += 1
+            if res.ok:
+                LOG.info("[%d/%d] %s: %d pages -> %d chunks (%.1fs)", done_count, total, res.path.name, res.pages, len(res.chunks), res.seconds)
+            else:
+                failed += 1
+                LOG.warning("[%d/%d] %s: FAILED (%s)", done_count, total, res.path.name, res.error)
+            yield res
+    finally:
+        # do not block on abandoned (timed-out) parses
+        pool.shutdown(wait=False, cancel_futures=True)
+        if chunk_pool is not None:
+            chunk_pool.shutdown(wait=False, cancel_futures=True)
+        elapsed = time.monotonic() - t0
+        LOG.info("Ingested %d/%d files (%d failed) in %.1fs", done_count - failed, total, failed, elapsed)
+
+
+_STOP = object()
+
+
+class _BatchWriter(threading.Thread):
+    """Single consumer of the batch queue: writes batches and reports files once all their chunks are committed."""
+
+    def __init__(self, write_fn: WriteFn, batches: "queue.Queue", events: "queue.Queue", on_batch_committed: Optional[Callable[[List[str]], None]]):
+        super().__init__(name="ingest-writer", daemon=True)
+        self.write_fn = bind(write_fn)
+        self.batches = batches
+        self.events = events
+        self.on_batch_committed = on_batch_committed
+        self.error: Optional[BaseException] = None
+        self.committed = 0
+
+    def run(self):
+        while True:
+            item = self.batches.get()
+            if item is _STOP:
+                return
+            if self.error is not None:
+                continue  # keep draining so the producer never blocks on a full queue
+            kind, payload = item
+            if kind == "batch":
+                try:
+                    self.write_fn(payload)
+                    self.committed += len(payload)
+                    if self.on_batch_committed:
+                        self.on_batch_committed([chunk_id(d) for d in payload])
+                except BaseException as e:
+                    LOG.exception("Batch write failed: %s", e)
+                    self.error = e
+            else:
+                self.events.put(("committed", payload))
+
+
+def stream_index(sources: Iterable, write_fn: WriteFn, batch_size: int = INGEST_BATCH_SIZE, queue_size: int = INGEST_QUEUE_SIZE,
+                 skip_ids: Optional[Set[str]] = None, on_batch_committed: Optional[Callable[[List[str]], None]] = None,
+                 dedup=None, **ingest_kwargs) -> Iterator[Tuple[str, FileResult]]:
+    """
+    Streaming parse -> chunk -> write pipeline. Yields (event, FileResult) in the caller's thread:
+    - ("duplicate", res): content already indexed as res.duplicate_of; not parsed (needs dedup)
+    - ("parsed", res):    file parsed and chunked, its new chunks are queued for writing
+    - ("failed", res):    parse/chunk failed or timed out (res.error)
+    - ("committed", res): every chunk of the file is in the vector store
+    write_fn(batch) must upsert the batch and raise on failure; it runs on one writer thread.
+    Chunks whose ID is in skip_ids (already committed by an interrupted run) are not written again.
+    dedup (a DedupRegistry) is consulted before parsing (file SHA-256) and before writing (chunk hash);
+    res.chunk_ids then lists the vector IDs the file relies on, which may belong to other files, and
+    res.replaced_ids those of a previous version of the file that are now unreferenced (to be deleted).
+    res.index is always the position in 'sources'.
+    Raises the writer's exception after the pipeline has stopped.
+    """
+    sources = list(sources)
+    if dedup is None:
+        yield from _pipeline(sources, list(range(len(sources))), [None] * len(sources), write_fn, batch_size, queue_size,
+                             skip_ids or set(), on_batch_committed, None, {}, ingest_kwargs)
+        return
+    claimed, positions, shas, early, deferred = _claim_sources(sources, dedup)
+    try:
+        yield from early
+        yield from _pipeline(claimed, positions, shas, write_fn, batch_size, queue_size,
+                             skip_ids or set(), on_batch_committed, dedup, deferred, ingest_kwargs)
+    finally:
+        # release claims of files that never got committed (failure or early stop); committed ones are kept
+        for src, sha in zip(claimed, shas):
+            dedup.abandon(src.name, sha)
+
+
+def _pipeline(sources: List, positions: List[int], shas: List[Optional[str]], write_fn: WriteFn, batch_size: int, queue_size: int,
+              skip_ids: Set[str], on_batch_committed, dedup, deferred: Dict[str, List[FileResult]],
+              ingest_kwargs) -> Iterator[Tuple[str, FileResult]]:
+    batches: "queue.Queue" = queue.Queue(maxsize=max(1, queue_size))
+    events: "queue.Queue" = queue.Queue()
+    writer = _BatchWriter(write_fn, batches, events, on_batch_committed)
+    writer.start()
+
+    def drain():
+        while True:
+            try:
+                event, res = events.get_nowait()
+            except queue.Empty:
+                return
+            if dedup is not None:
+                res.replaced_ids = dedup.commit_file(res.path.name, res.sha256, zip(res.chunk_hashes, res.chunk_ids))
+            yield event, res
+            # copies of this file later in the same run
+            for dup in deferred.pop(res.path.name, []):
+                dup.replaced_ids = dedup.alias(dup.path.name, dup.sha256, res.path.name)
+                dup.chunk_ids = dedup.chunk_ids_for(dup.path.name)
+                yield ("duplicate", dup)
+
+    t0 = time.monotonic()
+    # chunk_hash -> vector ID for text queued earlier in this run (not in the registry yet)
+    queued: Dict[str, str] = {}
+    reused = 0
+    try:
+        buffer: List[Document] = []
+        waiting: List[FileResult] = []
+        for res in ingest_files(sources, **ingest_kwargs):
+            res.sha256 = shas[res.index]
+            res.index = positions[res.index]
+            if writer.error is not None:
+                break
+            if not res.ok:
+                yield ("failed", res)
+                for dup in deferred.pop(res.path.name, []):
+                    dup.error = f"copy of {res.path.name}, which failed"
+                    yield ("failed", dup)
+                continue
+
+            res.chunk_ids = [chunk_id(c) for c in res.chunks]
+            new = res.chunks
+            if dedup is not None:
+                res.chunk_hashes = [c.metadata.get("chunk_hash") or _hash_text(c.page_content) for c in res.chunks]
+                known = dedup.known_chunks(res.chunk_hashes)
+                new = []
+                for i, (c, h) in enumerate(zip(res.chunks, res.chunk_hashes)):
+                    existing = known.get(h) or queued.get(h)
+                    if existing is None:
+                        queued[h] = res.chunk_ids[i]
+                        new.append(c)
+                    elif existing != res.chunk_ids[i]:
+                        res.chunk_ids[i] = existing  # same text already indexed under another file
+                        reused += 1
+            new = [c for c in new if chunk_id(c) not in skip_ids]
+            res.new_chunks = len(new)
+            res.chunks = []  # the queue owns them now
+            yield ("parsed", res)
+
+            for c in new:
+                buffer.append(c)
+                if len(buffer) >= batch_size:
+                    batches.put(("batch", buffer))
+                    buffer = []
+                    for w in waiting:
+                        batches.put(("file", w))
+                    waiting = []
+            # a file is committed once the batch holding its last chunk is written
+            if buffer:
+                waiting.append(res)
+            else:
+                batches.put(("file", res))
+            yield from drain()
+
+        if buffer and writer.error is None:
+            batches.put(("batch", buffer))
+        for w in waiting:
+            batches.put(("file", w))
+    finally:
+        batches.put(_STOP)
+        writer.join()
+    yield from drain()
+
+    LOG.info("Wrote %d chunks in %.1fs (%d duplicate chunks reused)", writer.committed, time.monotonic() - t0, reused)
+    if writer.error is not None:
+        raise writer.error
+
+
+def _claim_sources(sources: List, dedup):
+    """
+    Hashes every source and claims it in the registry. Returns
+    (sources to parse, their positions, their SHA-256, duplicate/failed events,
+     {source name: copies of it later in this run, reported once it is committed}).
+    """
+    keep, positions, shas, events = [], [], [], []
+    deferred: Dict[str, List[FileResult]] = {}
+    in_run: Dict[str, str] = {}
+    for i, src in enumerate(sources):
+        sha = source_sha256(src)
+        if sha in in_run:
+            deferred.setdefault(in_run[sha], []).append(FileResult(index=i, path=src, sha256=sha, duplicate_of=in_run[sha]))
+            continue
+        status, owner = dedup.claim_file(src.name, sha)
+        if status == "claimed":
+            in_run[sha] = src.name
+            keep.append(src)
+            positions.append(i)
+            shas.append(sha)
+            continue
+        res = FileResult(index=i, path=src, sha256=sha, duplicate_of=owner)
+        if status == "indexed":
+            res.replaced_ids = dedup.alias(src.name, sha, owner)
+            res.chunk_ids = dedup.chunk_ids_for(src.name)
+            LOG.info("%s: content already indexed as %s, skipping", src.name, owner)
+            events.append(("duplicate", res))
+        else:
+            res.error = f"being indexed as {owner} by another run"
+            events.append(("failed", res))
+    return keep, positions, shas, events, deferred
@@ -0,0 +1,313 @@
+# job_queue.py
+"""
+Background ingestion jobs for the Streamlit app.
+
+Uploads are spooled to disk and enqueued; worker threads run them through
+ingestion.stream_index (parse -> chunk -> embed -> write) while the script
+thread keeps answering questions. Job state lives in SQLite next to the
+vector store (<persist>_jobs.sqlite), so the sidebar can poll per-file
+progress and several sessions (or processes) can share one queue:
+
+    queued -> parsing -> chunking -> embedding -> done | duplicate | failed
+
+Each running job records the PID of the process working on it. Idle workers
+check every JOB_RECOVER_S and put jobs whose process is gone back to 'queued'
+(jobs without a usable PID after JOB_STALE_S).
+After a job writes new chunks the shared retriever is refreshed, so every
+session searches the new content on its next question.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from ingestion import BytesSource, stream_index, page_batches, _default_parse, INGEST_TIMEOUT
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_S = float(os.getenv("JOB_POLL_S", "0.5"))
+# a running job untouched for this long belongs to a dead process
+JOB_STALE_S = float(os.getenv("JOB_STALE_S", str(2 * INGEST_TIMEOUT)))
+# how often idle workers look for jobs orphaned by a dead process
+JOB_RECOVER_S = float(os.getenv("JOB_RECOVER_S", "30"))
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+QUEUED, PARSING, CHUNKING, EMBEDDING = "queued", "parsing", "chunking", "embedding"
+DONE, DUPLICATE, FAILED = "done", "duplicate", "failed"
+ACTIVE = (QUEUED, PARSING, CHUNKING, EMBEDDING)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    session TEXT,
+    status TEXT NOT NULL,
+    detail TEXT,
+    chunks INTEGER NOT NULL DEFAULT 0,
+    owner INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, id);
+CREATE INDEX IF NOT EXISTS jobs_session ON jobs(session, id);
+"""
+
+
+class JobQueue:
+    def __init__(self, db_path: str, spool_dir: str, workers: int = JOB_WORKERS,
+                 write_fn: Optional[Callable] = None, parse_fn: Optional[Callable] = None,
+                 dedup=None, on_indexed: Optional[Callable[[], Any]] = None):
+        """
+        write_fn: batch writer (default: a shared EmbeddingWriter); parse_fn: parser (default: LlamaParse);
+        dedup: DedupRegistry or None; on_indexed: called after a job wrote new chunks (e.g. refresh_retriever).
+        """
+        self.db_path = db_path
+        self.spool_dir = Path(spool_dir)
+        self.workers = max(1, workers)
+        self.write_fn = write_fn
+        self.parse_fn = parse_fn or _default_parse
+        self.dedup = dedup
+        self.on_indexed = on_indexed
+        self._local = threading.local()
+        self._threads: List[threading.Thread] = []
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._start_lock = threading.Lock()
+        self._recovered_at = 0.0
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        if "owner" not in {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}:
+            conn.execute("ALTER TABLE jobs ADD COLUMN owner INTEGER")  # queues created before owners were recorded
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def _spool_path(self, job_id: int) -> Path:
+        return self.spool_dir / f"{job_id}.bin"
+
+    # --- producer side ---
+    def enqueue(self, name: str, data: bytes, session: Optional[str] = None) -> int:
+        now = time.time()
+        # the row starts as 'spooling' so workers ignore it until the bytes are on disk
+        job_id = self._conn().execute("INSERT INTO jobs (name, session, status, created_at, updated_at) VALUES (?, ?, 'spooling', ?, ?)",
+                                      (name, session, now, now)).lastrowid
+        tmp = self._spool_path(job_id).with_suffix(".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, self._spool_path(job_id))
+        self._set(job_id, QUEUED)
+        self._wake.set()
+        self.start()
+        return job_id
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def jobs(self, ids: Optional[List[int]] = None, session: Optional[str] = None) -> List[Dict[str, Any]]:
+        conn = self._conn()
+        if ids is not None:
+            if not ids:
+                return []
+            marks = ",".join("?" * len(ids))
+            rows = conn.execute(f"SELECT * FROM jobs WHERE id IN ({marks}) ORDER BY id", list(ids)).fetchall()
+        elif session is not None:
+            rows = conn.execute("SELECT * FROM jobs WHERE session = ? ORDER BY id", (session,)).fetchall()
+        else:
+            rows = conn.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        return [dict(r) for r in rows]
+
+    def pending(self) -> int:
+        marks = ",".join("?" * len(ACTIVE))
+        return self._conn().execute(f"SELECT COUNT(*) FROM jobs WHERE status IN ({marks})", ACTIVE).fetchone()[0]
+
+    # --- worker side ---
+    def _set(self, job_id: int, status: str, detail: Optional[str] = None, chunks: Optional[int] = None):
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, detail = COALESCE(?, detail), chunks = COALESCE(?, chunks), updated_at = ? WHERE id = ?",
+            (status, detail, chunks, time.time(), job_id))
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """Atomically moves the oldest queued job to 'parsing' (safe across threads and processes)."""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE status = ? ORDER BY id LIMIT 1", (QUEUED,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = ?, owner = ?, updated_at = ? WHERE id = ?",
+                             (PARSING, os.getpid(), time.time(), row["id"]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return dict(row) if row else None
+
+    def recover(self, stale_after: float = JOB_STALE_S):
+        """Re-queues running jobs whose process has exited (or, without a usable PID, untouched for stale_after seconds)."""
+        self._recovered_at = time.monotonic()
+        marks = ",".join("?" * (len(ACTIVE) - 1))
+        now = time.time()
+        conn = self._conn()
+        rows = conn.execute(f"SELECT id, owner, updated_at FROM jobs WHERE status IN ({marks})", ACTIVE[1:]).fetchall()
+        alive: Dict[int, Optional[bool]] = {}
+        orphaned = []
+        for r in rows:
+            if r["owner"] is not None and r["owner"] not in alive:
+                alive[r["owner"]] = _pid_alive(r["owner"])
+            owner_alive = alive.get(r["owner"]) if r["owner"] is not None else None
+            if owner_alive is False or (owner_alive is None and r["updated_at"] < now - stale_after):
+                orphaned.append(r["id"])
+        n = 0
+        for job_id in orphaned:
+            # the status check skips jobs that finished since the SELECT
+            n += conn.execute(f"UPDATE jobs SET status = ?, owner = NULL, updated_at = ? WHERE id = ? AND status IN ({marks})",
+                              (QUEUED, now, job_id, *ACTIVE[1:])).rowcount
+        conn.execute("UPDATE jobs SET status = ?, detail = 'upload interrupted', updated_at = ? WHERE status = 'spooling' AND updated_at < ?",
+                     (FAILED, now, now - stale_after))
+        if n:
+            LOG.info("Re-queued %d interrupted ingestion jobs", n)
+
+    def _writer(self):
+        with self._start_lock:
+            if self.write_fn is None:
+                from vector_store_handler import EmbeddingWriter, get_vector_store
+                # one writer for all jobs so its adaptive batch size is shared
+                self.write_fn = EmbeddingWriter(vectordb=get_vector_store()).write
+        return self.write_fn
+
+    @staticmethod
+    def _drop_replaced(res) -> bool:
+        """Deletes the vectors of the upload's previous content under the same name; True if any were."""
+        if not res.replaced_ids:
+            return False
+        from vector_store_handler import delete_chunks
+        LOG.info("%s: replacing %d chunks of its previous content", res.path.name, len(res.replaced_ids))
+        return delete_chunks(res.replaced_ids)
+
+    def _run(self, job: Dict[str, Any]):
+        job_id = job["id"]
+        path = self._spool_path(job_id)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            self._set(job_id, FAILED, detail="upload data missing")
+            return
+
+        def parse(file_bytes: bytes, filename: str):
+            # large PDFs arrive shard by shard; ingest_files chunks each batch as it comes
+            pages = 0
+            for docs in page_batches(self.parse_fn(file_bytes, filename)):
+                pages += len(docs)
+                self._set(job_id, PARSING, detail=f"{pages} pages parsed")
+                yield docs
+            self._set(job_id, CHUNKING)
+
+        indexed = requeued = False
+        try:
+            for event, res in stream_index([BytesSource(job["name"], data)], write_fn=self._writer(), dedup=self.dedup,
+                                           parse_fn=parse, workers=1, chunk_workers=0):
+                if event == "parsed":
+                    self._set(job_id, EMBEDDING, chunks=len(res.chunk_ids), detail=f"{res.new_chunks} new chunks")
+                elif event == "committed":
+                    indexed = self._drop_replaced(res) or res.new_chunks > 0
+                    self._set(job_id, DONE, chunks=len(res.chunk_ids))
+                elif event == "duplicate":
+                    indexed = self._drop_replaced(res)
+                    self._set(job_id, DUPLICATE, chunks=len(res.chunk_ids), detail=f"already indexed as {res.duplicate_of}")
+                elif event == "failed" and res.duplicate_of:
+                    # the same content is being indexed by another job: check again shortly
+                    time.sleep(2 * JOB_POLL_S)
+                    self._set(job_id, QUEUED, detail=f"waiting for {res.duplicate_of}")
+                    requeued = True
+                elif event == "failed":
+                    self._set(job_id, FAILED, detail=res.error)
+        except Exception as e:
+            LOG.exception("Ingestion job %d (%s) failed: %s", job_id, job["name"], e)
+            self._set(job_id, FAILED, detail=f"{type(e).__name__}: {e}")
+        finally:
+            if not requeued:
+                path.unlink(missing_ok=True)
+
+        if indexed and self.on_indexed is not None:
+            try:
+                self.on_indexed()
+            except Exception as e:
+                LOG.warning("Post-index hook failed: %s", e)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            job = self._claim()
+            if job is None:
+                if time.monotonic() - self._recovered_at >= JOB_RECOVER_S:
+                    try:
+                        self.recover()
+                    except sqlite3.Error as e:
+                        LOG.warning("Job recovery failed: %s", e)
+                    continue
+                self._wake.wait(JOB_POLL_S)
+                self._wake.clear()
+                continue
+            LOG.info("Job %d: indexing %s", job["id"], job["name"])
+            self._run(job)
+
+    def start(self):
+        with self._start_lock:
+            if self._threads:
+                return
+            self.recover()
+            for i in range(self.workers):
+                t = threading.Thread(target=self._loop, name=f"ingest-job-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+        self._stop.clear()
+
+
+def _pid_alive(pid: int) -> Optional[bool]:
+    """Whether a local process with this PID exists; None where that cannot be checked safely."""
+    if pid == os.getpid():
+        return True
+    if os.name == "nt":
+        return None  # os.kill(pid, 0) would terminate the process on Windows
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # exists but belongs to another user
+    return True
+
+
+_QUEUE: Optional[JobQueue] = None
+_QUEUE_LOCK = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Process-wide queue backed by the vector store's sidecar database; workers start on first use."""
+    global _QUEUE
+    with _QUEUE_LOCK:
+        if _QUEUE is None:
+            from vector_store_handler import sidecar_path
+            from dedup_registry import get_dedup_registry
+            from resources import refresh_retriever
+            _QUEUE = JobQueue(sidecar_path("jobs.sqlite"), sidecar_path("jobs"),
+                              dedup=get_dedup_registry(), on_indexed=refresh_retriever)
+            _QUEUE.start()
+        return _QUEUE
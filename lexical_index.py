@@ -0,0 +1,388 @@
+# lexical_index.py
+"""
+In-process BM25 index over the same chunks as the Chroma collection, plus a
+HybridRetriever that fuses it with vector search by reciprocal rank fusion.
+
+Dense search misses exact-term queries: press release IDs ("PR25/034"),
+acronyms ("QCB"), years and figures. The tokenizer keeps those intact.
+
+Persistence (next to the Chroma directory):
+    <persist>_lexical/snapshot.pkl  -> full index
+    <persist>_lexical/journal.jsonl -> add/remove ops since the snapshot
+Writers append to the journal (incremental); it is folded into a new snapshot
+once it grows large. setup_db and the app both write, so appends and compaction
+hold <persist>_lexical/.lock and first replay what the other process wrote.
+Readers in other processes pick up journal lines on the next query by checking
+the file size.
+
+CLI:
+    python lexical_index.py rebuild   # build from the existing Chroma collection
+    python lexical_index.py stats
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import heapq
+import pickle
+import logging
+import argparse
+import threading
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from data_loader import chunk_id
+from file_lock import file_lock
+
+RRF_K = int(os.getenv("RRF_K", "60"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+# words, numbers ("2.4", "2025", "4%"), and IDs joined by / or - ("pr25/034", "2024-25")
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[./\-][a-z0-9]+)*%?")
+_SPLIT_RE = re.compile(r"[/\-]")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were what which will with "
+    "how why when who does do did".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = []
+    for m in _TOKEN_RE.finditer(text.lower()):
+        t = m.group()
+        if t in _STOPWORDS:
+            continue
+        tokens.append(t)
+        # also index the parts of compound IDs so "PR25" alone still matches "PR25/034"
+        if "/" in t or "-" in t:
+            tokens.extend(p for p in _SPLIT_RE.split(t.rstrip("%")) if p and p not in _STOPWORDS)
+    return tokens
+
+
+class LexicalIndex:
+    COMPACT_RATIO = 0.5  # fold the journal into the snapshot once it holds this many ops per indexed doc
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory
+        self._lock = threading.RLock()
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.lengths: Dict[str, int] = {}
+        self.docs: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        self.total_len = 0
+        self._journal_ops = 0
+        self._journal_offset = 0
+        self._snapshot_mtime = None
+        if directory:
+            self._load()
+
+    # --- persistence ---
+    @property
+    def _snapshot_path(self) -> str:
+        return os.path.join(self.directory, "snapshot.pkl")
+
+    @property
+    def _journal_path(self) -> str:
+        return os.path.join(self.directory, "journal.jsonl")
+
+    def _reset(self):
+        self.postings, self.lengths, self.docs, self.total_len = {}, {}, {}, 0
+        self._journal_ops = 0
+        self._journal_offset = 0
+
+    def _load(self):
+        with self._lock:
+            self._reset()
+            try:
+                with open(self._snapshot_path, "rb") as fh:
+                    data = pickle.load(fh)
+                self.postings, self.lengths, self.docs = data["postings"], data["lengths"], data["docs"]
+                self.total_len = sum(self.lengths.values())
+                self._snapshot_mtime = os.stat(self._snapshot_path).st_mtime_ns
+            except FileNotFoundError:
+                self._snapshot_mtime = None
+            self._replay_journal(reload_on_error=False)
+
+    @property
+    def _lock_path(self) -> str:
+        return os.path.join(self.directory, ".lock")
+
+    def _replay_journal(self, reload_on_error: bool = True):
+        try:
+            with open(self._journal_path, "rb") as fh:
+                fh.seek(self._journal_offset)
+                for line in fh:
+                    if not line.endswith(b"\n"):
+                        break  # a writer is mid-line; pick it up next time
+                    try:
+                        op = json.loads(line)
+                        kind = op["op"]
+                    except (ValueError, KeyError, TypeError) as e:
+                        if reload_on_error:
+                            # our offset no longer falls on a line boundary (e.g. the journal was rewritten)
+                            LOG.warning("Lexical journal out of sync (%s); reloading", e)
+                            self._load()
+                            return
+                        LOG.warning("Skipping unreadable lexical journal line at byte %d: %s", self._journal_offset, e)
+                        self._journal_offset += len(line)
+                        continue
+                    self._journal_offset += len(line)
+                    if kind == "add":
+                        self._add(op["id"], op["text"], op["meta"])
+                    elif kind == "remove":
+                        for i in op["ids"]:
+                            self._remove(i)
+                    self._journal_ops += 1
+        except FileNotFoundError:
+            pass
+
+    def refresh(self):
+        """Cheap staleness check (two stats): reloads or replays what other processes wrote."""
+        if not self.directory:
+            return
+        with self._lock:
+            try:
+                snap = os.stat(self._snapshot_path).st_mtime_ns
+            except FileNotFoundError:
+                snap = None
+            if snap != self._snapshot_mtime:
+                self._load()
+                return
+            try:
+                if os.path.getsize(self._journal_path) > self._journal_offset:
+                    self._replay_journal()
+            except FileNotFoundError:
+                if self._journal_offset:
+                    self._load()
+
+    def _sync(self):
+        """Under the file lock: catch up to the end of the journal and drop a torn tail left by a crashed writer."""
+        self.refresh()
+        try:
+            if os.path.getsize(self._journal_path) > self._journal_offset:
+                with open(self._journal_path, "r+b") as fh:
+                    fh.truncate(self._journal_offset)
+        except FileNotFoundError:
+            pass
+
+    def _append_journal(self, ops: List[Dict[str, Any]]):
+        """Call with both locks held and after _sync(), so the journal ends where this instance has read to."""
+        payload = "".join(json.dumps(op, ensure_ascii=False) + "\n" for op in ops).encode("utf-8")
+        with open(self._journal_path, "ab") as fh:
+            fh.write(payload)
+            self._journal_offset = fh.tell()
+        self._journal_ops += len(ops)
+        if self._journal_ops > max(1000, self.COMPACT_RATIO * len(self.docs)):
+            self._write_snapshot()
+
+    def compact(self):
+        """Writes a fresh snapshot (including what other processes appended) and truncates the journal."""
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, file_lock(self._lock_path):
+            self._sync()
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        tmp = self._snapshot_path + ".tmp"
+        with open(tmp, "wb") as fh:
+            pickle.dump({"postings": self.postings, "lengths": self.lengths, "docs": self.docs}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._snapshot_path)
+        open(self._journal_path, "w").close()
+        self._snapshot_mtime = os.stat(self._snapshot_path).st_mtime_ns
+        self._journal_ops = 0
+        self._journal_offset = 0
+        LOG.info("Lexical index compacted: %d docs, %d terms", len(self.docs), len(self.postings))
+
+    def _write(self, apply: Callable[[], List[Dict[str, Any]]]):
+        """Runs apply() (in-memory change, returns its journal ops) and persists the ops atomically w.r.t. other writers."""
+        if not self.directory:
+            with self._lock:
+                apply()
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, file_lock(self._lock_path):
+            self._sync()
+            ops = apply()
+            if ops:
+                self._append_journal(ops)
+
+    # --- mutation ---
+    def _add(self, cid: str, text: str, meta: Dict[str, Any]):
+        if cid in self.docs:
+            self._remove(cid)
+        tf = Counter(tokenize(text))
+        for term, n in tf.items():
+            self.postings.setdefault(term, {})[cid] = n
+        length = sum(tf.values())
+        self.lengths[cid] = length
+        self.total_len += length
+        self.docs[cid] = (text, meta)
+
+    def _remove(self, cid: str):
+        entry = self.docs.pop(cid, None)
+        if entry is None:
+            return
+        for term in set(tokenize(entry[0])):
+            plist = self.postings.get(term)
+            if plist is not None:
+                plist.pop(cid, None)
+                if not plist:
+                    del self.postings[term]
+        self.total_len -= self.lengths.pop(cid, 0)
+
+    def add_documents(self, documents: List[Document]):
+        def apply():
+            ops = []
+            for d in documents:
+                cid = doc_key(d)
+                self._add(cid, d.page_content, dict(d.metadata))
+                ops.append({"op": "add", "id": cid, "text": d.page_content, "meta": dict(d.metadata)})
+            return ops
+        self._write(apply)
+
+    def remove(self, ids: List[str]):
+        if not ids:
+            return
+        def apply():
+            for cid in ids:
+                self._remove(cid)
+            return [{"op": "remove", "ids": list(ids)}]
+        self._write(apply)
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+                with file_lock(self._lock_path):
+                    self._write_snapshot()
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    # --- search ---
+    def search(self, query: str, k: int = 10, allow: Optional[Callable[[Dict[str, Any]], bool]] = None) -> List[Tuple[str, float]]:
+        """Top-k (chunk_id, BM25 score); allow(metadata) restricts hits, e.g. to a retrieval scope."""
+        with self._lock:
+            n = len(self.docs)
+            if not n:
+                return []
+            avg_len = self.total_len / n
+            scores: Dict[str, float] = {}
+            allowed: Dict[str, bool] = {}
+            for term in set(tokenize(query)):
+                plist = self.postings.get(term)
+                if not plist:
+                    continue
+                idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+                for cid, tf in plist.items():
+                    if allow is not None:
+                        ok = allowed.get(cid)
+                        if ok is None:
+                            ok = allowed[cid] = bool(allow(self.docs[cid][1]))
+                        if not ok:
+                            continue
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[cid] / avg_len)
+                    scores[cid] = scores.get(cid, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+            return heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+
+    def get_document(self, cid: str) -> Optional[Document]:
+        entry = self.docs.get(cid)
+        return Document(page_content=entry[0], metadata=dict(entry[1]), id=cid) if entry else None
+
+
+def doc_key(d: Document) -> str:
+    """Vector-store ID when Chroma returned one, else the deterministic chunk ID."""
+    return d.id or chunk_id(d)
+
+
+def reciprocal_rank_fusion(ranked_lists: List[List[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    scores: Dict[str, float] = {}
+    for ranked in ranked_lists:
+        for rank, cid in enumerate(ranked):
+            scores[cid] = scores.get(cid, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda kv: kv[1], reverse=True)
+
+
+class HybridRetriever(BaseRetriever):
+    """Vector retriever + BM25, fused by reciprocal rank fusion. Drop-in for the Chroma retriever."""
+
+    vector_retriever: BaseRetriever
+    index: Any
+    k: int = 5
+    scope: Any = None  # metadata_index.Scope applied to the BM25 side; the vector side filters in Chroma
+
+    @property
+    def vectorstore(self):
+        return getattr(self.vector_retriever, "vectorstore", None)
+
+    def _fuse(self, query: str, dense: List[Document]) -> List[Document]:
+        self.index.refresh()
+        allow = self.scope.matches if self.scope is not None else None
+        lexical = self.index.search(query, self.k, allow=allow)
+        by_id = {doc_key(d): d for d in dense}
+        fused = reciprocal_rank_fusion([list(by_id), [cid for cid, _ in lexical]])
+        out = []
+        for cid, score in fused[: self.k]:
+            d = by_id.get(cid) or self.index.get_document(cid)
+            if d is not None:
+                out.append(d)
+        return out
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        dense = self.vector_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return self._fuse(query, dense)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager) -> List[Document]:
+        dense = await self.vector_retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+        return self._fuse(query, dense)
+
+
+_INDEXES: Dict[str, LexicalIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_lexical_index(directory: str) -> LexicalIndex:
+    """One instance per directory per process, shared by writers and retrievers."""
+    with _INDEXES_LOCK:
+        if directory not in _INDEXES:
+            _INDEXES[directory] = LexicalIndex(directory)
+        return _INDEXES[directory]
+
+
+def main(argv: Optional[List[str]] = None):
+    from vector_store_handler import get_vector_store, sidecar_path, PERSIST_DIR
+
+    parser = argparse.ArgumentParser(description="Manage the BM25 index stored next to Chroma.")
+    parser.add_argument("cmd", choices=["rebuild", "stats"])
+    parser.add_argument("--persist", default=PERSIST_DIR)
+    args = parser.parse_args(argv)
+
+    index = get_lexical_index(sidecar_path("lexical", args.persist))
+    if args.cmd == "rebuild":
+        collection = get_vector_store(args.persist)._collection
+        os.makedirs(index.directory, exist_ok=True)
+        with index._lock, file_lock(index._lock_path):
+            index.clear()
+            total, offset, page = collection.count(), 0, 1000
+            while offset < total:
+                got = collection.get(include=["documents", "metadatas"], limit=page, offset=offset)
+                docs = [Document(page_content=t or "", metadata=m or {}) for t, m in zip(got["documents"], got["metadatas"])]
+                for cid, d in zip(got["ids"], docs):
+                    index._add(cid, d.page_content, dict(d.metadata))
+                offset += page
+            index._write_snapshot()
+    print(f"{index.directory}: {len(index)} docs, {len(index.postings)} terms")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
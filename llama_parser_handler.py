@@ -1,67 +1,317 @@
 # llama_parser_handler.py
+import io
 import os
+import asyncio
+import time
+import logging
 import tempfile
+import atexit
+import threading
+import weakref
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from dotenv import load_dotenv
-from llama_parse import LlamaParse
 from langchain_core.documents import Document as LangChainDocument
 from multimodal_utils import safe_filename, normalize_markdown
+from parse_cache import cache_key, get_parse_cache
+from tracing import span, bind
 
 load_dotenv()
 
 LLAMA_API_KEY = os.getenv("LLAMA_CLOUD_API_KEY")
-if not LLAMA_API_KEY:
-    raise ValueError("LLAMA_CLOUD_API_KEY is missing!")
+# PDFs longer than this are parsed as page-range shards (0 = always one job per file)
+PARSE_SHARD_PAGES = int(os.getenv("PARSE_SHARD_PAGES", "25"))
+PARSE_SHARD_WORKERS = int(os.getenv("PARSE_SHARD_WORKERS", "4"))
+# extra attempts for shards that failed; successful shards are never re-sent
+PARSE_SHARD_RETRIES = int(os.getenv("PARSE_SHARD_RETRIES", "2"))
 
-def parse_bytes_to_documents(file_bytes: bytes, filename: str) -> List[LangChainDocument]:
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+# Parser settings are part of the parse-cache key: changing any of them re-parses.
+PARSE_SETTINGS = {
+    "result_type": "markdown",
+    # CRITICAL UPDATE: 'parsing_instruction' is deprecated. Use 'user_prompt'.
+    "user_prompt": "Extract all text. For tables, preserve the structure exactly. For charts or graphs, provide a detailed textual description of the trends and data points.",
+    "vendor_multimodal_model_name": "openai-gpt-4o-mini",
+}
+
+# per thread: a LlamaParse client keeps an httpx.AsyncClient that only works on the
+# event loop it was first used on, so threads (shards, ingestion workers) never share one
+_LOCAL = threading.local()
+
+
+class _ThreadParser:
     """
-    Uses LlamaParse to convert PDF/Images into Markdown text.
-    Enabled with Multimodal Vision for charts/graphs.
+    The calling thread's LlamaParse client and the long-lived event loop it runs on
+    (load_data would asyncio.run a new loop per call, leaving the client bound to a closed one).
+    Both are closed when the thread ends, or at exit.
     """
-    safe_name = safe_filename(filename)
-    file_ext = os.path.splitext(filename)[1] or ".pdf"
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-        tmp_file.write(file_bytes)
-        tmp_path = tmp_file.name
+    def __init__(self, parser: Any):
+        self.parser = parser
+        self.loop = asyncio.new_event_loop()
+        weakref.finalize(self, _close_parser, parser, self.loop)
+
 
+def _close_parser(parser: Any, loop: asyncio.AbstractEventLoop):
     try:
+        client = getattr(parser, "_aclient", None)
+        if client is not None:
+            loop.run_until_complete(client.aclose())
+    except Exception as e:
+        LOG.debug("Closing LlamaParse client failed: %s", e)
+    finally:
+        loop.close()
+
+
+def _thread_parser() -> _ThreadParser:
+    """
+    One LlamaParse client per thread, reused for every file that thread parses.
+    llama_parse and the API key are only needed once a file is actually parsed.
+    """
+    state = getattr(_LOCAL, "state", None)
+    if state is None:
+        if not LLAMA_API_KEY:
+            raise ValueError("LLAMA_CLOUD_API_KEY is missing!")
+        from llama_parse import LlamaParse
         # Initialize Parser with VISION capabilities
         parser = LlamaParse(
             api_key=LLAMA_API_KEY,
-            result_type="markdown",
+            result_type=PARSE_SETTINGS["result_type"],
             verbose=True,
             language="en",
-            # CRITICAL UPDATE: 'parsing_instruction' is deprecated. Use 'user_prompt'.
-            user_prompt="Extract all text. For tables, preserve the structure exactly. For charts or graphs, provide a detailed textual description of the trends and data points.",
+            user_prompt=PARSE_SETTINGS["user_prompt"],
             # This forces it to use a Vision model (like GPT-4o) to 'see' charts
             use_vendor_multimodal_model=True,
-            vendor_multimodal_model_name="openai-gpt-4o-mini"
+            vendor_multimodal_model_name=PARSE_SETTINGS["vendor_multimodal_model_name"],
         )
+        state = _LOCAL.state = _ThreadParser(parser)
+    return state
+
 
+def _parse_pages(file_bytes: bytes, filename: str) -> List[Dict[str, Any]]:
+    """Sends the file to LlamaParse and returns normalized markdown per page."""
+    file_ext = os.path.splitext(filename)[1] or ".pdf"
+
+    with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
+        tmp_file.write(file_bytes)
+        tmp_path = tmp_file.name
+
+    try:
         # Execute Parse
-        llama_docs = parser.load_data(tmp_path)
-        
-        langchain_docs = []
+        state = _thread_parser()
+        llama_docs = state.loop.run_until_complete(state.parser.aload_data(tmp_path))
+
+        pages = []
         for i, doc in enumerate(llama_docs):
             content = normalize_markdown(doc.text)
             if not content:
                 continue
-            
-            meta = {
-                "source": safe_name,
-                "page": i + 1,
-                "original_filename": filename
-            }
-            langchain_docs.append(LangChainDocument(page_content=content, metadata=meta))
+            pages.append({"page": i + 1, "content": content})
+        return pages
+
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+Shard = Tuple[int, Optional[int], bytes]  # (first page, last page or None for the whole file, bytes)
+
+
+def split_pdf(file_bytes: bytes, shard_pages: int = PARSE_SHARD_PAGES) -> List[Shard]:
+    """
+    Page ranges of at most shard_pages pages, each as a standalone PDF.
+    Short files, non-PDFs and PDFs pypdf cannot read stay a single whole-file shard.
+    """
+    whole = [(1, None, file_bytes)]
+    if shard_pages <= 0 or not file_bytes.startswith(b"%PDF"):
+        return whole
+    try:
+        from pypdf import PdfReader, PdfWriter
+        reader = PdfReader(io.BytesIO(file_bytes))
+        total = len(reader.pages)
+        if total <= shard_pages:
+            return whole
+        shards = []
+        for start in range(0, total, shard_pages):
+            writer = PdfWriter()
+            for i in range(start, min(start + shard_pages, total)):
+                writer.add_page(reader.pages[i])
+            buf = io.BytesIO()
+            writer.write(buf)
+            shards.append((start + 1, min(start + shard_pages, total), buf.getvalue()))
+        return shards
+    except Exception as e:
+        LOG.warning("Could not split PDF (%s); parsing it as one job", e)
+        return whole
+
+
+def _shard_key(file_bytes: bytes, shard: Shard) -> str:
+    first, last, _ = shard
+    if last is None:
+        return cache_key(file_bytes, PARSE_SETTINGS)
+    # keyed by the source file + page range, so a re-run re-sends only the shards that never completed
+    return cache_key(file_bytes, {**PARSE_SETTINGS, "pages": [first, last]})
+
+
+# shared by every file being parsed, so shard threads (and their clients) outlive a single file
+_SHARD_POOL: Optional[ThreadPoolExecutor] = None
+_SHARD_POOL_SIZE = 0
+_SHARD_POOL_LOCK = threading.Lock()
+
+
+def _shard_pool(workers: int) -> ThreadPoolExecutor:
+    """The process-wide shard pool, with at least `workers` threads (PARSE_SHARD_WORKERS by default)."""
+    global _SHARD_POOL, _SHARD_POOL_SIZE
+    with _SHARD_POOL_LOCK:
+        if _SHARD_POOL is None or _SHARD_POOL_SIZE < workers:
+            if _SHARD_POOL is not None:
+                # running shards finish on the old threads, which then exit and close their clients
+                _SHARD_POOL.shutdown(wait=False)
+            _SHARD_POOL_SIZE = max(workers, PARSE_SHARD_WORKERS, 1)
+            _SHARD_POOL = ThreadPoolExecutor(max_workers=_SHARD_POOL_SIZE, thread_name_prefix="parse-shard")
+        return _SHARD_POOL
+
+
+def shutdown_shard_pool():
+    """Stops the shard threads; each closes its LlamaParse client and event loop as it exits."""
+    global _SHARD_POOL
+    with _SHARD_POOL_LOCK:
+        pool, _SHARD_POOL = _SHARD_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+atexit.register(shutdown_shard_pool)
+
+
+def _parse_shard(parse_fn: Callable[[bytes, str], List[Dict[str, Any]]], shard: Shard, filename: str, attempt: int) -> List[Dict[str, Any]]:
+    first, last, data = shard
+    with span("parse_shard", file=filename, first_page=first, last_page=last, attempt=attempt) as s:
+        pages = parse_fn(data, filename)
+        s.set(pages=len(pages))
+    # shard-relative page numbers -> page numbers in the original file
+    return [{**p, "page": p["page"] + first - 1} for p in pages]
+
+
+def iter_parsed_pages(file_bytes: bytes, filename: str, parse_fn: Optional[Callable[[bytes, str], List[Dict[str, Any]]]] = None,
+                      shard_pages: int = PARSE_SHARD_PAGES, workers: int = PARSE_SHARD_WORKERS,
+                      retries: int = PARSE_SHARD_RETRIES, retry_delay: float = 2.0) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Yields the {"page", "content"} dicts of one shard at a time, as each shard finishes
+    (completion order, absolute page numbers). Up to `workers` shards of the file run at once on
+    the process-wide shard pool (a single shard is parsed on the caller's thread);
+    failed shards are retried up to `retries` times, then RuntimeError names the missing pages.
+    Every completed shard is cached on its own, so pages yielded before a failure are not parsed again.
+    parse_fn(bytes, filename) defaults to LlamaParse; pass a stub to run offline.
+    """
+    parse_fn = parse_fn or _parse_pages
+    cache = get_parse_cache()
+    whole_key = cache_key(file_bytes, PARSE_SETTINGS)
+    pages = cache.get(whole_key) if cache else None
+    if pages is not None:
+        LOG.info("Parse cache hit for %s (%d pages)", filename, len(pages))
+        yield pages
+        return
+
+    pending = []
+    for shard in split_pdf(file_bytes, shard_pages):
+        key = _shard_key(file_bytes, shard)
+        pages = cache.get(key) if cache and key != whole_key else None
+        if pages is not None:
+            yield pages
+        else:
+            pending.append((shard, key))
+    if not pending:
+        return
+    if len(pending) > 1:
+        LOG.info("Parsing %s as %d page-range shards", filename, len(pending))
+
+    limit = max(1, min(workers, len(pending)))
+    parse_one = bind(_parse_shard)
+    for attempt in range(retries + 1):
+        failed = []
+        for shard, key, result in _run_shards(parse_one, parse_fn, pending, filename, attempt, limit):
+            if isinstance(result, Exception):
+                LOG.warning("%s pages %s: parse failed (attempt %d/%d): %s",
+                            filename, _page_range(shard), attempt + 1, retries + 1, result)
+                failed.append((shard, key))
+                continue
+            if cache and result:
+                cache.put(key, result, filename=filename, settings=PARSE_SETTINGS)
+            yield result
+        pending = failed
+        if not pending:
+            return
+        if attempt < retries:
+            time.sleep(retry_delay * (2 ** attempt))
+    raise RuntimeError(f"{filename}: pages {', '.join(_page_range(s) for s, _ in pending)} could not be parsed")
+
+
+def _run_shards(parse_one: Callable, parse_fn: Callable, pending: List[Tuple[Shard, str]], filename: str, attempt: int,
+                limit: int) -> Iterator[Tuple[Shard, str, Any]]:
+    """
+    Yields (shard, key, pages or the exception) in completion order. A single shard (or limit 1)
+    is parsed on the caller's thread; otherwise at most `limit` shards run at once on the shard pool.
+    """
+    if limit == 1:
+        for shard, key in pending:
+            try:
+                yield shard, key, parse_one(parse_fn, shard, filename, attempt)
+            except Exception as e:
+                yield shard, key, e
+        return
+
+    pool = _shard_pool(limit)
+    queued = list(pending)
+    running: Dict[Any, Tuple[Shard, str]] = {}
+    try:
+        while queued or running:
+            while queued and len(running) < limit:
+                shard, key = queued.pop(0)
+                running[pool.submit(parse_one, parse_fn, shard, filename, attempt)] = (shard, key)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                shard, key = running.pop(fut)
+                try:
+                    yield shard, key, fut.result()
+                except Exception as e:
+                    yield shard, key, e
+    finally:
+        # the consumer stopped early: drop shards that have not started
+        for fut in running:
+            fut.cancel()
+
+
+def _page_range(shard: Shard) -> str:
+    first, last, _ = shard
+    return "all" if last is None else f"{first}-{last}"
+
+
+def _to_documents(pages: List[Dict[str, Any]], filename: str) -> List[LangChainDocument]:
+    safe_name = safe_filename(filename)
+    return [LangChainDocument(page_content=p["content"], metadata={"source": safe_name, "page": p["page"], "original_filename": filename})
+            for p in pages]
 
-        return langchain_docs
 
+def iter_parse_bytes(file_bytes: bytes, filename: str, **kwargs) -> Iterator[List[LangChainDocument]]:
+    """Streaming parse_bytes_to_documents: one list of page Documents per completed shard (see iter_parsed_pages)."""
+    for pages in iter_parsed_pages(file_bytes, filename, **kwargs):
+        yield _to_documents(pages, filename)
+
+
+def parse_bytes_to_documents(file_bytes: bytes, filename: str) -> List[LangChainDocument]:
+    """
+    Uses LlamaParse to convert PDF/Images into Markdown text.
+    Enabled with Multimodal Vision for charts/graphs.
+    Results are cached on disk by content hash, so unchanged files are never re-parsed.
+    Large PDFs are parsed as concurrent page-range shards (see iter_parsed_pages).
+    """
+    try:
+        docs = [d for batch in iter_parse_bytes(file_bytes, filename) for d in batch]
+        return sorted(docs, key=lambda d: d.metadata["page"])
     except Exception as e:
         print(f"Error parsing file {filename}: {e}")
         return []
-        
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
\ No newline at end of file
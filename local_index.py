@@ -0,0 +1,700 @@
+# local_index.py
+"""
+Memory-mapped, quantized vector index: an alternative to Chroma for the
+retrieval path (VECTOR_BACKEND=local in vector_store_handler).
+
+Opening the index only maps a few files, so cold start does not depend on
+the corpus size. Vectors are stored as int8 with one float32 scale per
+vector (or float16), about 4x (2x) smaller than float32. Search is an exact,
+block-wise NumPy top-k scan. An optional IVF layer (k-means lists, see
+build_ivf) limits large indexes to the lists closest to the query.
+
+Layout of <persist>/local_index/:
+    meta.json        {"dim", "dtype", "count", "nlist", "generation"}
+    vectors.bin      (count, dim) int8 | float16, row-major, append-only
+    aux.f32          (count, 2) float32: per-vector scale, squared norm
+    live.u8          (count,) 1 while the row is the current version of its ID
+    lists.i32        (count,) IVF list of every row (only after build_ivf)
+    centroids.npy    (nlist, dim) float32 IVF centroids
+    records.sqlite   rows (ID, document, metadata JSON) + ID -> current row
+
+Distances are squared L2 like Chroma's default space, so relevance scores
+(and the rerank thresholds built on them) match the Chroma backend.
+Writers (setup_db, the Streamlit job queue) hold <dir>/.lock while they
+change the files, re-reading meta.json first; readers in any process pick
+up changes through meta.json.
+
+    python local_index.py migrate [--persist DIR] [--dtype int8] [--ivf N]   # N ~ sqrt(vectors)
+    python local_index.py stats | build-ivf --lists N | compact
+"""
+
+import os
+import sys
+import json
+import uuid
+import sqlite3
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from file_lock import file_lock
+
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "int8")
+LOCAL_IVF_NPROBE = int(os.getenv("LOCAL_IVF_NPROBE", "16"))
+LOCAL_SCAN_BLOCK = int(os.getenv("LOCAL_SCAN_BLOCK", "65536"))
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+_DTYPES = {"int8": np.int8, "float16": np.float16}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    row INTEGER PRIMARY KEY,
+    id TEXT NOT NULL,
+    document TEXT,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS ids (
+    id TEXT PRIMARY KEY,
+    row INTEGER NOT NULL
+);
+"""
+
+_OPS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+_MAX_VARS = 900
+_QUERY_GROUP = 64
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    """(stored rows, per-row scale); int8 uses a symmetric per-vector scale, float16 a scale of 1."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float16":
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+    scale = np.abs(vectors).max(axis=1) / 127.0
+    scale[scale == 0] = 1.0
+    return np.rint(vectors / scale[:, None]).astype(np.int8), scale.astype(np.float32)
+
+
+def where_to_sql(where: Dict[str, Any], params: List[Any]) -> str:
+    """Chroma `where` clause -> SQL over the JSON metadata column (json_extract)."""
+    clauses = []
+    for key, cond in where.items():
+        if key in ("$and", "$or"):
+            parts = [where_to_sql(c, params) for c in cond]
+            clauses.append("(" + (" AND " if key == "$and" else " OR ").join(parts) + ")")
+            continue
+        field = "json_extract(r.metadata, ?)"
+        if not isinstance(cond, dict):
+            cond = {"$eq": cond}
+        for op, value in cond.items():
+            params.append(f'$."{key}"')
+            if op in ("$in", "$nin"):
+                values = list(value)
+                if not values:
+                    clauses.append("0" if op == "$in" else "1")
+                    params.pop()
+                    continue
+                params.extend(values)
+                neg = "NOT " if op == "$nin" else ""
+                clauses.append(f"{field} {neg}IN ({','.join('?' * len(values))})")
+            elif op in _OPS:
+                params.append(value)
+                clauses.append(f"{field} {_OPS[op]} ?")
+            else:
+                raise ValueError(f"Unsupported where operator: {op}")
+    return " AND ".join(clauses) or "1"
+
+
+class _State:
+    """Read-only view of the index at one generation (swapped atomically on refresh)."""
+
+    def __init__(self, count: int = 0, generation: int = 0, vectors=None, aux=None, live=None, lists=None, centroids=None):
+        self.count = count
+        self.generation = generation
+        self.vectors = vectors
+        self.aux = aux
+        self.live = live
+        self.lists = lists
+        self.centroids = centroids
+
+
+class LocalIndex:
+    """Storage and search; also implements the subset of the Chroma collection API this repo uses."""
+
+    def __init__(self, directory: str, dtype: str = LOCAL_INDEX_DTYPE):
+        if dtype not in _DTYPES:
+            raise ValueError(f"LOCAL_INDEX_DTYPE must be one of {sorted(_DTYPES)}, got {dtype!r}")
+        self.directory = directory
+        self.default_dtype = dtype
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._meta: Dict[str, Any] = {}
+        self._meta_mtime = None
+        self._state = _State()
+        self._where_cache: Dict[Tuple[str, int], np.ndarray] = {}
+        os.makedirs(directory, exist_ok=True)
+        self._conn().executescript(_SCHEMA)
+        self.refresh()
+
+    # --- files ---
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path("records.sqlite"), timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write_meta(self, **changes):
+        self._where_cache.clear()
+        meta = {**self._meta, **changes, "generation": self._meta.get("generation", 0) + 1}
+        tmp = self._path("meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(meta, fh)
+        os.replace(tmp, self._path("meta.json"))
+        self._meta = meta
+
+    @property
+    def dim(self) -> Optional[int]:
+        return self._meta.get("dim")
+
+    @property
+    def dtype(self) -> str:
+        return self._meta.get("dtype", self.default_dtype)
+
+    def refresh(self):
+        """Re-maps the files if another process (or a write here) changed the index."""
+        try:
+            mtime = os.stat(self._path("meta.json")).st_mtime_ns
+        except FileNotFoundError:
+            self._meta, self._state = {}, _State()
+            return
+        if mtime == self._meta_mtime:
+            return
+        with open(self._path("meta.json"), "r", encoding="utf-8") as fh:
+            self._meta = json.load(fh)
+        self._meta_mtime = mtime
+        count, dim = int(self._meta.get("count", 0)), self._meta.get("dim")
+        if not count or not dim:
+            self._state = _State(generation=self._meta.get("generation", 0))
+            return
+        mm = lambda name, dt, shape: np.memmap(self._path(name), dtype=dt, mode="r", shape=shape)
+        lists = centroids = None
+        if self._meta.get("nlist"):
+            centroids = np.load(self._path("centroids.npy"))
+            lists = mm("lists.i32", np.int32, (count,))
+        self._state = _State(count=count, generation=self._meta["generation"],
+                             vectors=mm("vectors.bin", _DTYPES[self.dtype], (count, dim)),
+                             aux=mm("aux.f32", np.float32, (count, 2)), live=mm("live.u8", np.uint8, (count,)),
+                             lists=lists, centroids=centroids)
+
+    # --- writes ---
+    @contextmanager
+    def _writing(self):
+        """Exclusive across threads and processes; the index is re-read so `count` includes other writers' rows."""
+        with self._lock, file_lock(self._path(".lock")):
+            self._meta_mtime = None
+            self.refresh()
+            yield
+
+    def _truncate_to(self, count: int):
+        """Drops bytes/rows past `count` left behind by an interrupted write."""
+        dim = self.dim or 0
+        itemsize = np.dtype(_DTYPES[self.dtype]).itemsize
+        for name, size in (("vectors.bin", count * dim * itemsize), ("aux.f32", count * 8), ("live.u8", count), ("lists.i32", count * 4)):
+            path = self._path(name)
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, "r+b") as fh:
+                    fh.truncate(size)
+        self._conn().execute("DELETE FROM records WHERE row >= ?", (count,))
+        self._conn().execute("DELETE FROM ids WHERE row >= ?", (count,))
+
+    def _kill_rows(self, rows: List[int]):
+        if not rows:
+            return
+        live = np.memmap(self._path("live.u8"), dtype=np.uint8, mode="r+", shape=(self._meta["count"],))
+        live[np.asarray(rows, dtype=np.int64)] = 0
+        live.flush()
+        del live
+
+    def upsert(self, ids: Sequence[str], embeddings: Sequence[Sequence[float]], documents: Optional[Sequence[str]] = None,
+               metadatas: Optional[Sequence[Optional[Dict[str, Any]]]] = None):
+        if not ids:
+            return
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        documents = documents or [None] * len(ids)
+        metadatas = metadatas or [None] * len(ids)
+        with self._writing():
+            if self.dim is None:
+                self._meta = {"dim": int(vectors.shape[1]), "dtype": self.default_dtype, "count": 0, "nlist": 0,
+                              "generation": self._meta.get("generation", 0)}
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the index ({self.dim})")
+            start = int(self._meta["count"])
+            self._truncate_to(start)
+            rows, scale = quantize(vectors, self.dtype)
+            aux = np.stack([scale, np.einsum("ij,ij->i", vectors, vectors)], axis=1).astype(np.float32)
+            with open(self._path("vectors.bin"), "ab") as fh:
+                fh.write(rows.tobytes())
+            with open(self._path("aux.f32"), "ab") as fh:
+                fh.write(aux.tobytes())
+            with open(self._path("live.u8"), "ab") as fh:
+                fh.write(b"\x01" * len(ids))
+            if self._meta.get("nlist"):
+                with open(self._path("lists.i32"), "ab") as fh:
+                    fh.write(_assign(vectors, self._state.centroids if self._state.centroids is not None
+                                     else np.load(self._path("centroids.npy"))).tobytes())
+
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                new_rows = {}
+                for i, cid in enumerate(ids):
+                    new_rows[cid] = start + i  # last occurrence wins within a batch
+                old = self._rows_for_ids(list(new_rows))
+                conn.executemany("INSERT INTO records (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+                                 [(start + i, cid, doc, json.dumps(meta) if meta else None)
+                                  for i, (cid, doc, meta) in enumerate(zip(ids, documents, metadatas))])
+                conn.executemany("INSERT OR REPLACE INTO ids (id, row) VALUES (?, ?)", list(new_rows.items()))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._write_meta(count=start + len(ids))
+            superseded = [r for r in old.values()] + [start + i for i, cid in enumerate(ids) if new_rows[cid] != start + i]
+            self._kill_rows(superseded)
+            self._meta_mtime = None
+            self.refresh()
+
+    def delete(self, ids: Optional[Sequence[str]] = None, **kwargs):
+        if not ids:
+            return
+        with self._writing():
+            rows = self._rows_for_ids(list(ids))
+            if not rows:
+                return
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for batch in _batches(list(rows)):
+                    conn.execute(f"DELETE FROM ids WHERE id IN ({','.join('?' * len(batch))})", batch)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._kill_rows(list(rows.values()))
+            self._write_meta()
+            self._meta_mtime = None
+            self.refresh()
+
+    def clear(self):
+        with self._writing():
+            conn = self._conn()
+            conn.execute("DELETE FROM records")
+            conn.execute("DELETE FROM ids")
+            for name in ("vectors.bin", "aux.f32", "live.u8", "lists.i32", "centroids.npy"):
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+            self._state = _State()
+            self._meta = {"generation": self._meta.get("generation", 0)}
+            self._write_meta()
+            self._meta_mtime = None
+            self.refresh()
+
+    def _rows_for_ids(self, ids: List[str]) -> Dict[str, int]:
+        found: Dict[str, int] = {}
+        conn = self._conn()
+        for batch in _batches(ids):
+            found.update(conn.execute(f"SELECT id, row FROM ids WHERE id IN ({','.join('?' * len(batch))})", batch).fetchall())
+        return found
+
+    # --- Chroma collection API subset ---
+    def count(self) -> int:
+        self.refresh()
+        return self._conn().execute("SELECT COUNT(*) FROM ids").fetchone()[0]
+
+    def get(self, ids: Optional[Sequence[str]] = None, where: Optional[Dict[str, Any]] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None, include: Iterable[str] = ("documents", "metadatas")) -> Dict[str, Any]:
+        self.refresh()
+        params: List[Any] = []
+        sql = "SELECT r.row, r.id, r.document, r.metadata FROM ids i JOIN records r ON r.row = i.row WHERE r.row < ?"
+        params.append(self._state.count)
+        if ids is not None:
+            ids = list(ids)
+            if not ids:
+                return {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+            sql += f" AND i.id IN ({','.join('?' * len(ids))})"
+            params.extend(ids)
+        if where:
+            sql += " AND " + where_to_sql(where, params)
+        sql += " ORDER BY r.row"
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            params.extend([limit if limit is not None else -1, offset or 0])
+        rows = self._conn().execute(sql, params).fetchall()
+        out: Dict[str, Any] = {"ids": [r[1] for r in rows]}
+        if "documents" in include:
+            out["documents"] = [r[2] for r in rows]
+        if "metadatas" in include:
+            out["metadatas"] = [json.loads(r[3]) if r[3] else None for r in rows]
+        if "embeddings" in include:
+            out["embeddings"] = self.vectors([r[0] for r in rows])
+        return out
+
+    def vectors(self, rows: Sequence[int]) -> np.ndarray:
+        """Dequantized float32 vectors of the given rows."""
+        st = self._state
+        idx = np.asarray(rows, dtype=np.int64)
+        if st.vectors is None or not len(idx):
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return st.vectors[idx].astype(np.float32) * st.aux[idx, 0][:, None]
+
+    # --- search ---
+    def _rows_matching(self, where: Dict[str, Any], st: _State) -> np.ndarray:
+        key = (json.dumps(where, sort_keys=True), st.generation)
+        rows = self._where_cache.get(key)
+        if rows is None:
+            params: List[Any] = [st.count]
+            sql = "SELECT r.row FROM ids i JOIN records r ON r.row = i.row WHERE r.row < ? AND " + where_to_sql(where, params)
+            rows = np.fromiter((r[0] for r in self._conn().execute(sql, params)), dtype=np.int64)
+            rows.sort()
+            if len(self._where_cache) > 64:
+                self._where_cache.clear()
+            self._where_cache[key] = rows
+        return rows
+
+    def _probe(self, query: np.ndarray, st: _State, nprobe: int) -> Optional[np.ndarray]:
+        if st.centroids is None or nprobe <= 0 or nprobe >= len(st.centroids):
+            return None
+        q = query / (np.linalg.norm(query) or 1.0)
+        lists = np.argpartition(-(st.centroids @ q), nprobe - 1)[:nprobe]
+        return np.flatnonzero(np.isin(st.lists, lists))
+
+    def search(self, query: Sequence[float], k: int = 4, where: Optional[Dict[str, Any]] = None,
+               nprobe: int = LOCAL_IVF_NPROBE) -> List[Tuple[int, float]]:
+        """(row, squared L2 distance) of the k nearest live rows, optionally restricted by a Chroma `where` filter."""
+        self.refresh()
+        st = self._state
+        if st.vectors is None or k <= 0:
+            return []
+        q = np.asarray(query, dtype=np.float32)
+        qn = float(q @ q)
+        rows = self._rows_matching(where, st) if where else None
+        probed = self._probe(q, st, nprobe)
+        if probed is not None:
+            rows = probed if rows is None else np.intersect1d(rows, probed, assume_unique=True)
+            if rows is not None and len(rows) < k and where is None:
+                rows = None  # too few candidates near the query: fall back to the exact scan
+
+        best_rows, best_dist = [], []
+        blocks = range(0, st.count, LOCAL_SCAN_BLOCK) if rows is None else range(0, len(rows), LOCAL_SCAN_BLOCK)
+        for start in blocks:
+            if rows is None:
+                idx = np.arange(start, min(start + LOCAL_SCAN_BLOCK, st.count))
+                vec, aux, live = st.vectors[idx[0]:idx[-1] + 1], st.aux[idx[0]:idx[-1] + 1], st.live[idx[0]:idx[-1] + 1]
+            else:
+                idx = rows[start:start + LOCAL_SCAN_BLOCK]
+                vec, aux, live = st.vectors[idx], st.aux[idx], st.live[idx]
+            # einsum reads int8/float16 rows directly, without materializing a float32 copy of the block
+            dots = np.einsum("ij,j->i", vec, q) * aux[:, 0]
+            dist = aux[:, 1] + qn - 2.0 * dots
+            dist[live == 0] = np.inf
+            if len(dist) > k:
+                top = np.argpartition(dist, k - 1)[:k]
+                idx, dist = idx[top], dist[top]
+            best_rows.append(idx)
+            best_dist.append(dist)
+        if not best_rows:
+            return []
+        all_rows, all_dist = np.concatenate(best_rows), np.concatenate(best_dist)
+        order = np.argsort(all_dist, kind="stable")[:k]
+        return [(int(all_rows[i]), float(max(all_dist[i], 0.0))) for i in order if np.isfinite(all_dist[i])]
+
+    def search_many(self, queries: Sequence[Sequence[float]], k: int = 4, where: Optional[Dict[str, Any]] = None,
+                    nprobe: int = LOCAL_IVF_NPROBE) -> List[List[Tuple[int, float]]]:
+        """search() for several queries in one pass over the vectors (each block is read once for all of them)."""
+        self.refresh()
+        st = self._state
+        if st.vectors is None or k <= 0 or not len(queries):
+            return [[] for _ in queries]
+        Q = np.asarray(queries, dtype=np.float32)
+        if st.centroids is not None and 0 < nprobe < len(st.centroids):
+            # every query probes its own lists
+            return [self.search(q, k, where, nprobe) for q in Q]
+        if len(Q) > _QUERY_GROUP:
+            # bounds the (queries x block) distance matrix
+            return [hits for g in range(0, len(Q), _QUERY_GROUP) for hits in self.search_many(Q[g:g + _QUERY_GROUP], k, where, nprobe)]
+        qn = np.einsum("qj,qj->q", Q, Q)
+        rows = self._rows_matching(where, st) if where else None
+
+        best_rows, best_dist = [], []
+        blocks = range(0, st.count, LOCAL_SCAN_BLOCK) if rows is None else range(0, len(rows), LOCAL_SCAN_BLOCK)
+        for start in blocks:
+            if rows is None:
+                idx = np.arange(start, min(start + LOCAL_SCAN_BLOCK, st.count))
+                vec, aux, live = st.vectors[idx[0]:idx[-1] + 1], st.aux[idx[0]:idx[-1] + 1], st.live[idx[0]:idx[-1] + 1]
+            else:
+                idx = rows[start:start + LOCAL_SCAN_BLOCK]
+                vec, aux, live = st.vectors[idx], st.aux[idx], st.live[idx]
+            dots = np.einsum("ij,qj->qi", vec, Q) * aux[:, 0]
+            dist = aux[:, 1] + qn[:, None] - 2.0 * dots
+            dist[:, live == 0] = np.inf
+            if dist.shape[1] > k:
+                top = np.argpartition(dist, k - 1, axis=1)[:, :k]
+                best_rows.append(idx[top])
+                best_dist.append(np.take_along_axis(dist, top, axis=1))
+            else:
+                best_rows.append(np.broadcast_to(idx, dist.shape))
+                best_dist.append(dist)
+        if not best_rows:
+            return [[] for _ in queries]
+        all_rows, all_dist = np.concatenate(best_rows, axis=1), np.concatenate(best_dist, axis=1)
+        order = np.argsort(all_dist, axis=1, kind="stable")[:, :k]
+        return [[(int(all_rows[q, i]), float(max(all_dist[q, i], 0.0))) for i in order[q] if np.isfinite(all_dist[q, i])]
+                for q in range(len(Q))]
+
+    def records(self, rows: Sequence[int]) -> Dict[int, Tuple[str, str, Dict[str, Any]]]:
+        """row -> (id, document, metadata)."""
+        out = {}
+        conn = self._conn()
+        for batch in _batches([int(r) for r in rows]):
+            for row, cid, doc, meta in conn.execute(
+                    f"SELECT row, id, document, metadata FROM records WHERE row IN ({','.join('?' * len(batch))})", batch):
+                out[row] = (cid, doc or "", json.loads(meta) if meta else {})
+        return out
+
+    # --- maintenance ---
+    def build_ivf(self, nlist: int, iters: int = 10, sample: int = 256, seed: int = 0):
+        """Spherical k-means over a sample of the vectors; every row is then assigned to its closest list."""
+        with self._writing():
+            st = self._state
+            if st.vectors is None or st.count < nlist:
+                LOG.warning("Not enough vectors (%d) for %d IVF lists", st.count, nlist)
+                return
+            rng = np.random.default_rng(seed)
+            pick = np.sort(rng.choice(st.count, size=min(st.count, nlist * sample), replace=False))
+            data = _normalize(self.vectors(pick))
+            centroids = data[rng.choice(len(data), size=nlist, replace=False)].copy()
+            for _ in range(iters):
+                assign = _assign(data, centroids)
+                order = np.argsort(assign, kind="stable")
+                counts = np.bincount(assign, minlength=nlist)
+                sums = np.zeros_like(centroids)
+                present = np.flatnonzero(counts)
+                sums[present] = np.add.reduceat(data[order], np.concatenate([[0], np.cumsum(counts)[:-1]])[present])
+                empty = counts == 0
+                sums[empty] = data[rng.choice(len(data), size=int(empty.sum()))]
+                centroids = _normalize(sums)
+            lists = np.empty(st.count, dtype=np.int32)
+            for start in range(0, st.count, LOCAL_SCAN_BLOCK):
+                stop = min(start + LOCAL_SCAN_BLOCK, st.count)
+                lists[start:stop] = _assign(self.vectors(np.arange(start, stop)), centroids)
+            np.save(self._path("centroids.npy"), centroids.astype(np.float32))
+            lists.tofile(self._path("lists.i32"))
+            self._write_meta(nlist=int(nlist))
+            self._meta_mtime = None
+            self.refresh()
+            LOG.info("IVF built: %d lists over %d vectors", nlist, st.count)
+
+    def compact(self):
+        """Rewrites the index without superseded or deleted rows."""
+        with self._writing():
+            st = self._state
+            if st.vectors is None:
+                return
+            conn = self._conn()
+            keep = np.fromiter((r[0] for r in conn.execute("SELECT row FROM ids WHERE row < ? ORDER BY row", (st.count,))), dtype=np.int64)
+            for name, arr in (("vectors.bin", st.vectors), ("aux.f32", st.aux), ("lists.i32", st.lists)):
+                if arr is not None:
+                    np.ascontiguousarray(arr[keep]).tofile(self._path(name + ".tmp"))
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("CREATE TEMP TABLE remap (old INTEGER PRIMARY KEY, new INTEGER)")
+                conn.executemany("INSERT INTO remap VALUES (?, ?)", ((int(o), n) for n, o in enumerate(keep)))
+                conn.execute("DELETE FROM records WHERE row NOT IN (SELECT old FROM remap)")
+                conn.execute("UPDATE records SET row = -1 - (SELECT new FROM remap WHERE old = records.row)")
+                conn.execute("UPDATE records SET row = -1 - row")
+                conn.execute("UPDATE ids SET row = (SELECT new FROM remap WHERE old = ids.row)")
+                conn.execute("DROP TABLE remap")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self._state = _State()
+            for name in ("vectors.bin", "aux.f32", "lists.i32"):
+                if os.path.exists(self._path(name + ".tmp")):
+                    os.replace(self._path(name + ".tmp"), self._path(name))
+            np.ones(len(keep), dtype=np.uint8).tofile(self._path("live.u8"))
+            self._write_meta(count=int(len(keep)))
+            self._meta_mtime = None
+            self.refresh()
+            LOG.info("Compacted local index: %d -> %d rows", st.count, len(keep))
+
+    def stats(self) -> Dict[str, Any]:
+        self.refresh()
+        st = self._state
+        disk = sum(os.path.getsize(self._path(n)) for n in ("vectors.bin", "aux.f32", "live.u8", "lists.i32")
+                   if os.path.exists(self._path(n)))
+        return {"rows": st.count, "live": self.count(), "dim": self.dim, "dtype": self.dtype,
+                "ivf_lists": self._meta.get("nlist", 0), "vector_bytes": disk,
+                "float32_bytes": st.count * (self.dim or 0) * 4}
+
+
+def _batches(items: List[Any], size: int = _MAX_VARS):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return x / norms
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    return np.argmax(_normalize(np.asarray(vectors, dtype=np.float32)) @ centroids.T, axis=1).astype(np.int32)
+
+
+class LocalVectorStore(VectorStore):
+    """LangChain VectorStore over a LocalIndex; drop-in for Chroma in ScoredVectorRetriever."""
+
+    def __init__(self, directory: str, embedding_function: Optional[Embeddings] = None, index: Optional[LocalIndex] = None):
+        self.directory = directory
+        self._embedding_function = embedding_function
+        self._collection = index or get_local_index(directory)
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding_function
+
+    def _select_relevance_score_fn(self):
+        # same conversion langchain_chroma applies to its default l2 space
+        return self._euclidean_relevance_score_fn
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, *, ids: Optional[List[str]] = None,
+                  **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        self._collection.upsert(ids=ids, embeddings=self._embedding_function.embed_documents(texts),
+                                documents=texts, metadatas=metadatas)
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        self._collection.delete(ids=ids)
+        return True
+
+    def delete_collection(self):
+        self._collection.clear()
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        got = self._collection.get(ids=list(ids))
+        return [Document(page_content=t or "", metadata=m or {}, id=i) for i, t, m in zip(got["ids"], got["documents"], got["metadatas"])]
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4, filter: Optional[Dict[str, Any]] = None,
+                                               **kwargs: Any) -> List[Tuple[Document, float]]:
+        hits = self._collection.search(embedding, k=k, where=filter, nprobe=kwargs.get("nprobe", LOCAL_IVF_NPROBE))
+        recs = self._collection.records([row for row, _ in hits])
+        out = []
+        for row, dist in hits:
+            cid, text, meta = recs[row]
+            out.append((Document(page_content=text, metadata=meta, id=cid), dist))
+        return out
+
+    def similarity_search_by_vectors_with_score(self, embeddings: List[List[float]], k: int = 4, filter: Optional[Dict[str, Any]] = None,
+                                                **kwargs: Any) -> List[List[Tuple[Document, float]]]:
+        """similarity_search_by_vector_with_score for several query vectors, scanned together."""
+        hits = self._collection.search_many(embeddings, k=k, where=filter, nprobe=kwargs.get("nprobe", LOCAL_IVF_NPROBE))
+        recs = self._collection.records({row for per_query in hits for row, _ in per_query})
+        out = []
+        for per_query in hits:
+            pairs = []
+            for row, dist in per_query:
+                cid, text, meta = recs[row]
+                pairs.append((Document(page_content=text, metadata=meta, id=cid), dist))
+            out.append(pairs)
+        return out
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None,
+                                     **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding_function.embed_query(query), k, filter, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any) -> List[Document]:
+        return [d for d, _ in self.similarity_search_with_score(query, k, filter, **kwargs)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, filter: Optional[Dict[str, Any]] = None,
+                                    **kwargs: Any) -> List[Document]:
+        return [d for d, _ in self.similarity_search_by_vector_with_score(embedding, k, filter, **kwargs)]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, *,
+                   ids: Optional[List[str]] = None, persist_directory: str = "./persist/local_index", **kwargs: Any) -> "LocalVectorStore":
+        store = cls(persist_directory, embedding_function=embedding)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
+
+
+_INDEXES: Dict[str, LocalIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_local_index(directory: str) -> LocalIndex:
+    """One instance per directory per process, shared by the writer and the retrievers."""
+    directory = os.path.normpath(directory)
+    with _INDEXES_LOCK:
+        if directory not in _INDEXES:
+            _INDEXES[directory] = LocalIndex(directory)
+        return _INDEXES[directory]
+
+
+def migrate(persist_directory: str, collection_name: str, target: LocalIndex, page: int = 1000) -> int:
+    """Copies every vector, document and metadata record of a Chroma collection into the local index."""
+    import chromadb
+    collection = chromadb.PersistentClient(path=persist_directory).get_collection(collection_name)
+    total, offset = collection.count(), 0
+    target.clear()
+    while offset < total:
+        got = collection.get(include=["embeddings", "documents", "metadatas"], limit=page, offset=offset)
+        if not len(got["ids"]):
+            break
+        target.upsert(ids=got["ids"], embeddings=got["embeddings"], documents=got["documents"], metadatas=got["metadatas"])
+        offset += len(got["ids"])
+        LOG.info("Migrated %d/%d vectors", offset, total)
+    return offset
+
+
+def main(argv: Optional[List[str]] = None):
+    from vector_store_handler import PERSIST_DIR, COLLECTION_NAME, local_index_path
+
+    parser = argparse.ArgumentParser(description="Manage the memory-mapped local vector index.")
+    parser.add_argument("cmd", choices=["migrate", "build-ivf", "compact", "stats"])
+    parser.add_argument("--persist", default=PERSIST_DIR, help="Chroma persist directory (the index lives inside it)")
+    parser.add_argument("--dtype", default=LOCAL_INDEX_DTYPE, choices=sorted(_DTYPES), help="storage type for migrate")
+    parser.add_argument("--ivf", "--lists", dest="lists", type=int, default=0, help="IVF lists (0 = exact scan only)")
+    args = parser.parse_args(argv)
+
+    index = LocalIndex(local_index_path(args.persist), dtype=args.dtype)
+    if args.cmd == "migrate":
+        n = migrate(args.persist, COLLECTION_NAME, index)
+        print(f"Migrated {n} vectors from {args.persist} ({COLLECTION_NAME})")
+    if args.cmd in ("migrate", "build-ivf") and args.lists:
+        index.build_ivf(args.lists)
+    if args.cmd == "compact":
+        index.compact()
+    stats = index.stats()
+    ratio = stats["float32_bytes"] / stats["vector_bytes"] if stats["vector_bytes"] else 0
+    print(json.dumps(stats), f"({ratio:.1f}x smaller than float32)" if ratio else "")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,220 @@
+# metadata_index.py
+"""
+Scoped retrieval: restrict a query to some documents, a page range or a section.
+
+Scope.to_where() turns the filters into a Chroma `where` clause, so the vector
+search itself only considers matching chunks; Scope.matches() applies the same
+rules to BM25 hits. Chroma has no prefix operator, so a section prefix is
+resolved to the exact header values through the MetadataIndex.
+
+MetadataIndex is a small in-memory summary of the collection
+(source -> chunk count, pages, section headers) used to list the available
+scopes without scanning the collection on every page load. It is built with
+one metadata-only pass (the collection is opened without an embedding client),
+updated in place by EmbeddingWriter and delete_chunks (a source that lost chunks
+has its pages and sections recomputed), and rebuilt when the index version
+shows that another process changed the data.
+"""
+
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+METADATA_SCAN_PAGE = int(os.getenv("METADATA_SCAN_PAGE", "5000"))
+
+HEADER_KEYS = ("Header 1", "Header 2", "Header 3")
+
+
+@dataclass
+class Scope:
+    sources: Optional[List[str]] = None
+    page_min: Optional[int] = None
+    page_max: Optional[int] = None
+    section: Optional[str] = None  # case-insensitive prefix of any Header 1..3
+
+    def is_empty(self) -> bool:
+        return not self.sources and self.page_min is None and self.page_max is None and not self.section
+
+    def to_where(self, index: Optional["MetadataIndex"] = None) -> Optional[Dict[str, Any]]:
+        conds: List[Dict[str, Any]] = []
+        if self.sources:
+            conds.append({"source": {"$in": list(self.sources)}})
+        if self.page_min is not None:
+            conds.append({"page": {"$gte": int(self.page_min)}})
+        if self.page_max is not None:
+            conds.append({"page": {"$lte": int(self.page_max)}})
+        if self.section:
+            values = index.headers_with_prefix(self.section, self.sources) if index is not None else {}
+            # no known header with that prefix: keep the literal value so nothing matches
+            ors = [{key: {"$in": vals}} for key, vals in values.items() if vals] or [{"Header 1": {"$in": [self.section]}}]
+            conds.append(ors[0] if len(ors) == 1 else {"$or": ors})
+        if not conds:
+            return None
+        return conds[0] if len(conds) == 1 else {"$and": conds}
+
+    def matches(self, metadata: Dict[str, Any]) -> bool:
+        if self.sources and metadata.get("source") not in self.sources:
+            return False
+        if self.page_min is not None or self.page_max is not None:
+            try:
+                page = int(metadata.get("page"))
+            except (TypeError, ValueError):
+                return False
+            if self.page_min is not None and page < self.page_min:
+                return False
+            if self.page_max is not None and page > self.page_max:
+                return False
+        if self.section:
+            prefix = self.section.casefold()
+            if not any(str(metadata.get(k) or "").casefold().startswith(prefix) for k in HEADER_KEYS):
+                return False
+        return True
+
+
+@dataclass
+class SourceInfo:
+    # chunk_id -> (page, Header 1..3); pages and headers are derived from it
+    chunks: Dict[str, Tuple[Optional[int], Tuple[Optional[str], ...]]] = field(default_factory=dict)
+    pages: Set[int] = field(default_factory=set)
+    headers: Dict[str, Set[str]] = field(default_factory=lambda: {k: set() for k in HEADER_KEYS})
+
+    def add(self, cid: str, page: Optional[int], headers: Tuple[Optional[str], ...]):
+        replaced = self.chunks.get(cid)
+        self.chunks[cid] = (page, headers)
+        if replaced is not None and replaced != (page, headers):
+            self.rebuild()
+            return
+        if page is not None:
+            self.pages.add(page)
+        for k, h in zip(HEADER_KEYS, headers):
+            if h:
+                self.headers[k].add(h)
+
+    def rebuild(self):
+        """Recomputes pages and headers from the remaining chunks (after a removal)."""
+        self.pages = {page for page, _ in self.chunks.values() if page is not None}
+        self.headers = {k: {hs[i] for _, hs in self.chunks.values() if hs[i]} for i, k in enumerate(HEADER_KEYS)}
+
+
+class MetadataIndex:
+    def __init__(self, load_fn: Callable[[], List[Tuple[str, Dict[str, Any]]]], version_fn: Callable[[], str]):
+        """load_fn returns (chunk_id, metadata) for every chunk (one scan); version_fn is the collection's index version."""
+        self.load_fn = load_fn
+        self.version_fn = version_fn
+        self._lock = threading.Lock()
+        self._sources: Dict[str, SourceInfo] = {}
+        self._version: Optional[str] = None
+
+    def _add(self, items: List[Tuple[str, Dict[str, Any]]]):
+        for cid, m in items:
+            m = m or {}
+            try:
+                page = int(m.get("page"))
+            except (TypeError, ValueError):
+                page = None
+            info = self._sources.setdefault(m.get("source") or "unknown", SourceInfo())
+            info.add(cid, page, tuple(m.get(k) or None for k in HEADER_KEYS))
+
+    def _ensure_fresh(self):
+        version = self.version_fn()
+        if version == self._version:
+            return
+        try:
+            items = self.load_fn()
+        except Exception as e:
+            LOG.warning("Could not load collection metadata: %s", e)
+            return
+        self._sources = {}
+        self._add(items)
+        self._version = version
+        LOG.info("Metadata index: %d sources, %d chunks", len(self._sources), sum(len(i.chunks) for i in self._sources.values()))
+
+    def note_written(self, items: List[Tuple[str, Dict[str, Any]]], version_before: str, version_after: str):
+        """In-place update after a write, valid only if nothing else changed the collection in between."""
+        with self._lock:
+            if self._version == version_before:
+                self._add(items)
+                self._version = version_after
+
+    def note_removed(self, ids: List[str], version_before: str, version_after: str):
+        with self._lock:
+            if self._version == version_before:
+                gone = set(ids)
+                for src in list(self._sources):
+                    info = self._sources[src]
+                    if gone.isdisjoint(info.chunks):
+                        continue
+                    for cid in gone.intersection(info.chunks):
+                        del info.chunks[cid]
+                    if info.chunks:
+                        info.rebuild()
+                    else:
+                        del self._sources[src]
+                self._version = version_after
+
+    # --- queries ---
+    def sources(self) -> List[str]:
+        with self._lock:
+            self._ensure_fresh()
+            return sorted(self._sources)
+
+    def describe(self) -> Dict[str, Dict[str, Any]]:
+        """source -> {"chunks", "pages": (first, last), "sections": [...]} for listing scopes."""
+        with self._lock:
+            self._ensure_fresh()
+            out = {}
+            for src, info in sorted(self._sources.items()):
+                pages = (min(info.pages), max(info.pages)) if info.pages else None
+                sections = sorted(set().union(*info.headers.values()))
+                out[src] = {"chunks": len(info.chunks), "pages": pages, "sections": sections}
+            return out
+
+    def headers_with_prefix(self, prefix: str, sources: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        p = prefix.casefold()
+        with self._lock:
+            self._ensure_fresh()
+            found: Dict[str, Set[str]] = {k: set() for k in HEADER_KEYS}
+            for src, info in self._sources.items():
+                if sources and src not in sources:
+                    continue
+                for k in HEADER_KEYS:
+                    found[k].update(h for h in info.headers[k] if h.casefold().startswith(p))
+            return {k: sorted(v) for k, v in found.items() if v}
+
+    def chunk_count(self, sources: Optional[List[str]] = None) -> int:
+        with self._lock:
+            self._ensure_fresh()
+            return sum(len(i.chunks) for s, i in self._sources.items() if not sources or s in sources)
+
+
+def scan_metadata(collection, page_size: int = METADATA_SCAN_PAGE) -> List[Tuple[str, Dict[str, Any]]]:
+    """(id, metadata) for every record of a Chroma collection, read in pages without documents or embeddings."""
+    out: List[Tuple[str, Dict[str, Any]]] = []
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        ids = page.get("ids") or []
+        out.extend(zip(ids, page.get("metadatas") or [{}] * len(ids)))
+        if len(ids) < page_size:
+            return out
+        offset += page_size
+
+
+_INDEXES: Dict[str, MetadataIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_metadata_index(persist_directory: Optional[str] = None) -> MetadataIndex:
+    """Metadata index of the given vector store (one per process); the collection is scanned lazily on first use."""
+    from vector_store_handler import PERSIST_DIR, get_collection, index_version
+    persist = os.path.normpath(persist_directory or PERSIST_DIR)
+    with _INDEXES_LOCK:
+        if persist not in _INDEXES:
+            load = lambda: scan_metadata(get_collection(persist)) if os.path.isdir(persist) else []
+            _INDEXES[persist] = MetadataIndex(load_fn=load, version_fn=lambda: index_version(persist))
+        return _INDEXES[persist]
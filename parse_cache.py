@@ -0,0 +1,196 @@
+# parse_cache.py
+"""
+Content-addressed on-disk cache for LlamaParse output.
+
+Entries are keyed by the SHA-256 of the raw file bytes plus the parser settings,
+so the same file is only ever sent to the vision parser once (across setup_db runs
+and Streamlit sessions). Each entry stores the normalized per-page markdown.
+The cache has a size cap; least-recently-used entries are evicted first.
+
+CLI:
+    python parse_cache.py stats
+    python parse_cache.py list
+    python parse_cache.py prune --max-mb 200
+    python parse_cache.py clear
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PARSE_CACHE_DIR = os.getenv("PARSE_CACHE_DIR", "./persist/parse_cache")
+PARSE_CACHE_MAX_MB = int(os.getenv("PARSE_CACHE_MAX_MB", "512"))
+PARSE_CACHE_ENABLED = os.getenv("PARSE_CACHE", "true").lower() in ("1", "true", "yes")
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+
+def cache_key(file_bytes: bytes, settings: Dict[str, Any]) -> str:
+    """sha256(file bytes) + short digest of the parser settings."""
+    content_hash = hashlib.sha256(file_bytes).hexdigest()
+    settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return f"{content_hash}-{settings_hash}"
+
+
+class ParseCache:
+    """
+    One JSON file per entry, sharded by key prefix.
+    LRU is tracked through file mtime (touched on every hit), so several
+    processes can share the directory without a separate index.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.cache_dir = Path(cache_dir or PARSE_CACHE_DIR)
+        self.max_bytes = max_bytes if max_bytes is not None else PARSE_CACHE_MAX_MB * 1024 * 1024
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                entry = json.load(fh)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            LOG.warning("Dropping unreadable parse cache entry %s: %s", path.name, e)
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)  # mark as recently used
+        except OSError:
+            pass
+        return entry.get("pages")
+
+    def put(self, key: str, pages: List[Dict[str, Any]], filename: str = "", settings: Optional[Dict[str, Any]] = None):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        entry = {
+            "key": key,
+            "filename": filename,
+            "settings": settings or {},
+            "created_at": time.time(),
+            "pages": pages,
+        }
+        # write to a temp file first so readers never see a half-written entry
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                json.dump(entry, fh, ensure_ascii=False)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.prune()
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """All entries, oldest (least recently used) first."""
+        if not self.cache_dir.exists():
+            return []
+        out = []
+        for p in self.cache_dir.glob("*/*.json"):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            out.append({"key": p.stem, "path": p, "size": st.st_size, "last_used": st.st_mtime})
+        out.sort(key=lambda e: e["last_used"])
+        return out
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self.entries()
+        return {
+            "dir": str(self.cache_dir),
+            "entries": len(entries),
+            "bytes": sum(e["size"] for e in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+    def prune(self, max_bytes: Optional[int] = None) -> int:
+        """Evicts least-recently-used entries until the cache fits in max_bytes."""
+        cap = self.max_bytes if max_bytes is None else max_bytes
+        with self._lock:
+            entries = self.entries()
+            total = sum(e["size"] for e in entries)
+            evicted = 0
+            for e in entries:
+                if total <= cap:
+                    break
+                self._remove(e["path"])
+                total -= e["size"]
+                evicted += 1
+        if evicted:
+            LOG.info("Parse cache evicted %d entries", evicted)
+        return evicted
+
+    def clear(self) -> int:
+        return self.prune(max_bytes=0)
+
+    @staticmethod
+    def _remove(path: Path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+_CACHE: Optional[ParseCache] = None
+
+
+def get_parse_cache() -> Optional[ParseCache]:
+    """Process-wide cache instance, or None when PARSE_CACHE is disabled."""
+    global _CACHE
+    if not PARSE_CACHE_ENABLED:
+        return None
+    if _CACHE is None:
+        _CACHE = ParseCache()
+    return _CACHE
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Inspect and prune the LlamaParse cache.")
+    parser.add_argument("--dir", default=PARSE_CACHE_DIR, help="cache directory")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("stats", help="show entry count and size")
+    sub.add_parser("list", help="list entries, least recently used first")
+    prune = sub.add_parser("prune", help="evict LRU entries down to a size cap")
+    prune.add_argument("--max-mb", type=float, default=PARSE_CACHE_MAX_MB)
+    sub.add_parser("clear", help="delete every entry")
+    args = parser.parse_args(argv)
+
+    cache = ParseCache(cache_dir=args.dir)
+    if args.cmd == "stats":
+        s = cache.stats()
+        print(f"{s['dir']}: {s['entries']} entries, {s['bytes'] / 2**20:.1f} MB (cap {s['max_bytes'] / 2**20:.0f} MB)")
+    elif args.cmd == "list":
+        for e in cache.entries():
+            try:
+                with open(e["path"], "r", encoding="utf-8") as fh:
+                    entry = json.load(fh)
+            except (OSError, ValueError):
+                entry = {}
+            used = time.strftime("%Y-%m-%d %H:%M", time.localtime(e["last_used"]))
+            print(f"{e['key'][:20]}  {used}  {e['size'] / 1e3:8.1f} KB  {len(entry.get('pages', [])):4d} pages  {entry.get('filename', '')}")
+    elif args.cmd == "prune":
+        n = cache.prune(max_bytes=int(args.max_mb * 1024 * 1024))
+        print(f"Evicted {n} entries")
+    elif args.cmd == "clear":
+        n = cache.clear()
+        print(f"Removed {n} entries")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# rerank_stage.py
+"""
+Cross-encoder rerank stage used by chain_handler in place of
+ContextualCompressionRetriever + FlashrankRerank.
+
+- fetch_k / top_n: at most RERANK_FETCH_K candidates are scored, RERANK_TOP_N are kept.
+  The retriever fetches RERANK_FETCH_K per query too (vector_store_handler.RETRIEVAL_K).
+- Scoring is batched (RERANK_BATCH_SIZE pairs per ONNX call) and only runs for
+  pairs missing from an LRU cache of (normalized query, chunk_hash) -> score.
+- When the vector scores already show a clear winner (top score above
+  RERANK_SKIP_MIN_SCORE and ahead of the runner-up by RERANK_SKIP_MARGIN) the
+  cross-encoder is skipped and relevance_score is the vector score.
+  RERANK_SKIP_MARGIN=0 disables the shortcut.
+- Every call logs its rerank time; stats() aggregates it for tuning fetch_k.
+- rerank_many() reranks the candidates of several queries on RERANK_WORKERS
+  threads (flashrank scores one query per request; ONNX runs outside the GIL).
+"""
+
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from langchain_core.documents import Document
+from data_loader import _hash_text
+from answer_cache import normalize_query
+from tracing import annotate, bind, span
+
+RERANK_FETCH_K = int(os.getenv("RERANK_FETCH_K", "10"))
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "3"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "4096"))
+RERANK_SKIP_MARGIN = float(os.getenv("RERANK_SKIP_MARGIN", "0.15"))
+RERANK_SKIP_MIN_SCORE = float(os.getenv("RERANK_SKIP_MIN_SCORE", "0.8"))
+RERANK_WORKERS = int(os.getenv("RERANK_WORKERS", "4"))
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+
+def _chunk_key(d: Document) -> str:
+    return d.metadata.get("chunk_hash") or _hash_text(d.page_content)
+
+
+class RerankStage:
+    def __init__(self, ranker: Any, fetch_k: int = RERANK_FETCH_K, top_n: int = RERANK_TOP_N,
+                 batch_size: int = RERANK_BATCH_SIZE, cache_size: int = RERANK_CACHE_SIZE,
+                 skip_margin: float = RERANK_SKIP_MARGIN, skip_min_score: float = RERANK_SKIP_MIN_SCORE):
+        """ranker: a flashrank.Ranker (FlashrankRerank.client)."""
+        self.ranker = ranker
+        self.fetch_k = fetch_k
+        self.top_n = top_n
+        self.batch_size = max(1, batch_size)
+        self.cache_size = cache_size
+        self.skip_margin = skip_margin
+        self.skip_min_score = skip_min_score
+        self._lock = threading.Lock()
+        self._scores: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self.metrics = {"queries": 0, "skipped": 0, "scored": 0, "cached": 0, "seconds": 0.0}
+
+    # --- score cache ---
+    def _cached(self, keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], float]:
+        found = {}
+        with self._lock:
+            for k in keys:
+                score = self._scores.get(k)
+                if score is not None:
+                    self._scores.move_to_end(k)
+                    found[k] = score
+        return found
+
+    def _remember(self, scores: Dict[Tuple[str, str], float]):
+        with self._lock:
+            self._scores.update(scores)
+            for k in scores:
+                self._scores.move_to_end(k)
+            while len(self._scores) > self.cache_size:
+                self._scores.popitem(last=False)
+
+    # --- scoring ---
+    def _score(self, query: str, docs: List[Document]) -> List[float]:
+        from flashrank import RerankRequest
+        scores = []
+        for start in range(0, len(docs), self.batch_size):
+            batch = docs[start:start + self.batch_size]
+            passages = [{"id": i, "text": d.page_content} for i, d in enumerate(batch)]
+            results = self.ranker.rerank(RerankRequest(query=query, passages=passages))
+            by_id = {r["id"]: float(r["score"]) for r in results}
+            scores.extend(by_id[i] for i in range(len(batch)))
+        return scores
+
+    def _clear_winner(self, docs: List[Document]) -> Optional[int]:
+        """Index of the candidate whose vector score clearly beats all others, if any."""
+        if self.skip_margin <= 0:
+            return None
+        scored = [(d.metadata["vector_score"], i) for i, d in enumerate(docs) if d.metadata.get("vector_score") is not None]
+        if not scored:
+            return None
+        scored.sort(reverse=True)
+        best, idx = scored[0]
+        runner_up = scored[1][0] if len(scored) > 1 else float("-inf")
+        if best >= self.skip_min_score and best - runner_up >= self.skip_margin:
+            return idx
+        return None
+
+    def rerank(self, query: str, candidates: List[Document]) -> List[Document]:
+        """Top-n of the first fetch_k candidates, best first, with 'relevance_score' in metadata."""
+        t0 = time.perf_counter()
+        docs = list(candidates[: self.fetch_k])
+        if not docs:
+            return []
+
+        winner = self._clear_winner(docs)
+        if winner is not None:
+            ordered = [docs[winner]] + [d for i, d in enumerate(docs) if i != winner]
+            # nothing was scored: the vector score stands in as the relevance score
+            out = [Document(page_content=d.page_content, metadata={**d.metadata, "relevance_score": d.metadata.get("vector_score")}, id=d.id)
+                   for d in ordered[: self.top_n]]
+            self._record(t0, skipped=True)
+            annotate(skipped=True)
+            LOG.info("Rerank skipped: clear vector winner (%.3f) among %d candidates", docs[winner].metadata["vector_score"], len(docs))
+            return out
+
+        qkey = normalize_query(query)
+        keys = [(qkey, _chunk_key(d)) for d in docs]
+        scores = self._cached(keys)
+        missing = [i for i, k in enumerate(keys) if k not in scores]
+        if missing:
+            fresh = self._score(query, [docs[i] for i in missing])
+            new = {keys[i]: s for i, s in zip(missing, fresh)}
+            self._remember(new)
+            scores.update(new)
+
+        ranked = sorted(range(len(docs)), key=lambda i: scores[keys[i]], reverse=True)[: self.top_n]
+        out = [Document(page_content=docs[i].page_content, metadata={**docs[i].metadata, "relevance_score": scores[keys[i]]}, id=docs[i].id)
+               for i in ranked]
+        elapsed = self._record(t0, scored=len(missing), cached=len(docs) - len(missing))
+        annotate(scored=len(missing), cache_hits=len(docs) - len(missing))
+        LOG.info("Rerank: %d candidates (%d cached, %d scored) in %.1fms", len(docs), len(docs) - len(missing), len(missing), 1000 * elapsed)
+        return out
+
+    def rerank_many(self, requests: List[Tuple[str, List[Document]]], workers: int = RERANK_WORKERS) -> List[List[Document]]:
+        """rerank() for several (query, candidates) pairs; results are in request order."""
+        def one(request: Tuple[str, List[Document]]) -> List[Document]:
+            query, candidates = request
+            with span("rerank", candidates=len(candidates)) as s:
+                docs = self.rerank(query, candidates)
+                s.set(kept=len(docs))
+                return docs
+
+        if workers <= 1 or len(requests) <= 1:
+            return [one(r) for r in requests]
+        with ThreadPoolExecutor(max_workers=min(workers, len(requests)), thread_name_prefix="rerank") as pool:
+            return list(pool.map(bind(one), requests))
+
+    def _record(self, t0: float, skipped: bool = False, scored: int = 0, cached: int = 0) -> float:
+        elapsed = time.perf_counter() - t0
+        with self._lock:
+            self.metrics["queries"] += 1
+            self.metrics["skipped"] += int(skipped)
+            self.metrics["scored"] += scored
+            self.metrics["cached"] += cached
+            self.metrics["seconds"] += elapsed
+        return elapsed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            m = dict(self.metrics)
+            m["cache_size"] = len(self._scores)
+        m["avg_ms"] = 1000 * m["seconds"] / m["queries"] if m["queries"] else 0.0
+        pairs = m["scored"] + m["cached"]
+        m["cache_hit_rate"] = m["cached"] / pairs if pairs else 0.0
+        return m
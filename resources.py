@@ -0,0 +1,155 @@
+# resources.py
+"""
+Process-wide registry of expensive, shareable objects:
+the FlashRank reranker (ONNX model) and its rerank stage with score cache,
+ChatGroq clients and the vector retriever.
+
+Each resource is built once per process on first use (thread-safe) and shared by
+every Streamlit session; app.py warms them at startup through st.cache_resource.
+refresh_retriever() swaps the retriever after the index changes.
+"""
+
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable
+from langchain_core.documents import Document
+
+RERANK_MODEL = os.getenv("RERANK_MODEL", "ms-marco-MiniLM-L-12-v2")
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+
+class ResourceRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._items: Dict[str, Any] = {}
+        self._building: Dict[str, threading.Lock] = {}
+
+    def register(self, name: str, factory: Callable[[], Any]):
+        with self._lock:
+            self._factories[name] = factory
+
+    def has(self, name: str) -> bool:
+        return name in self._factories
+
+    def get(self, name: str) -> Any:
+        item = self._items.get(name)
+        if item is not None:
+            return item
+        with self._lock:
+            build_lock = self._building.setdefault(name, threading.Lock())
+        # per-resource lock: loading the reranker does not block an LLM client lookup
+        with build_lock:
+            item = self._items.get(name)
+            if item is None:
+                factory = self._factories.get(name)
+                if factory is None:
+                    raise KeyError(f"No resource registered as {name!r}")
+                t0 = time.perf_counter()
+                item = factory()
+                LOG.info("Built resource %s in %.2fs", name, time.perf_counter() - t0)
+                if item is not None:
+                    self._items[name] = item
+        return item
+
+    def swap(self, name: str, item: Any = None):
+        """Replaces a resource; with item=None it is rebuilt lazily on next get()."""
+        with self._lock:
+            if item is None:
+                self._items.pop(name, None)
+            else:
+                self._items[name] = item
+
+
+REGISTRY = ResourceRegistry()
+
+
+def _build_reranker():
+    from langchain_community.document_compressors import FlashrankRerank
+    return FlashrankRerank(model=RERANK_MODEL)
+
+
+def _build_rerank_stage():
+    from rerank_stage import RerankStage
+    return RerankStage(ranker=get_reranker().client)
+
+
+def _build_retriever():
+    from vector_store_handler import get_existing_retriever
+    return get_existing_retriever()
+
+
+REGISTRY.register("reranker", _build_reranker)
+REGISTRY.register("rerank_stage", _build_rerank_stage)
+REGISTRY.register("retriever", _build_retriever)
+
+
+def get_reranker():
+    return REGISTRY.get("reranker")
+
+
+def get_rerank_stage():
+    """Shared RerankStage: one score cache for every session."""
+    return REGISTRY.get("rerank_stage")
+
+
+def get_llm(model: str):
+    name = f"llm:{model}"
+    if not REGISTRY.has(name):
+        def factory():
+            from langchain_groq import ChatGroq
+            return ChatGroq(model=model)
+        REGISTRY.register(name, factory)
+    return REGISTRY.get(name)
+
+
+def get_retriever():
+    """Shared retriever, or None while no index exists (it is retried on the next call)."""
+    return REGISTRY.get("retriever")
+
+
+def refresh_retriever():
+    """Call after the collection changes: every session picks up the new retriever."""
+    REGISTRY.swap("retriever")
+    return get_retriever()
+
+
+def warm_up(llm_models: Iterable[str] = (), retriever: bool = True) -> Dict[str, float]:
+    """
+    Builds resources ahead of the first question and pushes a dummy query through
+    the reranker so the ONNX session is initialised. LLM clients are only
+    constructed (a dummy generation would cost tokens).
+    """
+    timings = {}
+    t0 = time.perf_counter()
+    try:
+        get_reranker().compress_documents([Document(page_content="warm up")], "warm up")
+        get_rerank_stage()
+    except Exception as e:
+        LOG.warning("Reranker warm-up failed: %s", e)
+    timings["reranker"] = time.perf_counter() - t0
+
+    for model in llm_models:
+        t0 = time.perf_counter()
+        try:
+            get_llm(model)
+        except Exception as e:
+            LOG.warning("LLM client %s failed to build: %s", model, e)
+        timings[f"llm:{model}"] = time.perf_counter() - t0
+
+    if retriever:
+        t0 = time.perf_counter()
+        try:
+            r = get_retriever()
+            if r is not None:
+                r.invoke("warm up")
+        except Exception as e:
+            LOG.warning("Retriever warm-up failed: %s", e)
+        timings["retriever"] = time.perf_counter() - t0
+
+    LOG.info("Warm-up: %s", ", ".join(f"{k}={v:.2f}s" for k, v in timings.items()))
+    return timings
@@ -0,0 +1,300 @@
+# retrieval_eval.py
+"""
+Retrieval-only quality gate: recall@k, hit@k, MRR and nDCG@k of the retriever and
+of the rerank stage over a labelled query set, plus latency percentiles.
+No judge LLM is involved, so it can run on every index or chunking change.
+
+Labels are JSON lines, one query each; a query is relevant to any of its labels:
+
+    {"question": "...", "chunk_hash": "3f2a9c1b7d4e"}                  # exact chunk(s), str or list
+    {"question": "...", "source": "qatar_test_doc.pdf", "page": 12}   # any chunk of that page ("pages": [..] too)
+    {"question": "...", "source": "qatar_test_doc.pdf"}               # any chunk of that document
+    {"question": "...", "relevant": [{"chunk_hash": "..."}, {"source": "...", "page": 3}]}
+
+Each label counts once (a page hit twice is one relevant result), so recall is
+the share of labels found in the top k. Queries run on a thread pool in batches;
+only a 0/1 gain matrix is kept per query, and every metric is computed from it
+with NumPy in one pass. Retrieval and reranking are local, so the only network
+traffic is the query embedding: with a local embedder nothing leaves the machine.
+
+    python retrieval_eval.py labels.jsonl --depth 10 --k 1,3,5,10 --out report.json
+    python retrieval_eval.py labels.jsonl --no-rerank --workers 16
+    python retrieval_eval.py sample labels.jsonl --n 2000     # known-item queries drawn from the collection
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+from langchain_core.documents import Document
+
+RETRIEVAL_EVAL_WORKERS = int(os.getenv("RETRIEVAL_EVAL_WORKERS", "8"))
+RETRIEVAL_EVAL_BATCH = int(os.getenv("RETRIEVAL_EVAL_BATCH", "512"))
+RETRIEVAL_EVAL_KS = os.getenv("RETRIEVAL_EVAL_KS", "1,3,5,10")
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+Label = Tuple[str, ...]  # ("hash", h) | ("page", source, page) | ("source", source)
+
+
+def parse_labels(row: Dict[str, Any]) -> List[Label]:
+    """Normalized labels of one query row (see the module docstring for the accepted shapes)."""
+    out: List[Label] = []
+    items = row.get("relevant")
+    if items is None:
+        items = [row]
+    for item in items if isinstance(items, list) else [items]:
+        if isinstance(item, str):
+            out.append(("hash", item))
+            continue
+        hashes = item.get("chunk_hash")
+        for h in [hashes] if isinstance(hashes, str) else hashes or []:
+            out.append(("hash", str(h)))
+        source = item.get("source")
+        if source and not hashes:
+            pages = item.get("pages") if item.get("pages") is not None else item.get("page")
+            if pages is None:
+                out.append(("source", source))
+            else:
+                for p in pages if isinstance(pages, list) else [pages]:
+                    out.append(("page", source, str(p)))
+    return list(dict.fromkeys(out))
+
+
+def load_queries(path: str) -> List[Dict[str, Any]]:
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            labels = parse_labels(row)
+            if not row.get("question") or not labels:
+                LOG.warning("%s:%d: no question or no relevance label, skipped", path, n)
+                continue
+            queries.append({"question": row["question"], "labels": labels})
+    return queries
+
+
+def gains(docs: Sequence[Document], labels: Sequence[Label]) -> List[int]:
+    """0/1 per retrieved doc: 1 if it matches a label no earlier doc matched."""
+    remaining = set(labels)
+    out = []
+    for d in docs:
+        m = d.metadata or {}
+        h, src, page = m.get("chunk_hash"), m.get("source"), str(m.get("page"))
+        found = next((l for l in (("hash", h), ("page", src, page), ("source", src)) if l in remaining), None)
+        if found is not None:
+            remaining.discard(found)
+        out.append(int(found is not None))
+    return out
+
+
+def retrieval_metrics(gain: np.ndarray, n_labels: np.ndarray, ks: Sequence[int]) -> Dict[str, float]:
+    """recall@k, hit@k, nDCG@k and MRR from a (queries x depth) 0/1 gain matrix and the label count per query."""
+    q, depth = gain.shape
+    if q == 0 or depth == 0:
+        return {}
+    found = np.cumsum(gain, axis=1)
+    discount = 1.0 / np.log2(np.arange(2, max(depth, max(ks)) + 2))
+    ideal = np.concatenate([[0.0], np.cumsum(discount)])  # ideal[n] = DCG of n relevant results at the top
+    labels = np.maximum(n_labels, 1)
+    out: Dict[str, float] = {}
+    for k in ks:
+        kk = min(k, depth)
+        at_k = found[:, kk - 1]
+        dcg = gain[:, :kk] @ discount[:kk]
+        idcg = ideal[np.minimum(n_labels, k)]
+        out[f"recall@{k}"] = float(np.mean(at_k / labels))
+        out[f"hit@{k}"] = float(np.mean(at_k > 0))
+        out[f"ndcg@{k}"] = float(np.mean(np.divide(dcg, idcg, out=np.zeros(q), where=idcg > 0)))
+    first = gain.argmax(axis=1)
+    out["mrr"] = float(np.mean(np.where(gain.any(axis=1), 1.0 / (first + 1), 0.0)))
+    return {k: round(v, 4) for k, v in out.items()}
+
+
+def percentiles(seconds: Sequence[float]) -> Dict[str, float]:
+    if not len(seconds):
+        return {}
+    a = np.asarray(seconds) * 1000
+    p50, p95, p99 = np.percentile(a, [50, 95, 99])
+    return {"p50_ms": round(float(p50), 2), "p95_ms": round(float(p95), 2), "p99_ms": round(float(p99), 2),
+            "mean_ms": round(float(a.mean()), 2)}
+
+
+def with_depth(retriever, k: int):
+    """Copy of the app's retriever returning k results (vector side and hybrid fusion)."""
+    from lexical_index import HybridRetriever
+    if isinstance(retriever, HybridRetriever):
+        return retriever.model_copy(update={"vector_retriever": with_depth(retriever.vector_retriever, k), "k": k})
+    if hasattr(retriever, "search_kwargs"):
+        return retriever.model_copy(update={"search_kwargs": {**retriever.search_kwargs, "k": k}})
+    return retriever
+
+
+def evaluate_retrieval(queries: Sequence[Dict[str, Any]], retriever, rerank: Optional[Callable[[str, List[Document]], List[Document]]] = None,
+                       ks: Sequence[int] = (1, 3, 5, 10), workers: int = RETRIEVAL_EVAL_WORKERS, batch_size: int = RETRIEVAL_EVAL_BATCH,
+                       misses: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    Runs every query through retriever (and rerank(query, docs), e.g. RerankStage.rerank) and scores both stages.
+    queries: {"question", "labels"} as returned by load_queries. Queries whose retrieval raised count as misses.
+    misses, if given, collects the queries with no relevant result after the last stage.
+    Cutoffs deeper than a stage ever returned (e.g. recall@5 after a top-3 rerank) are left out of
+    that stage's metrics and listed under "beyond_depth".
+    """
+    depth = max(ks)
+    stages = ["retrieval"] + (["rerank"] if rerank is not None else [])
+    gain = {s: np.zeros((len(queries), depth), dtype=np.uint8) for s in stages}
+    latency: Dict[str, List[float]] = {s: [] for s in stages}
+    returned = {s: 0 for s in stages}  # most results the stage returned for any query
+    errors = 0
+
+    def run(i: int):
+        q = queries[i]
+        t0 = time.perf_counter()
+        docs = retriever.invoke(q["question"])
+        t1 = time.perf_counter()
+        out = {"retrieval": (docs, t1 - t0)}
+        if rerank is not None:
+            out["rerank"] = (rerank(q["question"], docs) if docs else [], time.perf_counter() - t1)
+        return i, out
+
+    def safe_run(i: int):
+        try:
+            return run(i)
+        except Exception as e:
+            LOG.warning("Query %d failed: %s", i, e)
+            return i, None
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="retrieval-eval") as pool:
+        for start in range(0, len(queries), batch_size):
+            for i, out in pool.map(safe_run, range(start, min(start + batch_size, len(queries)))):
+                if out is None:
+                    errors += 1
+                    continue
+                for s, (docs, seconds) in out.items():
+                    g = gains(docs[:depth], queries[i]["labels"])
+                    gain[s][i, :len(g)] = g
+                    latency[s].append(seconds)
+                    returned[s] = max(returned[s], len(g))
+                if misses is not None and not gain[stages[-1]][i].any():
+                    misses.append({"question": queries[i]["question"], "labels": queries[i]["labels"],
+                                   "retrieved": [{k: d.metadata.get(k) for k in ("source", "page", "chunk_hash")} for d in out[stages[-1]][0]]})
+            LOG.info("%d/%d queries", min(start + batch_size, len(queries)), len(queries))
+    elapsed = time.perf_counter() - t0
+
+    n_labels = np.array([len(q["labels"]) for q in queries])
+    report: Dict[str, Any] = {"queries": len(queries), "errors": errors, "seconds": round(elapsed, 2),
+                              "queries_per_s": round(len(queries) / elapsed, 1) if elapsed else None}
+    for s in stages:
+        within = [k for k in ks if k <= returned[s]]
+        report[s] = {**retrieval_metrics(gain[s][:, :returned[s]].astype(np.float32), n_labels, within),
+                     "depth": returned[s], "latency": percentiles(latency[s])}
+        if len(within) < len(ks):
+            report[s]["beyond_depth"] = [k for k in ks if k > returned[s]]
+    return report
+
+
+def sample_known_items(collection, n: int, words: int = 12, seed: int = 0) -> Iterable[Dict[str, Any]]:
+    """
+    Known-item queries: a random run of `words` words from n random chunks, labelled with that
+    chunk's source and page (labels survive re-chunking) and its chunk_hash.
+    """
+    from metadata_index import scan_metadata, METADATA_SCAN_PAGE
+    rng = random.Random(seed)
+    ids = [cid for cid, _ in scan_metadata(collection)]
+    chosen = rng.sample(ids, min(n, len(ids)))
+    for start in range(0, len(chosen), METADATA_SCAN_PAGE):
+        got = collection.get(ids=chosen[start:start + METADATA_SCAN_PAGE], include=["documents", "metadatas"])
+        for text, meta in zip(got["documents"], got["metadatas"]):
+            meta = meta or {}
+            tokens = (text or "").split()
+            if len(tokens) < words or not meta.get("source"):
+                continue
+            i = rng.randrange(len(tokens) - words + 1)
+            label = {"source": meta["source"]}
+            if meta.get("page") is not None:
+                label["page"] = meta["page"]
+            relevant = [label] + ([{"chunk_hash": meta["chunk_hash"]}] if meta.get("chunk_hash") else [])
+            yield {"question": " ".join(tokens[i:i + words]), "relevant": relevant}
+
+
+def main(argv: Optional[List[str]] = None):
+    from vector_store_handler import PERSIST_DIR, get_existing_retriever, get_vector_store
+
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if argv and argv[0] == "sample":
+        parser = argparse.ArgumentParser(prog="retrieval_eval.py sample", description="Write known-item queries drawn from the collection.")
+        parser.add_argument("out")
+        parser.add_argument("--n", type=int, default=1000)
+        parser.add_argument("--words", type=int, default=12)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--persist", default=PERSIST_DIR)
+        args = parser.parse_args(argv[1:])
+        count = 0
+        with open(args.out, "w", encoding="utf-8") as f:
+            for row in sample_known_items(get_vector_store(args.persist)._collection, args.n, args.words, args.seed):
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                count += 1
+        print(f"Wrote {count} queries to {args.out}")
+        return
+
+    parser = argparse.ArgumentParser(description="Recall@k / MRR / nDCG of retrieval and reranking over labelled queries.")
+    parser.add_argument("labels", help="JSON lines with question + chunk_hash / source / page labels")
+    parser.add_argument("--k", default=RETRIEVAL_EVAL_KS, help="comma-separated cutoffs")
+    parser.add_argument("--depth", type=int, default=0, help="results retrieved per query (default: the largest --k)")
+    parser.add_argument("--no-rerank", action="store_true", help="score the retriever only")
+    parser.add_argument("--workers", type=int, default=RETRIEVAL_EVAL_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=RETRIEVAL_EVAL_BATCH)
+    parser.add_argument("--limit", type=int, default=0, help="only the first N queries")
+    parser.add_argument("--persist", default=PERSIST_DIR)
+    parser.add_argument("--out", help="write the JSON report here (always printed)")
+    parser.add_argument("--misses", help="write queries without any relevant result here (JSON lines)")
+    args = parser.parse_args(argv)
+
+    queries = load_queries(args.labels)
+    if args.limit:
+        queries = queries[: args.limit]
+    if not queries:
+        print(f"No labelled queries in {args.labels}")
+        sys.exit(1)
+    retriever = get_existing_retriever(args.persist)
+    if retriever is None:
+        print(f"No index at {args.persist}; run setup_db.py first")
+        sys.exit(1)
+    ks = sorted({int(k) for k in args.k.split(",") if k.strip()})
+    retriever = with_depth(retriever, args.depth or max(ks))
+
+    rerank = None
+    if not args.no_rerank:
+        from rerank_stage import RerankStage
+        from resources import get_reranker
+        # no score cache: every query pays the real rerank cost
+        rerank = RerankStage(ranker=get_reranker().client, cache_size=0).rerank
+
+    misses: Optional[List[Dict[str, Any]]] = [] if args.misses else None
+    report = evaluate_retrieval(queries, retriever, rerank, ks=ks, workers=args.workers, batch_size=args.batch_size, misses=misses)
+    report["labels"] = args.labels
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    if misses is not None:
+        with open(args.misses, "w", encoding="utf-8") as f:
+            for m in misses:
+                f.write(json.dumps(m, ensure_ascii=False, default=list) + "\n")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    main()
@@ -3,11 +3,18 @@
 Setup script to create (or refresh) the Chroma vector DB from files in data/uploads.
 - Parses files with LlamaParse (Multi-Modal)
 - Chunks documents
-- Indexes into Chroma
+- Indexes into Chroma (streamed in fixed-size batches)
+
+Runs are incremental: a manifest of indexed files (size, mtime, sha256, chunk IDs)
+is kept next to the persist directory, so only new or changed files are parsed and
+vectors of removed/changed files are deleted. Use --full to rebuild from scratch.
+The dedup registry (shared with app.py) skips content that is already indexed
+under another name, and keeps vectors that other files still reference.
 """
 
 import os
 import sys
+import argparse
 from pathlib import Path
 import logging
 from dotenv import load_dotenv
@@ -22,11 +29,11 @@ PERSIST = os.getenv("PERSIST_DIRECTORY", "./persist/chroma_db_prod")
 # Add root to path so local modules import cleanly
 sys.path.insert(0, str(ROOT))
 
-# --- THE FIX IS HERE ---
-# We removed 'save_temp_file' from the import because it no longer exists
-from file_handler import handle_uploaded_file_bytes
-from data_loader import chunk_documents
-from vector_store_handler import create_vector_store_from_documents
+from vector_store_handler import get_vector_store, EmbeddingWriter, delete_chunks, reset_collection, sidecar_path
+from index_manifest import IndexManifest, IngestCheckpoint
+from dedup_registry import get_dedup_registry
+from ingestion import stream_index, INGEST_WORKERS, INGEST_CHUNK_WORKERS, INGEST_TIMEOUT, INGEST_BATCH_SIZE
+from tracing import start_span, use_span
 
 # Logging Setup
 LOG = logging.getLogger("setup_db")
@@ -34,6 +41,8 @@ LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
 ch = logging.StreamHandler()
 ch.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
 LOG.addHandler(ch)
+# per-file progress is reported by the ingestion module
+logging.getLogger("ingestion").addHandler(ch)
 
 
 def gather_files(upload_dir: Path):
@@ -50,32 +59,15 @@ def gather_files(upload_dir: Path):
     return files
 
 
-def parse_and_chunk(file_path: Path):
-    """Reads a file and sends it through the LlamaParse pipeline."""
-    LOG.info("Parsing file: %s", file_path.name)
-    
-    try:
-        # Read file as bytes
-        data = file_path.read_bytes()
-        
-        # Send to file_handler (which sends to LlamaParse)
-        docs = handle_uploaded_file_bytes(data, file_path.name)
-        
-        if not docs:
-            LOG.warning("No parsed docs for %s", file_path.name)
-            return []
-            
-        # Chunk the parsed text
-        chunks = chunk_documents(docs)
-        LOG.info("Produced %d chunks from %s", len(chunks), file_path.name)
-        return chunks
-        
-    except Exception as e:
-        LOG.exception("Failed processing %s: %s", file_path.name, e)
-        return []
-
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index files from the uploads folder into Chroma.")
+    parser.add_argument("--full", action="store_true", help="drop the collection and re-index every file")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="files parsed concurrently (1 = sequential)")
+    parser.add_argument("--chunk-workers", type=int, default=INGEST_CHUNK_WORKERS, help="chunking processes (0 = chunk in-thread)")
+    parser.add_argument("--timeout", type=float, default=INGEST_TIMEOUT, help="per-file parse timeout in seconds")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="chunks embedded and written per batch")
+    args = parser.parse_args(argv)
 
-def main():
     LOG.info("Starting setup_db...")
     
     # 1. Get Files
@@ -83,31 +75,95 @@ def main():
     if not files:
         LOG.error("No files found. Place files in %s and re-run.", UPLOADS)
         sys.exit(1)
-        
-    all_chunks = []
-    
-    # 2. Process Files
-    for f in files:
-        chks = parse_and_chunk(f)
-        all_chunks.extend(chks)
-        
-    LOG.info("Total chunks generated: %d", len(all_chunks))
-    
-    if not all_chunks:
+
+    manifest_path = sidecar_path("manifest.json", PERSIST)
+    if args.full:
+        LOG.info("--full: dropping collection and manifest")
+        reset_collection(PERSIST)
+        manifest = IndexManifest(manifest_path)
+    else:
+        manifest = IndexManifest.load(manifest_path)
+
+    registry = get_dedup_registry(PERSIST)
+
+    def deletable(ids):
+        """Vectors no other file relies on (all of them without a registry)."""
+        return registry.prune(ids) if registry is not None else list(ids)
+
+    # 2. Diff against what is already indexed
+    to_index, unchanged, removed = manifest.diff(files)
+    LOG.info("%d new/changed, %d unchanged, %d removed", len(to_index), len(unchanged), len(removed))
+
+    for key in removed:
+        if registry is not None:
+            registry.release(key)
+        if delete_chunks(deletable(manifest.files[key]["chunk_ids"]), persist_directory=PERSIST):
+            manifest.forget(key)
+
+    if not to_index:
+        manifest.save()
+        LOG.info("✅ Index is up to date: %s", PERSIST)
+        return
+
+    # 3. Stream new/changed files: parse -> chunk -> embed -> write in fixed-size batches.
+    #    Committed batches are journaled, so an interrupted run resumes where it stopped.
+    checkpoint = IngestCheckpoint(sidecar_path("checkpoint.jsonl", PERSIST))
+    if args.full:
+        checkpoint.clear()
+    skip_ids = checkpoint.load()
+    if skip_ids:
+        LOG.info("Resuming: %d chunks already committed by a previous run", len(skip_ids))
+
+    # one writer for the whole run so its adaptive batch size carries across pipeline batches
+    writer = EmbeddingWriter(vectordb=get_vector_store(PERSIST), persist_directory=PERSIST)
+    paths = [f for f, _ in to_index]
+    indexed = failed = total_chunks = 0
+    # parse/chunk/embed/write spans of this run share one trace (TRACING=true)
+    run_span = start_span("setup_db", files=len(paths))
+    try:
+        with use_span(run_span):
+            for event, res in stream_index(
+                paths,
+                write_fn=writer.write,
+                batch_size=args.batch_size,
+                skip_ids=skip_ids,
+                on_batch_committed=checkpoint.append,
+                dedup=registry,
+                workers=args.workers,
+                chunk_workers=args.chunk_workers,
+                timeout=args.timeout,
+            ):
+                if event == "failed":
+                    # keep the previous entry (if any) so the file is retried next run
+                    failed += 1
+                elif event in ("committed", "duplicate"):
+                    # 4. Drop vectors the changed file no longer produces, then record it
+                    key = res.path.name
+                    old_ids = manifest.files.get(key, {}).get("chunk_ids", [])
+                    stale = set(deletable(set(old_ids) - set(res.chunk_ids))) | set(res.replaced_ids)
+                    delete_chunks(sorted(stale), persist_directory=PERSIST)
+                    manifest.record(key, res.path, to_index[res.index][1], res.chunk_ids)
+                    manifest.save()
+                    if event == "duplicate":
+                        LOG.info("%s: same content as %s, not parsed", key, res.duplicate_of)
+                    indexed += 1
+                    total_chunks += len(res.chunk_ids)
+    except Exception as e:
+        run_span.end(e)
+        manifest.save()
+        LOG.error("Vector DB update failed (%s). Re-run to resume from the last committed batch.", e)
+        sys.exit(2)
+    run_span.set(indexed=indexed, failed=failed, chunks=total_chunks).end()
+
+    manifest.save()
+    checkpoint.clear()
+    if not indexed:
         LOG.error("No chunks to index. Exiting.")
         sys.exit(1)
-        
-    # 3. Create/Update Vector Store
-    LOG.info("Creating Vector Store...")
-    vs = create_vector_store_from_documents(all_chunks, persist_directory=PERSIST)
-    
-    if vs is None:
-        LOG.error("Vector DB creation failed")
-        sys.exit(2)
-        
-    LOG.info("✅ Vector DB successfully created at: %s", PERSIST)
+
+    LOG.info("✅ Vector DB successfully updated at: %s (%d files, %d chunks indexed, %d failed)", PERSIST, indexed, total_chunks, failed)
     LOG.info("Setup_db completed.")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,315 @@
+# tracing.py
+"""
+Per-stage spans and metrics for the query and ingestion pipelines.
+
+    with span("rerank", candidates=len(docs)) as s:
+        docs = stage.rerank(query, docs)
+        s.set(kept=len(docs))
+
+Spans nest through a context variable (asyncio tasks inherit it; use bind() for
+thread pools), so every stage of one question shares a trace_id. Finished spans
+are appended to TRACE_FILE as JSON lines and aggregated into Prometheus metrics:
+
+    rag_span_total{span,status}             calls per stage
+    rag_span_duration_seconds{span}         latency histogram per stage
+    rag_span_attribute_total{span,attr}     sum of numeric attributes (tokens, candidates, cache hits, ...)
+
+The metrics are rewritten to METRICS_FILE (node-exporter textfile format) at
+most every METRICS_INTERVAL_S when a trace finishes and at exit, and served on
+http://METRICS_HOST:METRICS_PORT/metrics when the port is set (METRICS_HOST
+defaults to 127.0.0.1; set it to 0.0.0.0 to let a remote Prometheus scrape).
+
+Off unless TRACING=true (or enable() is called): span() then returns a shared
+no-op object, so instrumented code pays one function call per stage.
+"""
+
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+TRACING = os.getenv("TRACING", "false").lower() == "true"
+TRACE_FILE = os.getenv("TRACE_FILE", "./persist/traces.jsonl")
+METRICS_FILE = os.getenv("METRICS_FILE", "./persist/metrics.prom")
+METRICS_INTERVAL_S = float(os.getenv("METRICS_INTERVAL_S", "10"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LOG = logging.getLogger(__name__)
+LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+# consumer went away (task cancelled, stream closed early): not counted as an error
+_CANCELLED = ("CancelledError", "GeneratorExit")
+
+_CURRENT: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("tracing_span", default=None)
+
+
+class _NoopSpan:
+    """Returned while tracing is off; accepts and ignores everything."""
+
+    __slots__ = ()
+    trace_id = span_id = None
+
+    def set(self, **attrs) -> "_NoopSpan":
+        return self
+
+    def end(self, error: Optional[BaseException] = None):
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+
+NOOP = _NoopSpan()
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attrs", "started", "_t0", "_token", "_ended")
+
+    def __init__(self, name: str, parent: Optional["Span"], attrs: Dict[str, Any]):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attrs = attrs
+        self.started = time.time()
+        self._t0 = time.perf_counter()
+        self._token = None
+        self._ended = False
+
+    def set(self, **attrs) -> "Span":
+        self.attrs.update(attrs)
+        return self
+
+    def end(self, error: Optional[BaseException] = None):
+        if not self._ended:
+            self._ended = True
+            _TRACER.finish(self, time.perf_counter() - self._t0, error)
+
+    def __enter__(self) -> "Span":
+        self._token = _CURRENT.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        try:
+            _CURRENT.reset(self._token)
+        except ValueError:
+            pass  # exited in another context, e.g. a generator resumed by a different thread
+        self.end(exc)
+        return False
+
+
+class Tracer:
+    """Writes finished spans as JSON lines and keeps the Prometheus aggregates."""
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_file: Optional[str] = None
+        self.metrics_file: Optional[str] = None
+        self._lock = threading.Lock()
+        self._fh = None
+        self._calls: Dict[Tuple[str, str], int] = {}
+        self._hist: Dict[str, List[float]] = {}  # span -> bucket counts + [sum, count]
+        self._attrs: Dict[Tuple[str, str], float] = {}
+        self._metrics_written = 0.0
+
+    def finish(self, s: Span, seconds: float, error: Optional[BaseException]):
+        status = "ok" if error is None else ("cancelled" if type(error).__name__ in _CANCELLED else "error")
+        record = {"trace_id": s.trace_id, "span_id": s.span_id, "parent_id": s.parent_id, "name": s.name,
+                  "start": round(s.started, 6), "duration_ms": round(seconds * 1000, 3), "status": status}
+        if error is not None:
+            record["error"] = f"{type(error).__name__}: {error}"
+        if s.attrs:
+            record["attrs"] = s.attrs
+        line = json.dumps(record, default=str)
+        with self._lock:
+            key = (s.name, status)
+            self._calls[key] = self._calls.get(key, 0) + 1
+            hist = self._hist.get(s.name)
+            if hist is None:
+                hist = self._hist[s.name] = [0.0] * (len(DURATION_BUCKETS) + 2)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+            for k, v in s.attrs.items():
+                if isinstance(v, (int, float)):  # bools count as 0/1 (cache hits)
+                    self._attrs[(s.name, k)] = self._attrs.get((s.name, k), 0.0) + float(v)
+            if self.trace_file:
+                try:
+                    if self._fh is None:
+                        os.makedirs(os.path.dirname(os.path.abspath(self.trace_file)), exist_ok=True)
+                        self._fh = open(self.trace_file, "a", encoding="utf-8", buffering=1)
+                    self._fh.write(line + "\n")
+                except OSError as e:
+                    LOG.warning("Could not write span to %s: %s", self.trace_file, e)
+                    self.trace_file = None
+            due = s.parent_id is None and time.monotonic() - self._metrics_written >= METRICS_INTERVAL_S
+            if due:
+                self._metrics_written = time.monotonic()
+        if due:
+            self.write_metrics()
+
+    def metrics_text(self) -> str:
+        """Prometheus text exposition of everything recorded so far."""
+        with self._lock:
+            calls = dict(self._calls)
+            hists = {k: list(v) for k, v in self._hist.items()}
+            attrs = dict(self._attrs)
+        out = ["# HELP rag_span_total Finished spans per stage and status.", "# TYPE rag_span_total counter"]
+        out += [f'rag_span_total{{span="{n}",status="{st}"}} {c}' for (n, st), c in sorted(calls.items())]
+        out += ["# HELP rag_span_duration_seconds Stage latency.", "# TYPE rag_span_duration_seconds histogram"]
+        for name, h in sorted(hists.items()):
+            for bound, count in zip(DURATION_BUCKETS, h):
+                out.append(f'rag_span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {int(count)}')
+            out.append(f'rag_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {int(h[-1])}')
+            out.append(f'rag_span_duration_seconds_sum{{span="{name}"}} {h[-2]:.6f}')
+            out.append(f'rag_span_duration_seconds_count{{span="{name}"}} {int(h[-1])}')
+        out += ["# HELP rag_span_attribute_total Sum of numeric span attributes (tokens, candidates, cache hits).",
+                "# TYPE rag_span_attribute_total counter"]
+        out += [f'rag_span_attribute_total{{span="{n}",attr="{a}"}} {v:g}' for (n, a), v in sorted(attrs.items())]
+        return "\n".join(out) + "\n"
+
+    def write_metrics(self, path: Optional[str] = None):
+        path = path or self.metrics_file
+        if not path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(self.metrics_text())
+            os.replace(tmp, path)  # scrapers never see a half-written file
+        except OSError as e:
+            LOG.warning("Could not write metrics to %s: %s", path, e)
+
+    def flush(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.flush()
+        self.write_metrics()
+
+
+_TRACER = Tracer()
+_SERVER = None
+
+
+def enable(trace_file: Optional[str] = TRACE_FILE, metrics_file: Optional[str] = METRICS_FILE, port: int = METRICS_PORT):
+    """Turns span recording on; pass None to skip the JSONL or metrics file."""
+    _TRACER.trace_file = trace_file
+    _TRACER.metrics_file = metrics_file
+    _TRACER.enabled = True
+    if port:
+        serve_metrics(port)
+    LOG.info("Tracing on: spans -> %s, metrics -> %s", trace_file, metrics_file)
+
+
+def disable():
+    _TRACER.flush()
+    _TRACER.enabled = False
+
+
+def enabled() -> bool:
+    return _TRACER.enabled
+
+
+def span(name: str, **attrs) -> Any:
+    """Context manager timing one stage as a child of the current span."""
+    if not _TRACER.enabled:
+        return NOOP
+    return Span(name, _CURRENT.get(), attrs)
+
+
+def start_span(name: str, parent: Any = None, **attrs) -> Any:
+    """
+    Span that is not made current; finish it with .end(). For stages that outlive
+    the calling frame, such as a streamed answer. parent defaults to the current span.
+    """
+    if not _TRACER.enabled:
+        return NOOP
+    return Span(name, parent if isinstance(parent, Span) else _CURRENT.get(), attrs)
+
+
+def current() -> Any:
+    return _CURRENT.get() or NOOP
+
+
+@contextmanager
+def use_span(s: Any):
+    """Makes a span from start_span() current for the block without ending it."""
+    if not isinstance(s, Span):
+        yield s
+        return
+    token = _CURRENT.set(s)
+    try:
+        yield s
+    finally:
+        _CURRENT.reset(token)
+
+
+def annotate(**attrs):
+    """Adds attributes to the current span, if any."""
+    s = _CURRENT.get()
+    if s is not None:
+        s.attrs.update(attrs)
+
+
+def bind(fn: Callable) -> Callable:
+    """fn running in (a copy of) the caller's context, so spans opened in a worker thread join the caller's trace."""
+    if not _TRACER.enabled:
+        return fn
+    ctx = contextvars.copy_context()
+    return lambda *a, **kw: ctx.copy().run(fn, *a, **kw)
+
+
+def metrics_text() -> str:
+    return _TRACER.metrics_text()
+
+
+def write_metrics(path: Optional[str] = None):
+    _TRACER.write_metrics(path)
+
+
+def serve_metrics(port: int, host: str = METRICS_HOST):
+    """Serves metrics_text() on http://host:port/metrics from a daemon thread (once per process)."""
+    global _SERVER
+    if _SERVER is not None:
+        return
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics_text().encode("utf-8")
+            self.send_response(200 if self.path.startswith("/metrics") else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        _SERVER = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        LOG.warning("Metrics endpoint not started on %s:%d: %s", host, port, e)
+        return
+    threading.Thread(target=_SERVER.serve_forever, name="metrics", daemon=True).start()
+    LOG.info("Metrics endpoint on %s:%d/metrics", host, port)
+
+
+atexit.register(lambda: _TRACER.flush() if _TRACER.enabled else None)
+
+if TRACING:
+    enable()
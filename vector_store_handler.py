@@ -1,31 +1,269 @@
 import os
+import time
+import sys
+import inspect
+import random
 import logging
-from typing import List, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
 from langchain_core.documents import Document
-from langchain_chroma import Chroma
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from langchain_core.vectorstores import VectorStore, VectorStoreRetriever
 from dotenv import load_dotenv
+from embedding_cache import EmbeddingCache, CachedEmbeddings
+from data_loader import chunk_id, estimate_tokens
+from lexical_index import HybridRetriever, get_lexical_index
+from dedup_registry import get_dedup_registry
+from metadata_index import Scope, get_metadata_index
+from local_index import LocalVectorStore, get_local_index
+from tracing import span, bind
 
 load_dotenv()
 
 PERSIST_DIR = os.getenv("PERSIST_DIRECTORY", "./persist/chroma_db_prod")
 EMBED_MODEL = os.getenv("EMBEDDING_MODEL", "models/text-embedding-004")
 COLLECTION_NAME = os.getenv("CHROMA_COLLECTION_NAME", "multi_rag")
-RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "5"))
+# candidates per query; defaults to the rerank pool (rerank_stage.RERANK_FETCH_K), so fetch_k sets how many are scored
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", os.getenv("RERANK_FETCH_K", "10")))
+# "chroma" or "local" (memory-mapped quantized index, see local_index.py; migrate with `python local_index.py migrate`)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma").lower()
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() in ("1", "true", "yes")
+EMBED_CACHE = os.getenv("EMBED_CACHE", "true").lower() in ("1", "true", "yes")
+# Embedding writer: batches are capped by an (estimated) token budget and an item count
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "16000"))
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "100"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "6"))
 
 LOG = logging.getLogger(__name__)
 LOG.setLevel(os.getenv("LOG_LEVEL", "INFO"))
 
+_EMBED_CACHES = {}
+
+
+def sidecar_path(name: str, persist_directory: Optional[str] = None) -> str:
+    """Path for auxiliary index data stored next to the Chroma directory, e.g. ./persist/chroma_db_prod_embeddings"""
+    persist = persist_directory or PERSIST_DIR
+    return f"{os.path.normpath(persist)}_{name}"
+
+
+def local_index_path(persist_directory: Optional[str] = None) -> str:
+    return os.path.join(persist_directory or PERSIST_DIR, "local_index")
+
+
+def get_lexical(persist_directory: Optional[str] = None):
+    """BM25 index kept in step with the collection, or None when HYBRID_SEARCH is off."""
+    return get_lexical_index(sidecar_path("lexical", persist_directory)) if HYBRID_SEARCH else None
+
+
+def index_version(persist_directory: Optional[str] = None) -> str:
+    """Opaque token that changes on every write to the collection (used to invalidate answer caches)."""
+    try:
+        with open(sidecar_path("version", persist_directory), "r", encoding="utf-8") as fh:
+            return fh.read().strip()
+    except FileNotFoundError:
+        return "0"
+
+
+def bump_index_version(persist_directory: Optional[str] = None) -> str:
+    version = str(time.time_ns())
+    path = sidecar_path("version", persist_directory)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        fh.write(version)
+    os.replace(tmp, path)
+    return version
+
+
+def embedding_model():
+    """The provider's embedding client (the Google SDK is imported on first use, not at module load)."""
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+    return GoogleGenerativeAIEmbeddings(model=EMBED_MODEL)
+
+
+def open_chroma(persist_directory: str, embeddings) -> VectorStore:
+    # chromadb is only imported by processes that use the Chroma backend
+    from langchain_chroma import Chroma
+    return Chroma(persist_directory=persist_directory, embedding_function=embeddings, collection_name=COLLECTION_NAME)
+
+
+def get_embeddings(persist_directory: Optional[str] = None):
+    """Embedding function for the collection, backed by the on-disk chunk_hash cache."""
+    embeddings = embedding_model()
+    if not EMBED_CACHE:
+        return embeddings
+    cache_dir = os.getenv("EMBED_CACHE_DIR") or sidecar_path("embeddings", persist_directory)
+    key = (cache_dir, EMBED_MODEL)
+    if key not in _EMBED_CACHES:
+        _EMBED_CACHES[key] = EmbeddingCache(cache_dir, EMBED_MODEL)
+    return CachedEmbeddings(embeddings, _EMBED_CACHES[key])
+
+
+def is_rate_limit(e: Exception) -> bool:
+    """True for provider throttling errors (HTTP 429, quota exhausted), whichever SDK raised them."""
+    status = getattr(e, "status_code", None) or getattr(e, "code", None)
+    if status == 429:
+        return True
+    msg = f"{type(e).__name__} {e}".lower()
+    return any(s in msg for s in ("429", "rate limit", "ratelimit", "quota", "resource exhausted", "resourceexhausted", "too many requests"))
+
+
+class EmbeddingWriter:
+    """
+    Embeds documents and upserts them into Chroma in token-budgeted batches.
+
+    - batches are cut by EMBED_BATCH_TOKENS (estimated) and the current item limit
+    - up to EMBED_CONCURRENCY batches are embedded at once
+    - on throttling the batch is backed off and the item limit halved; each success grows it again (AIMD)
+    - throughput is logged and returned by write()
+
+    embed_fn defaults to the store's (cached) embeddings; pass any List[str] -> List[List[float]]
+    callable (e.g. a local fake with injected latency / rate-limit errors) to exercise it offline.
+    """
+
+    def __init__(self, vectordb: Optional[VectorStore] = None, embed_fn: Optional[Callable[[List[str]], List[List[float]]]] = None,
+                 persist_directory: Optional[str] = None, max_tokens: int = EMBED_BATCH_TOKENS, max_items: int = EMBED_BATCH_MAX,
+                 concurrency: int = EMBED_CONCURRENCY, max_retries: int = EMBED_MAX_RETRIES, base_delay: float = 1.0):
+        self.vectordb = vectordb
+        self.persist_directory = persist_directory
+        self.embed_fn = embed_fn
+        self.max_tokens = max_tokens
+        self.max_items = max_items
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.batch_limit = max_items
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._store_lock = threading.Lock()
+        self.throttled = 0
+
+    def _store(self) -> VectorStore:
+        # opened lazily by the first embed worker; Chroma's client cache is not safe to populate from several threads
+        if self.vectordb is None:
+            with self._store_lock:
+                if self.vectordb is None:
+                    self.vectordb = get_vector_store(self.persist_directory)
+        return self.vectordb
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        if self.embed_fn is None:
+            self.embed_fn = self._store().embeddings.embed_documents
+        return self.embed_fn(texts)
+
+    def _batches(self, documents: List[Document]) -> List[List[Document]]:
+        limit = self.batch_limit
+        batches, cur, cur_tokens = [], [], 0
+        for d in documents:
+            t = estimate_tokens(d.page_content)
+            if cur and (len(cur) >= limit or cur_tokens + t > self.max_tokens):
+                batches.append(cur)
+                cur, cur_tokens = [], 0
+            cur.append(d)
+            cur_tokens += t
+        if cur:
+            batches.append(cur)
+        return batches
+
+    def _on_success(self):
+        with self._lock:
+            self.batch_limit = min(self.max_items, self.batch_limit + max(1, self.max_items // 10))
+
+    def _on_throttle(self):
+        with self._lock:
+            self.throttled += 1
+            self.batch_limit = max(1, self.batch_limit // 2)
+
+    def _embed_with_backoff(self, batch: List[Document]) -> List[List[float]]:
+        """Embeds one batch, splitting it when the provider throttles and the limit has shrunk below its size."""
+        attempt = 0
+        while True:
+            try:
+                vectors = self._embed([d.page_content for d in batch])
+                self._on_success()
+                return vectors
+            except Exception as e:
+                if not is_rate_limit(e) or attempt >= self.max_retries:
+                    raise
+                self._on_throttle()
+                delay = self.base_delay * (2 ** attempt) * (0.5 + random.random())
+                LOG.warning("Embedding throttled (%s); retrying in %.1fs with batch limit %d", e, delay, self.batch_limit)
+                time.sleep(delay)
+                attempt += 1
+                limit = self.batch_limit
+                if len(batch) > limit:
+                    out = []
+                    for i in range(0, len(batch), limit):
+                        out.extend(self._embed_with_backoff(batch[i:i + limit]))
+                    return out
+
+    def _write_batch(self, batch: List[Document]) -> int:
+        with span("embed", chunks=len(batch), tokens=sum(estimate_tokens(d.page_content) for d in batch)):
+            vectors = self._embed_with_backoff(batch)
+        with self._write_lock, span("write", chunks=len(batch)):
+            self._store()._collection.upsert(
+                ids=[chunk_id(d) for d in batch],
+                embeddings=vectors,
+                documents=[d.page_content for d in batch],
+                metadatas=[d.metadata or None for d in batch],
+            )
+            lexical = get_lexical(self.persist_directory)
+            if lexical is not None:
+                lexical.add_documents(batch)
+        return len(batch)
+
+    def write(self, documents: List[Document]) -> Dict[str, Any]:
+        """Embeds and upserts all documents; raises if a batch still fails after retries."""
+        t0 = time.perf_counter()
+        version_before = index_version(self.persist_directory)
+        # identical text on two pages of one file maps to one ID; a repeated ID in an upsert is rejected by Chroma
+        unique: Dict[str, Document] = {}
+        for d in documents:
+            unique.setdefault(chunk_id(d), d)
+        documents = list(unique.values())
+        batches = self._batches(documents)
+        written = 0
+        throttled = self.throttled
+        with span("embed_write", chunks=len(documents), batches=len(batches)) as s:
+            if self.concurrency == 1 or len(batches) == 1:
+                for b in batches:
+                    written += self._write_batch(b)
+            else:
+                with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="embed") as pool:
+                    for n in pool.map(bind(self._write_batch), batches):
+                        written += n
+            s.set(throttled=self.throttled - throttled)
+        if written:
+            unchanged = index_version(self.persist_directory) == version_before
+            version = bump_index_version(self.persist_directory)
+            if unchanged:
+                # nobody else wrote meanwhile: update the scope listing in place instead of rescanning
+                get_metadata_index(self.persist_directory).note_written(
+                    [(chunk_id(d), d.metadata) for d in documents], version_before, version)
+        elapsed = time.perf_counter() - t0
+        stats = {
+            "chunks": written,
+            "batches": len(batches),
+            "seconds": elapsed,
+            "chunks_per_sec": written / elapsed if elapsed > 0 else float("inf"),
+            "throttled": self.throttled,
+            "batch_limit": self.batch_limit,
+        }
+        LOG.info("Embedded %d chunks in %d batches: %.1f chunks/s (throttled %d times, batch limit now %d)",
+                 written, len(batches), stats["chunks_per_sec"], self.throttled, self.batch_limit)
+        return stats
+
 
 def create_vector_store_from_documents(documents: List[Document], persist_directory: Optional[str] = None):
     if not documents:
         LOG.error("No documents provided to create vector store.")
         return None
     persist = persist_directory or PERSIST_DIR
-    embeddings = GoogleGenerativeAIEmbeddings(model=EMBED_MODEL)
     try:
-# NEW (Correct) -> changed 'embedding_function' to 'embedding'
-        vectordb = Chroma.from_documents(documents=documents, embedding=embeddings, persist_directory=persist, collection_name=COLLECTION_NAME)
+        # stable IDs make this an upsert: re-indexing a file no longer appends duplicate vectors
+        vectordb = get_vector_store(persist)
+        EmbeddingWriter(vectordb=vectordb, persist_directory=persist).write(documents)
         if hasattr(vectordb, "persist"):
             vectordb.persist()
         LOG.info("Created Chroma at %s", persist)
@@ -35,21 +273,169 @@ def create_vector_store_from_documents(documents: List[Document], persist_direct
         return None
 
 
+def get_vector_store(persist_directory: Optional[str] = None) -> VectorStore:
+    persist = persist_directory or PERSIST_DIR
+    if VECTOR_BACKEND == "local":
+        return LocalVectorStore(local_index_path(persist), embedding_function=get_embeddings(persist))
+    return open_chroma(persist, get_embeddings(persist))
+
+
+def get_collection(persist_directory: Optional[str] = None):
+    """The store's raw collection, opened without an embedding client (metadata scans need no provider)."""
+    persist = persist_directory or PERSIST_DIR
+    if VECTOR_BACKEND == "local":
+        return get_local_index(local_index_path(persist))
+    return open_chroma(persist, None)._collection
+
+
+def upsert_documents(documents: List[Document], persist_directory: Optional[str] = None, vectordb: Optional[VectorStore] = None) -> int:
+    """
+    Writes one batch under deterministic chunk IDs (insert or overwrite).
+    Unlike create_vector_store_from_documents this raises on failure, so streaming callers can stop and resume.
+    """
+    if not documents:
+        return 0
+    return EmbeddingWriter(vectordb=vectordb, persist_directory=persist_directory).write(documents)["chunks"]
+
+
+def delete_chunks(ids: List[str], persist_directory: Optional[str] = None) -> bool:
+    """Removes vectors by chunk ID (see data_loader.chunk_id)."""
+    if not ids:
+        return True
+    try:
+        get_vector_store(persist_directory).delete(ids=list(ids))
+        lexical = get_lexical(persist_directory)
+        if lexical is not None:
+            lexical.remove(list(ids))
+        version_before = index_version(persist_directory)
+        get_metadata_index(persist_directory).note_removed(ids, version_before, bump_index_version(persist_directory))
+        LOG.info("Deleted %d stale vectors", len(ids))
+        return True
+    except Exception as e:
+        LOG.exception("Failed to delete vectors: %s", e)
+        return False
+
+
+def reset_collection(persist_directory: Optional[str] = None) -> bool:
+    """Drops the whole collection (used by setup_db --full)."""
+    try:
+        get_vector_store(persist_directory).delete_collection()
+        lexical = get_lexical(persist_directory)
+        if lexical is not None:
+            lexical.clear()
+        registry = get_dedup_registry(persist_directory)
+        if registry is not None:
+            registry.clear()
+        bump_index_version(persist_directory)
+        LOG.info("Dropped collection %s", COLLECTION_NAME)
+        return True
+    except Exception as e:
+        LOG.exception("Failed to drop collection: %s", e)
+        return False
+
+
+class ScoredVectorRetriever(VectorStoreRetriever):
+    """Similarity search that keeps the relevance score in metadata['vector_score'] (used by the rerank stage)."""
+
+    @staticmethod
+    def _stamp(pairs) -> List[Document]:
+        return [Document(page_content=d.page_content, metadata={**d.metadata, "vector_score": float(s)}, id=d.id) for d, s in pairs]
+
+    def _get_relevant_documents(self, query: str, *, run_manager, **kwargs) -> List[Document]:
+        return self._stamp(self.vectorstore.similarity_search_with_relevance_scores(query, **(self.search_kwargs | kwargs)))
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager, **kwargs) -> List[Document]:
+        return self._stamp(await self.vectorstore.asimilarity_search_with_relevance_scores(query, **(self.search_kwargs | kwargs)))
+
+
+def scoped_retriever(retriever, scope: Optional[Scope], persist_directory: Optional[str] = None):
+    """
+    Copy of retriever restricted to scope: the vector search gets a Chroma `where` filter,
+    so only matching chunks are searched, and the BM25 side of a HybridRetriever is filtered the same way.
+    """
+    if retriever is None or scope is None or scope.is_empty():
+        return retriever
+    if isinstance(retriever, HybridRetriever):
+        return retriever.model_copy(update={"vector_retriever": scoped_retriever(retriever.vector_retriever, scope, persist_directory),
+                                            "scope": scope})
+    if isinstance(retriever, VectorStoreRetriever):
+        where = scope.to_where(get_metadata_index(persist_directory))
+        return retriever.model_copy(update={"search_kwargs": {**retriever.search_kwargs, "filter": where}})
+    LOG.warning("Retriever %s does not support scopes; searching everything", type(retriever).__name__)
+    return retriever
+
+
+def embed_queries(embeddings, texts: List[str]) -> List[List[float]]:
+    """
+    Query vectors for several texts. Embedders whose embed_documents takes a task_type
+    (Gemini) get a single batched request in query mode; others are called once per text.
+    """
+    if not texts:
+        return []
+    base = getattr(embeddings, "base", embeddings)  # CachedEmbeddings only caches documents
+    if "task_type" in inspect.signature(base.embed_documents).parameters:
+        return base.embed_documents(list(texts), task_type="RETRIEVAL_QUERY")
+    return [embeddings.embed_query(t) for t in texts]
+
+
+def _search_by_vectors(vectorstore, vectors: List[List[float]], k: int, where: Optional[Dict[str, Any]]):
+    """Per query [(Document, distance)] from one store call, or None if the store has no multi-query search."""
+    if isinstance(vectorstore, LocalVectorStore):
+        return vectorstore.similarity_search_by_vectors_with_score(vectors, k=k, filter=where)
+    chroma = sys.modules.get("langchain_chroma")  # loaded if any Chroma store was opened
+    if chroma is not None and isinstance(vectorstore, chroma.Chroma):
+        res = vectorstore._collection.query(query_embeddings=vectors, n_results=k, where=where or None,
+                                            include=["documents", "metadatas", "distances"])
+        return [[(Document(page_content=t or "", metadata=m or {}, id=i), dist) for i, t, m, dist in zip(*cols)]
+                for cols in zip(res["ids"], res["documents"], res["metadatas"], res["distances"])]
+    return None
+
+
+def search_many(retriever, queries: List[str], vectors: List[List[float]]) -> Optional[List[List[Document]]]:
+    """
+    retriever.invoke(q) for every query, with all precomputed query vectors sent to the
+    vector store in a single search (the BM25 side of a HybridRetriever still runs per query).
+    Returns None for retrievers it cannot batch; callers fall back to retriever.batch.
+    """
+    if isinstance(retriever, HybridRetriever):
+        dense = search_many(retriever.vector_retriever, queries, vectors)
+        return None if dense is None else [retriever._fuse(q, d) for q, d in zip(queries, dense)]
+    if not isinstance(retriever, ScoredVectorRetriever) or retriever.search_type != "similarity":
+        return None
+    kwargs = dict(retriever.search_kwargs)
+    k, where = kwargs.pop("k", 4), kwargs.pop("filter", None)
+    if kwargs:  # e.g. score_threshold: leave it to the store's own search
+        return None
+    hits = _search_by_vectors(retriever.vectorstore, vectors, k, where)
+    if hits is None:
+        return None
+    relevance = retriever.vectorstore._select_relevance_score_fn()
+    return [ScoredVectorRetriever._stamp([(d, relevance(dist)) for d, dist in pairs]) for pairs in hits]
+
+
 def get_existing_retriever(persist_directory: Optional[str] = None):
     persist = persist_directory or PERSIST_DIR
     if not os.path.isdir(persist):
         LOG.warning("Persist directory missing: %s", persist)
         return None
     try:
-        embeddings = GoogleGenerativeAIEmbeddings(model=EMBED_MODEL)
-        vectordb = Chroma(persist_directory=persist, embedding_function=embeddings, collection_name=COLLECTION_NAME)
+        embeddings = embedding_model()
+        if VECTOR_BACKEND == "local":
+            vectordb = LocalVectorStore(local_index_path(persist), embedding_function=embeddings)
+        else:
+            vectordb = open_chroma(persist, embeddings)
         # best-effort
         try:
             cnt = vectordb._collection.count()
             LOG.info("Loaded collection %s with %d vectors", COLLECTION_NAME, cnt)
         except Exception:
             LOG.debug("Could not read internal collection count")
-        return vectordb.as_retriever(search_kwargs={"k": RETRIEVAL_K})
+        retriever = ScoredVectorRetriever(vectorstore=vectordb, search_kwargs={"k": RETRIEVAL_K})
+        lexical = get_lexical(persist)
+        if lexical is not None and len(lexical):
+            LOG.info("Hybrid retrieval: BM25 index with %d chunks", len(lexical))
+            return HybridRetriever(vector_retriever=retriever, index=lexical, k=RETRIEVAL_K)
+        return retriever
     except Exception as e:
         LOG.exception("Failed to load Chroma: %s", e)
         return None